@@ -0,0 +1,174 @@
+"""
+Persistent chat archive for the jetsetradio.live CLI client.
+
+Every chat message the client sees goes into a local SQLite database with a
+full-text (FTS5) index over usernames and messages, so chat can be searched
+long after it's scrolled off messages.xml. Writes are queued and done in
+batches on a thread of their own, so polling and drawing never wait on disk.
+
+Messages are stored as the ingester finds them new, so someone saying the
+same thing twice is archived twice. The one overlap left is at startup, when
+the first poll hands over the whole of messages.xml again: the part of it
+that lines up with the end of the archive is skipped.
+"""
+
+import queue
+import sqlite3
+import threading
+import time
+
+from chat import ChatMessage, overlap
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    fingerprint BLOB NOT NULL,
+    user TEXT NOT NULL,
+    text TEXT NOT NULL,
+    role TEXT NOT NULL,
+    seen REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_fingerprint ON messages (fingerprint);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(user, text, content='messages', content_rowid='id');
+CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, user, text) VALUES (new.id, new.user, new.text);
+END;
+'''
+
+
+def fts_query(terms):
+    """
+    Turns what was typed after /search into an FTS5 query: every word has to match, and the last
+    one can be the start of a word. Quoting each word keeps FTS5 syntax out of it.
+
+    Args:
+        terms (str): The search terms
+
+    Returns:
+        str: The FTS5 query, '' if there's nothing to search for
+    """
+    words = ['"%s"' % word.replace('"', '""') for word in terms.split()]
+    if not words:
+        return ''
+    words[-1] += '*'  # Prefix match on the last word, so half-typed names still find something
+    return ' '.join(words)
+
+
+class ChatArchive(object):
+    def __init__(self, path, batch_size=500, flush_interval=1.0, tail_size=1000):
+        """
+        Opens (or creates) the archive and starts its writer thread
+
+        Args:
+            path (str): The SQLite database file
+            batch_size (int): Most messages written in one transaction
+            flush_interval (float): Longest a message waits in the queue before it's written, in seconds
+            tail_size (int): How many of the latest archived messages the first batch is checked against
+        """
+        self.__path = path
+        self.__batch_size = batch_size
+        self.__flush_interval = flush_interval
+        self.__queue = queue.Queue()  # Batches of messages to write; None stops the writer
+        self.__readers = threading.local()  # One read connection per thread that searches
+
+        connection = self.__connect()  # Create the tables up front so searches work before the first write
+        connection.executescript(SCHEMA)
+        self.__tail = [row[0] for row in connection.execute(  # The latest archived messages, oldest first
+            'SELECT fingerprint FROM messages ORDER BY id DESC LIMIT ?', (tail_size,))][::-1]
+        connection.close()
+
+        self.written = 0  # Messages stored
+        self.duplicates = 0  # Messages skipped because they were archived before this started (see add())
+        self.__writer = threading.Thread(target=self.__write, daemon=True, name='archive')
+        self.__writer.start()
+
+    def __connect(self):
+        connection = sqlite3.connect(self.__path, timeout=30)
+        connection.execute('PRAGMA journal_mode=WAL')  # Readers don't block the writer and vice versa
+        connection.execute('PRAGMA synchronous=NORMAL')  # Safe with WAL; a crash can only lose the last batch
+        return connection
+
+    def add(self, messages):
+        """
+        Queues messages to be archived; never blocks. The first batch is the whole of messages.xml (or the
+        relay's history), which was mostly archived by the last run: its messages up to the end of the archive
+        are skipped, those lined up with the archive's last ones or, failing that, the leading ones in it.
+
+        Args:
+            messages (list): ChatMessages, oldest first, each new (see chat.ChatIngester)
+        """
+        if self.__tail is not None:
+            tail, self.__tail = self.__tail, None
+            fingerprints = [message.fingerprint for message in messages]
+            archived = overlap(tail, fingerprints)
+            if not archived:
+                known = set(tail)
+                while archived < len(fingerprints) and fingerprints[archived] in known:
+                    archived += 1
+            self.duplicates += archived
+            messages = messages[archived:]
+
+        if messages:
+            self.__queue.put([(message.fingerprint, message.user, message.text, message.role, time.time())
+                              for message in messages])
+
+    def __write(self):
+        """
+        Writer thread: takes everything queued, waiting up to flush_interval for more, and writes it in
+        one transaction
+        """
+        connection = self.__connect()
+        running = True
+        while running:
+            rows = self.__queue.get()
+            if rows is None:
+                break
+
+            deadline = time.monotonic() + self.__flush_interval
+            while len(rows) < self.__batch_size:  # Gather more until the batch is full or it's time to write
+                try:
+                    more = self.__queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if more is None:
+                    running = False
+                    break
+                rows.extend(more)
+
+            with connection:  # One transaction per batch
+                connection.executemany('INSERT INTO messages (fingerprint, user, text, role, seen) '
+                                       'VALUES (?, ?, ?, ?, ?)', rows)
+            self.written += len(rows)
+        connection.close()
+
+    def search(self, terms, limit=50):
+        """
+        Finds archived messages matching every search term, newest first
+
+        Args:
+            terms (str): The search terms, as typed
+            limit (int): Most messages to return
+
+        Returns:
+            list: (ChatMessage, time first seen) tuples, newest first
+        """
+        query = fts_query(terms)
+        if not query:
+            return []
+
+        connection = getattr(self.__readers, 'connection', None)
+        if connection is None:
+            connection = self.__readers.connection = self.__connect()
+
+        # Walking the index newest first and stopping at the limit keeps this fast however big the archive is
+        rows = connection.execute('SELECT m.fingerprint, m.user, m.text, m.role, m.seen FROM messages_fts '
+                                  'JOIN messages m ON m.id = messages_fts.rowid WHERE messages_fts MATCH ? '
+                                  'ORDER BY messages_fts.rowid DESC LIMIT ?', (query, limit)).fetchall()
+        return [(ChatMessage(user, text, role, fingerprint), seen) for fingerprint, user, text, role, seen in rows]
+
+    def close(self):
+        """
+        Writes whatever's still queued and stops the writer thread
+        """
+        self.__queue.put(None)
+        self.__writer.join()
@@ -0,0 +1,674 @@
+"""
+Audio helpers for the jetsetradio.live CLI client.
+
+Kept free of curses, PyAudio and the network so they can be imported (and
+benchmarked) without taking over a terminal or opening a sound device.
+"""
+
+import array
+import collections
+import hashlib
+import os
+import subprocess
+import threading
+import wave
+
+try:  # NumPy is optional; when it's around whole buffers are converted in C
+    import numpy
+except ImportError:
+    numpy = None
+
+
+_sample_table = (None, None)  # (volume, table); Float32 encodings of every 16-bit sample at that volume
+
+
+def _get_sample_table(volume):
+    """
+    Returns a list mapping every unsigned 16-bit sample to its Float32 bytes at the given volume.
+    Only the table for the most recent volume is kept around (~2.5 MB).
+
+    Args:
+        volume (int): The volume to play music at; goes from 0 to 9
+    """
+    global _sample_table
+
+    if _sample_table[0] != volume:  # Volume changed (or first call), so the table has to be rebuilt
+        scale = volume / 9 / 65535
+        blob = array.array('f', map(scale.__mul__, range(65536))).tobytes()
+        _sample_table = (volume, [blob[i:i + 4] for i in range(0, len(blob), 4)])
+
+    return _sample_table[1]
+
+
+def convert_samples(data, volume):
+    """
+    Converts a buffer of raw wav data into Float32 samples scaled by the volume, in one pass
+
+    Args:
+        data (bytes): Raw data read from the wav; read as unsigned 16-bit samples
+        volume (int): The volume to play music at; goes from 0 to 9
+
+    Returns:
+        bytes: Native-endian Float32 samples ready to be written to the audio stream
+    """
+    usable = len(data) - len(data) % 2  # Drop a dangling byte so the buffer lines up with 16-bit samples
+
+    if numpy is not None:  # Vectorized path: one multiply over the whole buffer
+        scale = numpy.float32(volume / 9 / 65535)  # Divide by 0xFFFF to get a float, then multiply by the volume
+        samples = numpy.frombuffer(data, dtype=numpy.uint16, count=usable // 2)
+        return (samples * scale).astype(numpy.float32).tobytes()
+
+    samples = array.array('H')  # Fallback path: a lookup table keeps the per-sample work inside C builtins
+    samples.frombytes(memoryview(data)[:usable])
+    return b''.join(map(_get_sample_table(volume).__getitem__, samples))
+
+
+class RingBuffer(object):
+    def __init__(self, capacity):
+        """
+        Fixed-size byte ring between one writer thread (the decoder) and one reader (the PyAudio
+        callback). Neither side takes a lock: each side only ever moves its own position forward,
+        and the GIL makes those updates atomic.
+
+        Args:
+            capacity (int): Size of the ring in bytes; allocated once up front
+        """
+
+        self.__buffer = bytearray(capacity)
+        self.__capacity = capacity
+        self.__read_pos = 0  # Total bytes ever read; only the reader moves this
+        self.__write_pos = 0  # Total bytes ever written; only the writer moves this
+        self.__space = threading.Event()  # Set by the reader when it frees up space, so the writer can sleep
+        self.__closed = False  # Set by the writer once it has nothing more to write
+        self.underruns = 0  # Times the reader wanted more than was buffered (audible gaps)
+        self.overruns = 0  # Times the writer found the ring full and had to wait
+
+    @property
+    def capacity(self):
+        return self.__capacity
+
+    @property
+    def available(self):  # Bytes waiting to be read
+        return self.__write_pos - self.__read_pos
+
+    @property
+    def closed(self):  # True once the writer is done and everything's been read
+        return self.__closed and self.available == 0
+
+    def write(self, data):
+        """
+        Writes as much of 'data' as fits without waiting and returns how many bytes that was
+
+        Args:
+            data (bytes): Bytes to write
+        """
+        start = self.__write_pos
+        count = min(len(data), self.__capacity - (start - self.__read_pos))
+        if count <= 0:
+            self.overruns += 1
+            self.__space.clear()
+            return 0
+
+        offset = start % self.__capacity
+        first = min(count, self.__capacity - offset)  # The write may wrap around the end of the ring
+        self.__buffer[offset:offset + first] = data[:first]
+        self.__buffer[:count - first] = data[first:count]
+
+        self.__write_pos = start + count  # Publish the bytes only once they're in place
+        return count
+
+    def write_all(self, data, cancelled=lambda: False):
+        """
+        Writes all of 'data', waiting for the reader to make room whenever the ring is full
+
+        Args:
+            data (bytes): Bytes to write
+            cancelled (function): Checked while waiting; stops writing early when it returns True
+
+        Returns:
+            bool: False if writing was cancelled
+        """
+        view = memoryview(data)
+        while view:
+            written = self.write(view)
+            view = view[written:]
+            if not written:
+                if cancelled():
+                    return False
+                self.__space.wait(0.05)  # Woken up early by read()
+        return True
+
+    def read(self, n):
+        """
+        Reads up to n bytes without waiting; counts an underrun if fewer were available
+
+        Args:
+            n (int): Amount of bytes wanted
+        """
+        start = self.__read_pos
+        count = min(n, self.__write_pos - start)
+        if count < n and not self.__closed:
+            self.underruns += 1
+
+        offset = start % self.__capacity
+        first = min(count, self.__capacity - offset)
+        data = bytes(self.__buffer[offset:offset + first]) + bytes(self.__buffer[:count - first])
+
+        self.__read_pos = start + count  # Hand the space back to the writer
+        self.__space.set()
+        return data
+
+    def close(self):
+        """
+        Marks the end of the data; reads after this stop counting underruns
+        """
+        self.__closed = True
+        self.__space.set()
+
+
+class StreamingDecoder(object):
+    def __init__(self, chunks, total_bytes=None, source=None, framerate=44100, channels=2):
+        """
+        Decodes an mp3 through ffmpeg while it's still downloading. Reads like the wave.Wave_read
+        objects play_song used to get from temp.wav, but nothing ever touches the disk.
+
+        Args:
+            chunks (iterable): Pieces of the mp3 as they arrive (e.g. Response.iter_content())
+            total_bytes (int): Size of the whole mp3 if known (Content-Length), used to estimate the song length
+            source (object): Anything with a close() method to call when we're done (e.g. the HTTP response)
+            framerate (int): Sample rate to have ffmpeg output
+            channels (int): Amount of channels to have ffmpeg output
+
+        Raises:
+            OSError: If ffmpeg can't be started
+        """
+
+        self.__framerate = framerate
+        self.__channels = channels
+        self.__total_bytes = total_bytes
+        self.__source = source
+        self.__bytes_fed = 0  # How much of the mp3 has been handed to ffmpeg so far
+        self.__frames_read = 0  # How many frames have been read out of ffmpeg so far
+        self.__fed_all = False  # True once the whole mp3 made it into ffmpeg
+
+        # Raw unsigned 8-bit PCM in, same format the old temp.wav had; mp3 in through stdin and PCM out through stdout
+        self.__process = subprocess.Popen(
+            ['ffmpeg', '-loglevel', 'panic', '-i', 'pipe:0', '-f', 'u8', '-acodec', 'pcm_u8',
+             '-ar', str(framerate), '-ac', str(channels), 'pipe:1'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        )
+
+        # Feed ffmpeg from its own thread so a full stdout pipe can never deadlock the download
+        self.__feeder = threading.Thread(target=self.__feed, args=(chunks,), daemon=True, name='ffmpeg-feeder')
+        self.__feeder.start()
+
+    def __feed(self, chunks):
+        """
+        Copies the mp3 chunks into ffmpeg's stdin until the download ends or the decoder is closed
+
+        Args:
+            chunks (iterable): Pieces of the mp3 as they arrive
+        """
+        try:
+            for chunk in chunks:
+                if chunk:
+                    self.__process.stdin.write(chunk)
+                    self.__bytes_fed += len(chunk)
+            self.__fed_all = True
+        except Exception:  # ffmpeg went away, the decoder got closed or the download broke; end the song here
+            pass
+        finally:
+            if hasattr(chunks, 'close'):  # Lets generators (e.g. AudioCache.tee) know the download is over
+                chunks.close()
+            try:
+                self.__process.stdin.close()  # EOF lets ffmpeg flush the last frames and exit
+            except OSError:
+                pass
+
+    def readframes(self, n):
+        """
+        Reads up to n frames of PCM; blocks until they're decoded. Returns less at the end of the song.
+
+        Args:
+            n (int): Amount of frames to read
+        """
+        data = self.__process.stdout.read(n * self.__channels)
+        self.__frames_read += len(data) // self.__channels
+        return data
+
+    def getframerate(self):
+        return self.__framerate
+
+    def getnchannels(self):
+        return self.__channels
+
+    def tell(self):
+        return self.__frames_read
+
+    def getnframes(self):
+        """
+        Estimates the total amount of frames in the song. The mp3 isn't fully downloaded until the end,
+        so it's extrapolated from how much of the download has been decoded so far.
+        """
+        if not self.__total_bytes or not self.__bytes_fed:
+            return max(1, self.__frames_read)
+        return max(1, self.__frames_read, int(self.__frames_read * self.__total_bytes / self.__bytes_fed))
+
+    @property
+    def complete(self):
+        """
+        True if the whole song was decoded without errors (e.g. so it's safe to cache).
+        Only meaningful once readframes() has hit the end of the song.
+        """
+        return self.__fed_all and self.__process.wait() == 0
+
+    def close(self):
+        """
+        Stops ffmpeg and the download (used when the song ends or is skipped)
+        """
+        if self.__source is not None:
+            self.__source.close()
+        if self.__process.poll() is None:
+            self.__process.kill()
+        self.__process.wait()
+        self.__process.stdout.close()
+
+
+class BufferedTrack(object):
+    def __init__(self, decoder, max_bytes):
+        """
+        Reads a decoder ahead of playback on a background thread, keeping at most max_bytes of PCM
+        in memory. Reads the same as the decoder it wraps, so play_song doesn't know the difference.
+
+        Args:
+            decoder (object): A StreamingDecoder / wave.Wave_read to read ahead
+            max_bytes (int): The most PCM to hold in memory for this track at once
+        """
+
+        self.__decoder = decoder
+        self.__max_bytes = max(1, max_bytes)
+        self.__channels = decoder.getnchannels()
+        self.__chunks = collections.deque()  # Decoded PCM waiting to be played, oldest on the left
+        self.__buffered = 0  # Total bytes in self.__chunks
+        self.__frames_read = 0  # How many frames have been handed to the player
+        self.__finished = False  # True once the decoder has run dry
+        self.__closed = False
+        self.__condition = threading.Condition()
+
+        self.__thread = threading.Thread(target=self.__fill, daemon=True, name='track-buffer')
+        self.__thread.start()
+
+    def __fill(self):
+        """
+        Keeps the buffer topped up until the decoder runs out or the track is closed
+        """
+        try:
+            while True:
+                with self.__condition:
+                    while self.__buffered >= self.__max_bytes and not self.__closed:  # Over budget, wait for playback
+                        self.__condition.wait()
+                    if self.__closed:
+                        return
+
+                data = self.__decoder.readframes(4096)  # Decoding happens outside the lock
+                if not data:
+                    return
+
+                with self.__condition:
+                    self.__chunks.append(data)
+                    self.__buffered += len(data)
+                    self.__condition.notify_all()
+        except (OSError, ValueError):  # The decoder was closed out from under us
+            pass
+        finally:
+            with self.__condition:
+                self.__finished = True
+                self.__condition.notify_all()
+
+    @property
+    def buffered_bytes(self):  # How much decoded PCM is waiting in memory
+        return self.__buffered
+
+    def readframes(self, n):
+        """
+        Reads up to n frames; blocks until they're decoded. Returns less at the end of the song.
+
+        Args:
+            n (int): Amount of frames to read
+        """
+        wanted = n * self.__channels
+        pieces = []
+
+        with self.__condition:
+            while wanted > 0:
+                while not self.__chunks and not self.__finished:  # Caught up with the decoder, wait for more
+                    self.__condition.wait()
+                if not self.__chunks:  # Decoder is done and the buffer is empty
+                    break
+
+                chunk = self.__chunks.popleft()
+                if len(chunk) > wanted:  # Only part of this chunk is needed; put the rest back
+                    self.__chunks.appendleft(chunk[wanted:])
+                    chunk = chunk[:wanted]
+                pieces.append(chunk)
+                wanted -= len(chunk)
+                self.__buffered -= len(chunk)
+
+            self.__condition.notify_all()  # Room was made, so the filler can carry on
+
+        data = b''.join(pieces)
+        self.__frames_read += len(data) // self.__channels
+        return data
+
+    def getframerate(self):
+        return self.__decoder.getframerate()
+
+    def getnchannels(self):
+        return self.__channels
+
+    def tell(self):
+        return self.__frames_read
+
+    def getnframes(self):
+        return self.__decoder.getnframes()
+
+    def close(self):
+        """
+        Stops reading ahead, drops the buffer and closes the decoder
+        """
+        with self.__condition:
+            self.__closed = True
+            self.__chunks.clear()
+            self.__buffered = 0
+            self.__condition.notify_all()
+        self.__decoder.close()
+
+
+class Prefetcher(object):
+    def __init__(self, open_track, pick_next, depth=1, budget_bytes=64 * 1024 * 1024):
+        """
+        Picks upcoming tracks early and starts downloading/decoding them while the current one plays,
+        so the next track is ready the moment it's needed.
+
+        Args:
+            open_track (function): Takes a song URL, returns a decoder for it (or None if it couldn't be loaded)
+            pick_next (function): Returns the next [song name, song url] to play
+            depth (int): How many tracks to keep ready ahead of the one playing
+            budget_bytes (int): Total decoded PCM kept in memory, split between playing and upcoming tracks
+        """
+
+        self.__open_track = open_track
+        self.__pick_next = pick_next
+        self.__depth = max(0, depth)
+        self.__track_budget = budget_bytes // (self.__depth + 1)  # The playing track gets a share as well
+        self.__upcoming = collections.deque()  # [name, url, thread, result] in play order
+
+    def __start(self):
+        """
+        Picks the next song and starts loading it in the background
+        """
+        name, url = self.__pick_next()
+        result = []  # Filled in by the loading thread; a list so the thread can hand the track back
+
+        def load():
+            decoder = self.__open_track(url)
+            result.append(decoder and BufferedTrack(decoder, self.__track_budget))
+
+        thread = threading.Thread(target=load, daemon=True, name='prefetch')
+        thread.start()
+        self.__upcoming.append([name, url, thread, result])
+
+    def next(self):
+        """
+        Returns the next [song name, song url, track] and starts prefetching the ones after it.
+        The track is None if it couldn't be loaded.
+        """
+        if not self.__upcoming:  # Nothing prefetched yet (first song, or prefetching is off)
+            self.__start()
+
+        name, url, thread, result = self.__upcoming.popleft()
+
+        while len(self.__upcoming) < self.__depth:  # Top the lookahead back up before waiting on this one
+            self.__start()
+
+        thread.join()
+        return name, url, result[0]
+
+    def close(self):
+        """
+        Drops every prefetched track
+        """
+        while self.__upcoming:
+            name, url, thread, result = self.__upcoming.popleft()
+            thread.join()
+            if result[0]:
+                result[0].close()
+
+
+class AudioCache(object):
+    def __init__(self, directory, max_bytes, kind='mp3'):
+        """
+        On-disk cache of songs keyed by their URL, evicting the least recently played ones once
+        it grows past max_bytes. Holds either the original mp3s or the decoded audio as wav files.
+
+        Args:
+            directory (str): Folder to keep the cached songs in; created if it doesn't exist
+            max_bytes (int): The most the cached songs may take up on disk
+            kind (str): 'mp3' to keep the downloads, 'pcm' to keep the decoded audio (skips ffmpeg on a hit)
+        """
+        assert kind in ('mp3', 'pcm')
+
+        self.__directory = directory
+        self.__max_bytes = max_bytes
+        self.__kind = kind
+        self.__extension = kind == 'mp3' and '.mp3' or '.wav'
+        self.__lock = threading.Lock()
+        self.__entries = collections.OrderedDict()  # path -> size, least recently used first
+        self.__size = 0  # Total size of the entries
+        self.hits = 0  # Lookups that found the song on disk
+        self.misses = 0  # Lookups that had to go to the website
+        self.evictions = 0  # Songs deleted to stay under max_bytes
+
+        os.makedirs(directory, exist_ok=True)
+
+        cached = []  # Pick up whatever previous sessions left behind, oldest first
+        for file_name in os.listdir(directory):
+            path = os.path.join(directory, file_name)
+            if file_name.endswith('.part'):  # Leftover from a crash mid-download
+                self.__remove(path)
+            elif file_name.endswith(self.__extension):
+                stat = os.stat(path)
+                cached.append((stat.st_mtime, path, stat.st_size))
+
+        for mtime, path, size in sorted(cached):
+            self.__entries[path] = size
+            self.__size += size
+
+        with self.__lock:
+            self.__evict()
+
+    @property
+    def kind(self):  # 'mp3' or 'pcm'
+        return self.__kind
+
+    @property
+    def stats(self):
+        """
+        Hit/miss counters and disk usage, for display
+        """
+        with self.__lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'files': len(self.__entries), 'bytes': self.__size}
+
+    def __path(self, url):
+        return os.path.join(self.__directory, hashlib.sha1(url.encode('utf-8')).hexdigest() + self.__extension)
+
+    @staticmethod
+    def __remove(path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:  # Windows won't delete a song that's still being played
+            return False
+
+    def __evict(self):
+        """
+        Deletes least recently used songs until the cache fits in max_bytes. Call with the lock held.
+        """
+        for path in list(self.__entries):
+            if self.__size <= self.__max_bytes:
+                break
+            if self.__remove(path):
+                self.__size -= self.__entries.pop(path)
+                self.evictions += 1
+
+    def lookup(self, url):
+        """
+        Returns the path of the cached song for 'url', or None if it isn't cached
+
+        Args:
+            url (str): URL of the song
+        """
+        path = self.__path(url)
+
+        with self.__lock:
+            if path in self.__entries and os.path.exists(path):
+                self.__entries.move_to_end(path)  # Just played, so it's the last to be evicted
+                self.hits += 1
+            else:
+                self.__size -= self.__entries.pop(path, 0)  # Deleted from outside the client
+                self.misses += 1
+                return None
+
+        try:
+            os.utime(path)  # Keeps the LRU order across sessions
+        except OSError:
+            pass
+        return path
+
+    def reserve(self, url):
+        """
+        Returns a temporary path to write the song for 'url' to; hand it to commit() or discard() after
+
+        Args:
+            url (str): URL of the song
+        """
+        return '%s.%d.part' % (self.__path(url), threading.get_ident())
+
+    def commit(self, url, temp_path):
+        """
+        Moves a fully written song into the cache and evicts old songs if needed
+
+        Args:
+            url (str): URL of the song
+            temp_path (str): Path given by reserve()
+        """
+        path = self.__path(url)
+
+        with self.__lock:
+            try:
+                os.replace(temp_path, path)
+            except OSError:  # Same song already cached and in use (Windows); keep the old copy
+                self.__remove(temp_path)
+                return
+
+            self.__size -= self.__entries.pop(path, 0)
+            self.__entries[path] = os.path.getsize(path)
+            self.__size += self.__entries[path]
+            self.__evict()
+
+    def discard(self, temp_path):
+        """
+        Throws away a partially written song
+
+        Args:
+            temp_path (str): Path given by reserve()
+        """
+        self.__remove(temp_path)
+
+    def tee(self, url, chunks):
+        """
+        Passes the mp3 chunks through unchanged while writing them to the cache; the song is only
+        cached if every chunk made it through.
+
+        Args:
+            url (str): URL of the song
+            chunks (iterable): Pieces of the mp3 as they arrive
+        """
+        temp_path = self.reserve(url)
+        complete = False
+
+        try:
+            with open(temp_path, 'wb') as temp:
+                for chunk in chunks:
+                    temp.write(chunk)
+                    yield chunk
+            complete = True
+        finally:
+            if complete:
+                self.commit(url, temp_path)
+            else:  # Skipped or the download broke; don't keep half a song
+                self.discard(temp_path)
+
+    def record(self, url, decoder):
+        """
+        Wraps a decoder so the audio read from it is written to the cache as a wav file
+
+        Args:
+            url (str): URL of the song
+            decoder (object): A StreamingDecoder / wave.Wave_read to record
+        """
+        return _CacheRecorder(self, url, decoder)
+
+
+class _CacheRecorder(object):
+    def __init__(self, cache, url, decoder):
+        """
+        Reads like the decoder it wraps, copying everything read into a wav file in the cache.
+        See AudioCache.record().
+        """
+        self.__cache = cache
+        self.__url = url
+        self.__decoder = decoder
+        self.__temp_path = cache.reserve(url)
+        self.__done = False  # True once the recording has been committed or discarded
+
+        self.__wav = wave.open(self.__temp_path, 'wb')
+        self.__wav.setnchannels(decoder.getnchannels())
+        self.__wav.setsampwidth(1)  # ffmpeg gives us unsigned 8-bit samples
+        self.__wav.setframerate(decoder.getframerate())
+
+    def readframes(self, n):
+        data = self.__decoder.readframes(n)
+        if not self.__done:
+            self.__wav.writeframes(data)
+            if len(data) < n * self.__decoder.getnchannels():  # End of the song
+                self.__finish()
+        return data
+
+    def __finish(self):
+        self.__done = True
+        self.__wav.close()
+        if getattr(self.__decoder, 'complete', True):  # Only cache songs that decoded all the way through
+            self.__cache.commit(self.__url, self.__temp_path)
+        else:
+            self.__cache.discard(self.__temp_path)
+
+    def getframerate(self):
+        return self.__decoder.getframerate()
+
+    def getnchannels(self):
+        return self.__decoder.getnchannels()
+
+    def tell(self):
+        return self.__decoder.tell()
+
+    def getnframes(self):
+        return self.__decoder.getnframes()
+
+    def close(self):
+        if not self.__done:  # Skipped before the end; don't keep half a song
+            self.__done = True
+            self.__wav.close()
+            self.__cache.discard(self.__temp_path)
+        self.__decoder.close()
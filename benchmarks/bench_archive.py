@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark for the chat archive: write throughput and /search time.
+
+Archives a lot of synthetic messages through archive.ChatArchive (in the
+batches of new messages the chat poller would hand it, 20 at a time), then
+times a few searches against it.
+
+    python3 benchmarks/bench_archive.py [--messages N] [--database PATH]
+
+The database is deleted afterwards unless --database is given.
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))  # Import from the repo root
+
+import archive  # noqa: E402
+import chat  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=1000000, help='messages to archive (default 1000000)')
+    parser.add_argument('--database', help='archive file to use (default: a temporary one)')
+    args = parser.parse_args()
+
+    directory = None
+    path = args.database
+    if path is None:
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'chat.db')
+
+    words = 'jet set radio live tokyo-to rudie graffiti soul funk beat gum corn yoyo combo'.split()
+    words += ['word%d' % i for i in range(5000)]  # A long tail of rarer words, like real chat
+
+    chat_archive = archive.ChatArchive(path)
+    start = time.perf_counter()
+    batch = []
+    for i in range(args.messages):
+        text = ' '.join(random.choice(words) for _ in range(random.randint(1, 30)))
+        user = 'user%d' % (i % 500)
+        batch.append(chat.ChatMessage(user, text, 'default', chat.ChatIngester.fingerprint(user, '%d %s' % (i, text))))
+        if len(batch) == 20:
+            chat_archive.add(batch)
+            batch = []
+    chat_archive.add(batch)
+    queued = time.perf_counter() - start
+    chat_archive.close()
+    written = time.perf_counter() - start
+
+    print('archived:  %d messages' % chat_archive.written)
+    print('add():     %.2f us/message on the polling thread' % (queued / args.messages * 1e6))
+    print('written:   %.1f s total, %d messages/s' % (written, chat_archive.written / written))
+
+    chat_archive = archive.ChatArchive(path)
+    for terms in ('graffiti', 'word4242', 'jet set', 'user42 soul', 'tok', 'nothingmatchesthis'):
+        start = time.perf_counter()
+        found = chat_archive.search(terms)
+        took = (time.perf_counter() - start) * 1000
+        print('search:    %-20s %3d results in %.2f ms' % (repr(terms), len(found), took))
+    chat_archive.close()
+
+    if directory is not None:
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark for chat ingestion: parse time per poll of messages.xml.
+
+Replays a sliding window over a large messages.xml, a few new messages per
+poll, through chat.ChatIngester and (if bs4 is installed) the old
+BeautifulSoup full re-parse.
+
+    python3 benchmarks/bench_chat.py [recorded messages.xml] [--window N] [--polls N] [--new N]
+
+Without a recording, a synthetic one is generated in the same format.
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))  # Import from the repo root
+
+import chat  # noqa: E402
+
+
+def synthetic_messages(count):
+    """
+    Makes up 'count' raw (username, text) pairs shaped like the real feed
+
+    Args:
+        count (int): Amount of messages to make
+    """
+    words = 'jet set radio live tokyo-to rudie graffiti soul funk beat gum corn yoyo combo'.split()
+    users = ['user%d' % i for i in range(40)] + ['<font color="#00FFFF">reg%d</font>' % i for i in range(10)]
+    users.append('DJProfessorK')
+    return [(random.choice(users), ' '.join(random.choice(words) for _ in range(random.randint(1, 30))))
+            for _ in range(count)]
+
+
+def build_document(messages):
+    """
+    Builds a messages.xml document out of raw (username, text) pairs
+
+    Args:
+        messages (list): Raw (username, text) pairs, oldest first
+    """
+    body = ''.join('<message><username><![CDATA[%s]]></username><text><![CDATA[%s]]></text></message>\n' % message
+                   for message in messages)
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n<messages>\n%s</messages>\n' % body).encode('utf-8')
+
+
+def legacy_parse(data):
+    """
+    What chat_thread used to do on every poll: BeautifulSoup over the whole document plus the
+    tag-stripping regexes for every message
+    """
+    import bs4
+
+    bs = bs4.BeautifulSoup(data, 'html.parser')
+    for message in bs.findAll('message'):
+        re.sub('<[^<]+?>', '', message.find('username').get_text())
+        re.sub('<[^<]+?>', '', message.find('text').get_text())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('recording', nargs='?', help='recorded messages.xml to replay')
+    parser.add_argument('--window', type=int, default=2000, help='messages per poll (default 2000)')
+    parser.add_argument('--polls', type=int, default=50, help='polls to replay (default 50)')
+    parser.add_argument('--new', type=int, default=2, help='new messages per poll (default 2)')
+    args = parser.parse_args()
+
+    if args.recording:
+        with open(args.recording, 'rb') as recording:
+            messages = chat.parse_messages(recording.read())
+        args.window = min(args.window, max(1, len(messages) - args.new * args.polls))
+    else:
+        messages = synthetic_messages(args.window + args.new * args.polls)
+
+    documents = [build_document(messages[poll * args.new:poll * args.new + args.window])
+                 for poll in range(args.polls)]
+
+    ingester = chat.ChatIngester()
+    ingester.ingest(documents[0])  # The first poll is always a full parse; measure the steady state after it
+
+    start = time.perf_counter()
+    new_count = sum(len(ingester.ingest(document)) for document in documents[1:])
+    ingest_time = (time.perf_counter() - start) / (len(documents) - 1)
+
+    print('window:   %d messages, %d KB per poll' % (args.window, len(documents[-1]) // 1024))
+    print('ingester: %.2f ms/poll (%d new messages)' % (ingest_time * 1000, new_count))
+
+    try:
+        import bs4  # noqa: F401
+    except ImportError:
+        print('legacy:   skipped (bs4 not installed)')
+        return
+
+    start = time.perf_counter()
+    for document in documents[1:]:
+        legacy_parse(document)
+    legacy_time = (time.perf_counter() - start) / (len(documents) - 1)
+    print('legacy:   %.2f ms/poll' % (legacy_time * 1000))
+    print('speedup:  %.1fx' % (legacy_time / ingest_time))
+
+
+if __name__ == '__main__':
+    main()
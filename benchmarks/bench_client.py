@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+
+"""
+End-to-end benchmark of the client against the local mock site.
+
+Starts benchmarks/mock_server.py, points the client at it (JSRL_BASE_URL)
+and runs the client's core (client.Client: the pollers, chat ingestion, the
+outbox) for --duration seconds, along with chat panel layout and streaming +
+converting a song like the audio thread does. Then it reports,
+as JSON:
+
+    cpu_seconds / cpu_percent   per component (network loop, http workers,
+                                layout, audio thread, ffmpeg)
+    poll_latency_ms             p50/p95 per endpoint
+    parse                       chat parse throughput and time per poll
+    render                      chat panel layout time and estimated bytes per frame
+    time_to_first_audio_s       from the start of the run to the first decoded audio
+    send                        outgoing chat messages and POST latency
+
+    python3 benchmarks/bench_client.py [--duration 20] [--chat-rate 5] [--output FILE] [--compare OLD.json]
+
+--compare prints how every number moved against an earlier run and exits
+with status 1 if a cost grew by more than --threshold percent. Compare runs
+with the same parameters; short runs are noisy.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)  # Import from the repo root
+
+MIN_SAMPLES = 10  # Latencies measured fewer times than this are too noisy to call regressions
+
+
+def start_mock_site(args, quiet=False):
+    """
+    Runs the mock site in a process of its own (so its CPU time isn't counted as the client's)
+
+    Args:
+        args (argparse.Namespace): chat_rate, window, songs and seed for the mock site
+        quiet (bool): Throw away what it writes to stderr (e.g. clients hanging up halfway through a response)
+
+    Returns:
+        tuple: (the process, its base URL)
+    """
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, 'benchmarks', 'mock_server.py'), '--port', '0',
+                                '--chat-rate', str(args.chat_rate), '--window', str(args.window),
+                                '--songs', str(args.songs), '--seed', str(args.seed)],
+                               stdout=subprocess.PIPE, stderr=quiet and subprocess.DEVNULL or None,
+                               universal_newlines=True)
+    return process, process.stdout.readline().strip()
+
+
+def thread_cpu(thread):
+    """
+    Returns the CPU seconds a running thread has used, or None where that can't be read
+    """
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(thread.ident))
+    except (AttributeError, OSError, TypeError):
+        return None
+
+
+def histogram(metrics, name):
+    return metrics.histogram(name).snapshot()
+
+
+def run(args):
+    import audio
+    import chat
+    import client
+    import metrics
+    import net
+    import state
+    import tracks
+
+    registry = metrics.registry
+    registry.enabled = True
+    started = time.monotonic()
+    stop = threading.Event()
+    results = {}
+    exited = {}  # Thread -> CPU seconds it used, for the ones that finish early
+
+    http = net.HttpClient()
+    client_state = state.ClientState()
+    core = client.Client(client_state, http)  # The same pollers and outbox the client runs
+    outbox = core.outbox
+
+    async def sender():
+        for number in range(args.sends):
+            core.send('benchmark message %d' % number, 'bench')
+            await asyncio.sleep(args.duration / max(1, args.sends))
+
+    core.subscribe(lambda event: event['type'] == 'chat' and client_state.notify())  # Ask for a frame
+
+    # Layout: builds the chat panel every time the state changes, like the input loop's frames
+    frame_wanted = threading.Event()
+    client_state.subscribe(frame_wanted.set)
+    frame_bytes = []
+
+    def layout():
+        try:
+            import render
+        except ImportError:  # No curses here; the layout's measured without the byte estimate
+            render = None
+
+        wrapped_lines = chat.LineCache(2000)
+
+        def build_lines(message, width):
+            return chat.wrap_text(message.user + ': ' + message.text, width)[::-1]
+
+        def wrap(message):
+            return wrapped_lines.get(message, 58, build_lines)
+
+        view = chat.ChatView(core.chat.history, wrap, 13)
+        rows = []
+        while not stop.is_set():
+            if not frame_wanted.wait(0.1):
+                continue
+            frame_wanted.clear()
+            with registry.timer('layout.frame'):
+                new_rows = view.lines()
+                if render is not None:
+                    frame_bytes.append(render.estimate_output(rows, new_rows))
+            rows = new_rows
+
+    # Audio: fetch the tracklist, stream the first song through ffmpeg and convert it like the callback does
+    def play():
+        try:
+            stream()
+        finally:
+            exited['audio'] = time.thread_time()  # It's usually done (decoding's faster than playing) before the end
+
+    def stream():
+        cache = tracks.TracklistCache(os.path.join(tempfile.mkdtemp(), 'tracklist.json'))
+        loop = asyncio.new_event_loop()
+        try:
+            songs = loop.run_until_complete(cache.refresh(http))
+        finally:
+            loop.close()
+        name, url = songs[0]
+
+        decoder = client.AudioEngine(http, client_state, lambda: songs).stream_mp3(url)  # No sound card needed
+        if decoder is None:
+            results['audio_error'] = 'could not stream %s (is ffmpeg installed?)' % url
+            return
+
+        first = True
+        try:
+            while not stop.is_set():
+                with registry.timer('audio.decode'):
+                    data = decoder.readframes(4096)
+                if not data:
+                    break
+                if first:
+                    results['time_to_first_audio_s'] = round(time.monotonic() - started, 3)
+                    first = False
+                with registry.timer('audio.convert'):
+                    audio.convert_samples(data, 5)
+        finally:
+            decoder.close()
+
+    threads = {
+        'network': core.start(sender()),
+        'layout': threading.Thread(target=layout, name='layout', daemon=True),
+        'audio': threading.Thread(target=play, name='audio', daemon=True),
+    }
+    for name, thread in threads.items():
+        if name != 'network':
+            thread.start()
+
+    time.sleep(args.duration)
+
+    # CPU is read while the threads are still alive
+    cpu = {name: thread_cpu(thread) if thread.is_alive() else exited.get(name) for name, thread in threads.items()}
+    cpu['http'] = sum(thread_cpu(thread) or 0 for thread in threading.enumerate() if thread.name.startswith('http'))
+    stop.set()
+    core.stop()
+    for thread in threads.values():
+        thread.join(10)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)  # The mock site hasn't been reaped yet, so only ffmpeg
+    cpu['ffmpeg'] = children.ru_utime + children.ru_stime
+    times = os.times()
+    cpu['process'] = times.user + times.system
+
+    # Parse throughput, away from the network: the current window, parsed from scratch over and over
+    document = http.request('GET', net.CHAT_URL).content
+    count = len(chat.parse_messages(document))
+    parse_start = time.perf_counter()
+    for _ in range(args.parse_rounds):
+        chat.ChatIngester().ingest(document)
+    parse_time = time.perf_counter() - parse_start
+    http.close()
+
+    polls = {name: histogram(registry, 'http.' + url) for name, url in
+             (('chat', net.CHAT_URL), ('listeners', net.LISTENERS_URL), ('broadcast', net.BROADCAST_URL))}
+    results.update({
+        'cpu_seconds': {name: None if seconds is None else round(seconds, 3) for name, seconds in cpu.items()},
+        'cpu_percent': {name: None if seconds is None else round(seconds / args.duration * 100, 2)
+                        for name, seconds in cpu.items()},
+        'poll_latency_ms': {name: {'p50': poll['p50_ms'], 'p95': poll['p95_ms'], 'count': poll['count']}
+                            for name, poll in polls.items()},
+        'polling': {name: schedule.stats for name, schedule in core.poll_schedules.items()},
+        'parse': {
+            'messages_per_second': round(count * args.parse_rounds / parse_time),
+            'full_parse_ms': round(parse_time / args.parse_rounds * 1000, 3),
+            'poll_ms': histogram(registry, 'chat.parse'),
+            'messages_ingested': registry.counter('chat.messages').value,
+        },
+        'render': {
+            'frames': histogram(registry, 'layout.frame')['count'],
+            'layout_ms': histogram(registry, 'layout.frame'),
+            'bytes_per_frame': frame_bytes and round(sum(frame_bytes) / len(frame_bytes), 1) or None,
+        },
+        'audio': {'decode_ms': histogram(registry, 'audio.decode'), 'convert_ms': histogram(registry, 'audio.convert')},
+        'send': {'sent': outbox.sent, 'failed': outbox.failed, 'post_ms': histogram(registry, 'http.' + net.SEND_URL)},
+    })
+    results.setdefault('time_to_first_audio_s', None)
+    return results
+
+
+def flatten(results, prefix=''):
+    """
+    Turns nested results into {'a.b.c': number}
+    """
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(old, new, threshold):
+    """
+    Prints how every number moved since an earlier run
+
+    Returns:
+        list: The names of the costs that grew by more than 'threshold' percent
+    """
+    higher_is_better = ('messages_per_second', 'sent', 'frames', 'count', 'messages_ingested', 'hit_rate')
+    old, new = flatten(old['results']), flatten(new['results'])
+    regressions = []
+    for name in sorted(set(old) & set(new)):
+        if not old[name]:
+            continue
+        change = (new[name] - old[name]) / old[name] * 100
+        worse = -change if name.endswith(higher_is_better) else change
+        cost = name.startswith(('cpu_', 'poll_latency_ms', 'parse.', 'render.layout', 'audio.', 'send.post',
+                                'time_to_first_audio'))
+        cost = cost and not name.endswith(('.count', '.max_ms'))  # One slow outlier isn't a regression
+        samples = new.get(name.rpartition('.')[0] + '.count', MIN_SAMPLES)
+        flag = ''
+        if cost and samples >= MIN_SAMPLES and worse > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print('%-45s %12.3f -> %12.3f  %+7.1f%%%s' % (name, old[name], new[name], change, flag), file=sys.stderr)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--duration', type=float, default=20, help='seconds to run the client for (default 20)')
+    parser.add_argument('--chat-rate', type=float, default=5, help='chat messages per second (default 5)')
+    parser.add_argument('--window', type=int, default=100, help='messages in messages.xml (default 100)')
+    parser.add_argument('--songs', type=int, default=1000, help='synthetic songs in the tracklist (default 1000)')
+    parser.add_argument('--sends', type=int, default=10, help='chat messages to send during the run (default 10)')
+    parser.add_argument('--parse-rounds', type=int, default=200, help='full parses for the throughput number')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results here as well as to stdout')
+    parser.add_argument('--compare', metavar='OLD', help='results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=20, help='percent a cost may grow by (default 20)')
+    args = parser.parse_args()
+
+    mock_site, base_url = start_mock_site(args)
+    os.environ['JSRL_BASE_URL'] = base_url  # Read when net is imported
+    try:
+        results = run(args)
+    finally:
+        mock_site.terminate()
+        mock_site.wait()
+
+    report = {
+        'benchmark': 'client',
+        'format': 1,
+        'time': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': {name: value for name, value in vars(args).items() if name not in ('output', 'compare')},
+        'results': results,
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(text + '\n')
+
+    if args.compare:
+        with open(args.compare, 'r') as old:
+            if compare(json.load(old), report, args.threshold):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
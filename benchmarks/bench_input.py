@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark for typing into the chat box: keystroke-to-screen latency under paste bursts.
+
+A thread writes synthetic pastes (--paste characters and ENTER, every
+--interval seconds) into a pipe that stands in for the terminal. The input
+loop is main.py's: it waits on the pipe with select(), hands everything
+that's there to a stand-in curses window (like curses reading ahead), takes
+the keys with main.get_keys(), applies them with main.apply_keys() to a
+main.TextInput and draws the text box with TextInput.write(), once per
+batch. ENTER empties the text box, like sending the message does.
+
+Latency is measured from a paste being written to the frame drawn after
+the batch its ENTER was in. Every frame's row is also written to /dev/null.
+
+    python3 benchmarks/bench_input.py [--paste 76] [--bursts 200] [--interval 0.02] [--budget 5]
+
+Exits with status 1 if the 95th percentile latency is over --budget
+milliseconds, or a paste takes more than one frame. Needs what main.py
+does (unicurses), but no terminal.
+"""
+
+import argparse
+import collections
+import os
+import select
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))  # Import from the repo root
+
+import main as ui  # noqa: E402
+
+
+class Window(object):
+    def __init__(self, columns=80):
+        """
+        Stands in for the curses window main.py reads keys from and draws the text box on: keys come from
+        a queue, and what's drawn goes into one row
+        """
+        self.keys = collections.deque()  # Typed but not read yet
+        self.columns = columns
+        self.row = [' '] * columns
+
+    def get_wch(self):
+        if not self.keys:  # What curses does with no key waiting, in nodelay mode
+            raise ui.curses_error('no input')
+        return self.keys.popleft()
+
+    def nodelay(self, flag):
+        pass
+
+    def addstr(self, y, x, text, attr=0):
+        self.addnstr(y, x, text, len(text), attr)
+
+    def addnstr(self, y, x, text, n, attr=0):
+        text = text[:max(0, min(n, self.columns - x))]
+        self.row[x:x + len(text)] = text
+
+
+class Screen(object):
+    def __init__(self, window):
+        self.window = window
+        self.null = os.open(os.devnull, os.O_WRONLY)
+        self.frames = 0
+
+    def draw(self, text_input):
+        """
+        One frame of the text box, drawn by TextInput.write() and written out like curses would
+        """
+        self.window.row = [' '] * self.window.columns
+        ui.write('|> ', 0, 0, window=self.window)
+        text_input.write(3, 0, active=True, window=self.window)
+        os.write(self.null, ''.join(self.window.row).encode('utf-8'))
+        self.frames += 1
+
+
+def typist(write_fd, args, sent):
+    """
+    Writes the pastes into the pipe, noting when each one went in
+    """
+    text = ('jet set radio live, funky radio, tokyo-to ' * (args.paste // 40 + 1))[:args.paste]
+    for _ in range(args.bursts):
+        sent.append(time.perf_counter())
+        os.write(write_fd, (text + '\n').encode('utf-8'))  # A paste, then ENTER to send it
+        time.sleep(args.interval)
+    os.close(write_fd)
+
+
+def input_loop(read_fd, limit, sent):
+    """
+    Reads keys like main.py's input loop until the pipe closes
+
+    Returns:
+        tuple: (seconds from each paste to the frame after its ENTER, the Screen)
+    """
+    window = Window()
+    ui.stdscr = window  # What get_keys() reads from
+    screen = Screen(window)
+    box = ui.TextInput(limit)
+    entered = []  # Pastes whose ENTER was handled, but aren't on screen yet
+
+    def handle_key(key):
+        if key == 'KEY_ENTER':  # Sent: the text box empties
+            entered.append(len(latencies) + len(entered))
+            box.value = ''
+
+    latencies = []
+    pending = b''
+    while True:
+        select.select([read_fd], [], [])
+        data = os.read(read_fd, 65536)  # Everything waiting, like curses reading ahead
+        if not data:
+            return latencies, screen
+        pending += data
+        try:
+            window.keys.extend(pending.decode('utf-8'))
+            pending = b''
+        except UnicodeDecodeError:  # Cut in the middle of a character; wait for the rest
+            continue
+
+        keys = ui.get_keys()
+        if keys:
+            ui.apply_keys(keys, box, handle_key)
+            screen.draw(box)
+            drawn = time.perf_counter()
+            latencies.extend(drawn - sent[paste] for paste in entered)
+            entered.clear()
+
+
+def run(args):
+    read_fd, write_fd = os.pipe()
+    sent = []
+    thread = threading.Thread(target=typist, args=(write_fd, args, sent))
+    thread.start()
+    latencies, screen = input_loop(read_fd, args.limit, sent)
+    thread.join()
+    os.close(read_fd)
+
+    latencies.sort()
+    return {
+        'p50_ms': latencies[len(latencies) // 2] * 1000,
+        'p95_ms': latencies[int(len(latencies) * 0.95)] * 1000,
+        'max_ms': latencies[-1] * 1000,
+        'frames_per_burst': screen.frames / max(1, len(latencies)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--paste', type=int, default=76, help='characters per paste (default 76, a full chat box)')
+    parser.add_argument('--bursts', type=int, default=200, help='pastes to send (default 200)')
+    parser.add_argument('--interval', type=float, default=0.02, help='seconds between pastes (default 0.02)')
+    parser.add_argument('--limit', type=int, default=0, help='text box character limit (default 0 = none)')
+    parser.add_argument('--budget', type=float, default=5, help='milliseconds a paste may take to get on screen, '
+                                                                '95th percentile (default 5)')
+    args = parser.parse_args()
+
+    print('%d pastes of %d characters, one every %gs' % (args.bursts, args.paste, args.interval))
+    result = run(args)
+    print('latency p50 %.3fms p95 %.3fms max %.3fms, %.1f frames per paste' % (
+        result['p50_ms'], result['p95_ms'], result['max_ms'], result['frames_per_burst']))
+
+    if result['p95_ms'] > args.budget:
+        print('FAIL: p95 latency %.3fms is over the %gms budget' % (result['p95_ms'], args.budget))
+        sys.exit(1)
+    if result['frames_per_burst'] > 1:
+        print('FAIL: %.1f frames per paste; a batch of keys should be drawn once' % result['frames_per_burst'])
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
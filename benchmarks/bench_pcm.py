@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+"""
+Micro-benchmark for the sample conversion done in play_song.
+
+Compares the old struct/lambda conversion against audio.convert_samples and
+reports samples/sec for both. Run from anywhere: python3 benchmarks/bench_pcm.py
+"""
+
+import os
+import random
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))  # Import from the repo root
+
+import audio  # noqa: E402
+
+
+def legacy_convert_samples(data, volume):
+    """
+    The conversion play_song used before audio.convert_samples, kept here as the baseline
+
+    Args:
+        data (bytes): Raw data read from the wav
+        volume (int): The volume to play music at; goes from 0 to 9
+    """
+    return struct.pack('f' * (len(data) // 2), *list(map(lambda b: b / 65535 * (volume / 9),
+                       struct.unpack('H' * (len(data) // 2), data))))
+
+
+def bench(convert, data, seconds):
+    """
+    Runs 'convert' over 'data' repeatedly for roughly 'seconds' and returns samples/sec
+
+    Args:
+        convert (function): Conversion function to measure
+        data (bytes): Buffer to convert every iteration
+        seconds (float): How long to keep converting for
+    """
+    runs = 0
+    start = time.perf_counter()
+    while True:
+        convert(data, 5)
+        runs += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return runs * (len(data) // 2) / elapsed
+
+
+def main():
+    buffer_frames = int(sys.argv[1]) if len(sys.argv) > 1 else 2048  # Same size as a default PyAudio buffer
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 2.0
+
+    data = bytes(random.getrandbits(8) for _ in range(buffer_frames * 2))
+
+    # Both paths have to agree before their speed means anything (NumPy rounds in Float32, hence the tolerance)
+    new_samples = struct.unpack('f' * buffer_frames, audio.convert_samples(data, 5))
+    old_samples = struct.unpack('f' * buffer_frames, legacy_convert_samples(data, 5))
+    assert max(abs(a - b) for a, b in zip(new_samples, old_samples)) < 1e-6
+
+    before = bench(legacy_convert_samples, data, seconds)
+    after = bench(audio.convert_samples, data, seconds)
+
+    print('backend: %s' % (audio.numpy is not None and 'numpy' or 'array'))
+    print('buffer:  %d samples' % buffer_frames)
+    print('before:  %.0f samples/sec' % before)
+    print('after:   %.0f samples/sec' % after)
+    print('speedup: %.1fx' % (after / before))
+
+
+if __name__ == '__main__':
+    main()
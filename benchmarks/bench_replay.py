@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+"""
+Throughput benchmark for chat ingestion and layout, replaying recorded traffic.
+
+Replays a capture log (made with main.py --record) as fast as possible
+through the client's core (client.Client on a capture.ReplayHttpClient),
+laying out the chat panel after every batch of new messages like the chat
+window does, --runs times over. Without a log, one is recorded first from
+benchmarks/mock_server.py: --record-seconds of a chat moving at --chat-rate
+messages a second.
+
+    python3 benchmarks/bench_replay.py [LOG] [--runs 3] [--record-seconds 20] [--chat-rate 20]
+
+Exits with status 1 if the runs didn't all end up with the same messages,
+in the same order (the replay isn't deterministic).
+"""
+
+import argparse
+import hashlib
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)  # Import from the repo root
+
+
+def record(args, path):
+    """
+    Records --record-seconds of the mock site into a capture log at 'path'
+    """
+    from bench_client import start_mock_site
+
+    process, base_url = start_mock_site(args)
+    os.environ['JSRL_BASE_URL'] = base_url  # Read by net when it's first imported
+    try:
+        import capture
+        import client
+        import net
+
+        recorder = capture.Recorder(path)
+        http = net.HttpClient(recorder=recorder)
+        core = client.Client(http=http)
+        thread = core.start()
+        time.sleep(args.record_seconds)
+        core.stop()
+        thread.join()
+        recorder.close()
+        http.close()
+        print('recorded: %d responses over %ds, %d KB' % (recorder.records, args.record_seconds,
+                                                         os.path.getsize(path) // 1024))
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def percentiles(samples):
+    samples = sorted(samples) or [0]
+    return samples[len(samples) // 2] * 1000, samples[int(len(samples) * 0.95)] * 1000
+
+
+def replay(path, width, height):
+    """
+    Replays the log once, as fast as possible
+
+    Returns:
+        tuple: (a line of results, digest of every message ingested in order)
+    """
+    import capture
+    import chat
+    import client
+
+    http = capture.ReplayHttpClient(path, 0)
+    core = client.Client(http=http, chat_poll_intervals=(0, 0), listener_poll_intervals=(0, 0),
+                         broadcast_poll_intervals=(0, 0))
+    http.on_finished = core.stop
+
+    cache = chat.LineCache(2000)
+
+    def build_lines(message, columns):
+        return chat.wrap_text(message.user + ': ' + message.text, columns)[::-1]
+
+    view = chat.ChatView(core.chat.history, lambda message: cache.get(message, width, build_lines), height)
+    digest = hashlib.sha1()
+    layout_times = []
+    counts = {'messages': 0}
+
+    def on_event(event):
+        if event['type'] != 'chat':
+            return
+        for message in event['messages']:
+            digest.update(message.fingerprint)
+        counts['messages'] += len(event['messages'])
+        start = time.perf_counter()
+        view.lines()  # What the chat window does with every batch (on this same thread)
+        layout_times.append(time.perf_counter() - start)
+
+    core.subscribe(on_event)
+    start, cpu = time.perf_counter(), time.process_time()
+    core.start().join()
+    elapsed, cpu = time.perf_counter() - start, time.process_time() - cpu
+
+    line = '%6.3fs wall %6.3fs CPU  %d responses  %d messages (%.0f/s)  layout p50/p95 %.3f/%.3fms' % (
+        elapsed, cpu, http.replayed, counts['messages'], counts['messages'] / max(elapsed, 0.000001),
+        *percentiles(layout_times))
+    return line, digest.hexdigest()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('log', nargs='?', help='capture log to replay (default: record one from the mock site)')
+    parser.add_argument('--runs', type=int, default=3, help='times to replay it (default 3)')
+    parser.add_argument('--columns', type=int, default=80, help='terminal width to lay the chat out for')
+    parser.add_argument('--rows', type=int, default=24, help='terminal height to lay the chat out for')
+    parser.add_argument('--record-seconds', type=int, default=20, help='seconds to record without a log (default 20)')
+    parser.add_argument('--chat-rate', type=float, default=20, help='mock chat messages per second (default 20)')
+    parser.add_argument('--window', type=int, default=100, help='messages per mock messages.xml (default 100)')
+    args = parser.parse_args()
+    args.songs, args.seed = 0, 1  # For the mock site
+
+    path = args.log
+    if path is None:
+        path = os.path.join(tempfile.mkdtemp(prefix='bench_replay_'), 'capture.jsonl.gz')
+        record(args, path)
+
+    import metrics
+    metrics.registry.enabled = True  # Parse times, for the summary
+
+    digests = set()
+    for run in range(args.runs):
+        line, digest = replay(path, args.columns - 22, args.rows - 11)
+        digests.add(digest)
+        print('run %d: %s' % (run + 1, line))
+
+    parse = metrics.registry.histogram('chat.parse').snapshot()
+    print('parse:  p50/p95 %.2f/%.2fms over %d polls' % (parse['p50_ms'], parse['p95_ms'], parse['count']))
+    if len(digests) > 1:
+        print('FAIL: the runs ingested different messages')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
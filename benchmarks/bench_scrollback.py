@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark for the chat scrollback: memory and time over a very long session.
+
+Feeds a lot of messages through chat.Scrollback, drawing the chat panel
+(chat.ChatView) every few messages and paging back through it now and then,
+and checks that memory stays flat once the scrollback is full.
+
+    python3 benchmarks/bench_scrollback.py [--messages N] [--capacity N] [--draw-every N]
+
+Exits with status 1 if RSS grew by more than --max-growth MB after the
+scrollback filled up.
+"""
+
+import argparse
+import os
+import random
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))  # Import from the repo root
+
+import chat  # noqa: E402
+
+
+def rss_mb():
+    """
+    Returns the current resident set size in MB (peak RSS where /proc isn't there)
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except (OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024  # Bytes on macOS, KB elsewhere
+
+
+def build_lines(message, width):
+    """
+    Same wrapping as the chat panel: lines of 'width' columns, newest first
+    """
+    chunks = chat.wrap_text(message.user + ': ' + message.text, width)
+    chunks.reverse()
+    lines = [{'user': None, 'msg': chunk} for chunk in chunks]
+    lines[-1]['user'] = [message.user, 0]
+    return lines
+
+
+wrapped_lines = chat.LineCache(2000)
+
+
+def wrap(message):
+    return wrapped_lines.get(message, 58, build_lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=1000000, help='messages to feed (default 1000000)')
+    parser.add_argument('--capacity', type=int, default=5000, help='scrollback size (default 5000)')
+    parser.add_argument('--draw-every', type=int, default=10, help='messages between redraws (default 10)')
+    parser.add_argument('--max-growth', type=float, default=5, help='allowed RSS growth in MB (default 5)')
+    args = parser.parse_args()
+
+    words = 'jet set radio live tokyo-to rudie graffiti soul funk beat gum corn yoyo combo'.split()
+    texts = [' '.join(random.choice(words) for _ in range(random.randint(1, 30))) for _ in range(1000)]
+
+    scrollback = chat.Scrollback(args.capacity)
+    view = chat.ChatView(scrollback, wrap, 13)
+
+    draw_time = 0
+    draws = 0
+    full_rss = None
+    start = time.perf_counter()
+    for i in range(args.messages):
+        scrollback.append(chat.ChatMessage('user%d' % (i % 50), texts[i % len(texts)], 'default', None))
+
+        if i % args.draw_every == 0:
+            draw_start = time.perf_counter()
+            if i % (args.draw_every * 100) == 0:  # Page back a bit now and then, then return to the bottom
+                view.page_up()
+                view.page_up()
+                view.lines()
+                view.page_down()
+                view.page_down()
+            view.lines()
+            draw_time += time.perf_counter() - draw_start
+            draws += 1
+
+        if i + 1 == args.capacity * 2:  # Full, and every slot has been overwritten once
+            full_rss = rss_mb()
+    total_time = time.perf_counter() - start
+    end_rss = rss_mb()
+
+    print('messages:  %d through a %d message scrollback' % (args.messages, args.capacity))
+    print('total:     %.2f s (%.2f us/message including draws)' % (total_time, total_time / args.messages * 1e6))
+    print('draw:      %.1f us/frame over %d frames' % (draw_time / max(1, draws) * 1e6, draws))
+    if full_rss is None:
+        print('rss:       %.1f MB (too few messages to fill the scrollback twice)' % end_rss)
+        return
+
+    growth = end_rss - full_rss
+    print('rss:       %.1f MB once full, %.1f MB at the end (%+.1f MB)' % (full_rss, end_rss, growth))
+    if growth > args.max_growth:
+        print('FAIL: memory kept growing after the scrollback filled up')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
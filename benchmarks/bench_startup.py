@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+
+"""
+Cold start benchmark: how long until the login screen takes input, and until the chat window's up after it.
+
+Starts main.py --startup-report in a fresh interpreter on a pseudo-terminal
+(80x24) against benchmarks/mock_server.py, --runs times over, and for each:
+
+- times how long after the process was started the login screen gets
+  drawn, so the interpreter starting up and the imports are counted
+- waits --typing seconds (someone typing their name), types one and ENTER
+- times how long after ENTER the chat window gets drawn
+- opens /stats and checks the overlay gets drawn (it's drawn while the
+  renderer holds its lock, and shows the renderer's bytes per second)
+- /exit's and reads the report main.py prints: when each step happened
+  and what the client's imports cost
+
+The client's core (requests, asyncio, sqlite3, PyAudio, the tracklist and
+the archive) loads in the background while the login screen's up, so with
+--typing 0 the chat window waits on whatever of it isn't done yet. Also
+times importing main.py against importing it and the client's core, each in
+a fresh interpreter.
+
+The client runs from a copy of the repo in a temporary folder (so the
+archive and tracklist here aren't touched) without any bytecode at first,
+so the first run includes compiling it. The copy has show_render_stats on,
+so every frame of the commands panel reads the bytes per second too.
+
+    python3 benchmarks/bench_startup.py [--runs 5] [--typing 1]
+
+Exits with status 1 if the client crashes or the chat window or /stats
+never comes up (a frame got stuck).
+
+Needs a terminal type curses knows (TERM, xterm-256color if unset) and
+PyAudio: the chat window shows an error instead without it.
+"""
+
+import argparse
+import fcntl
+import os
+import re
+import select
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import termios
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from bench_client import start_mock_site  # noqa: E402
+
+REPORT_LINE = re.compile(r'^\s+(\S.*?)\s+(\d+\.\d+)\s*$')  # '  login screen    0.081' in --startup-report
+
+
+class Terminal(object):
+    def __init__(self, command, env, rows=24, columns=80):
+        """
+        Runs a command on a pseudo-terminal of its own
+
+        Args:
+            command (list): The program and its arguments
+            env (dict): Its environment
+            rows (int): Height of the terminal
+            columns (int): Width of the terminal
+        """
+        self.fd, child = os.openpty()
+        fcntl.ioctl(child, termios.TIOCSWINSZ, struct.pack('HHHH', rows, columns, 0, 0))
+        self.started = time.perf_counter()
+        self.process = subprocess.Popen(command, stdin=child, stdout=child, stderr=child, env=env,
+                                        start_new_session=True)
+        os.close(child)
+        self.output = b''  # Everything it's written so far
+
+    def wait_for(self, *markers, timeout=30):
+        """
+        Reads what the program writes until one of the markers turns up in it
+
+        Returns:
+            tuple: (the marker, time.perf_counter() when it turned up)
+        """
+        searched = len(self.output)
+        deadline = time.perf_counter() + timeout
+        while True:
+            for marker in markers:
+                if marker in self.output[max(0, searched - len(marker)):]:
+                    return marker, time.perf_counter()
+            searched = len(self.output)
+            if not select.select([self.fd], [], [], max(0, deadline - time.perf_counter()))[0]:
+                raise RuntimeError('timed out waiting for %r' % (markers,))
+            self.read()
+
+    def read(self):
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError:  # EIO: the program's gone
+            data = b''
+        self.output += data
+        return data
+
+    def type(self, text):
+        os.write(self.fd, text.encode('utf-8'))
+
+    def close(self, timeout=10):
+        """
+        Reads everything else it writes until it exits
+        """
+        deadline = time.perf_counter() + timeout
+        while select.select([self.fd], [], [], max(0, deadline - time.perf_counter()))[0] and self.read():
+            pass
+        try:
+            self.process.wait(max(0, deadline - time.perf_counter()))
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        os.close(self.fd)
+
+
+def parse_report(output):
+    """
+    Returns the steps and the imports from main.py's --startup-report, each a dict of name -> seconds
+    """
+    steps, imports = {}, {}
+    section = None
+    for line in output.decode('utf-8', 'replace').replace('\r', '').split('\n'):
+        if 'Startup timing' in line:  # After the escape codes curses resets the terminal with
+            section = steps
+        elif line.startswith('Imports'):
+            section = imports
+        elif section is not None:
+            match = REPORT_LINE.match(line)
+            if match:
+                section[match.group(1)] = float(match.group(2))
+    return steps, imports
+
+
+def start(copy, base_url, args):
+    """
+    Starts the client once: to the login screen, logged in, to the chat window, then /exit
+
+    Returns:
+        dict: 'login' and 'chat' (seconds), 'steps' and 'imports' (from the report)
+    """
+    env = dict(os.environ, JSRL_BASE_URL=base_url, TERM=os.environ.get('TERM', 'xterm-256color'))
+    terminal = Terminal([sys.executable, os.path.join(copy, 'main.py'), '--startup-report'], env)
+    try:
+        _, shown = terminal.wait_for(b'username')
+        time.sleep(args.typing)
+        terminal.type('bench\n')
+        entered = time.perf_counter()
+        marker, chat_shown = terminal.wait_for(b'COMMANDS', b'Fatal error')
+        if marker == b'Fatal error':
+            terminal.type('\n')  # Any key exits
+            raise RuntimeError('the client crashed after logging in; see %s' % os.path.join(copy, 'errorlog.txt'))
+        time.sleep(0.2)  # Let it settle before /stats
+        terminal.type('/stats\n')
+        try:
+            terminal.wait_for(b'STATS', timeout=5)
+        except RuntimeError:
+            raise RuntimeError('the /stats overlay never got drawn; the UI thread is stuck')
+        terminal.type('/stats\n/exit\n')
+    finally:
+        terminal.close()
+
+    steps, imports = parse_report(terminal.output)
+    return {'login': shown - terminal.started, 'chat': chat_shown - entered, 'steps': steps, 'imports': imports}
+
+
+def time_import(copy, modules, runs):
+    """
+    Returns the median seconds a fresh interpreter takes to import 'modules' (from the copy) and exit
+    """
+    samples = []
+    for _ in range(runs):
+        began = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'import ' + ', '.join(modules)], cwd=copy, check=True)
+        samples.append(time.perf_counter() - began)
+    return median(samples)
+
+
+def median(samples):
+    samples = sorted(samples)
+    return samples[len(samples) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help='times to start the client (default 5)')
+    parser.add_argument('--typing', type=float, default=1, help='seconds from the login screen to pressing ENTER '
+                                                                '(default 1; 0 = log in straight away)')
+    args = parser.parse_args()
+    args.chat_rate, args.window, args.songs, args.seed = 2, 100, 0, 1  # For the mock site; no songs to download
+
+    copy = os.path.join(tempfile.mkdtemp(prefix='bench_startup_'), 'client')
+    shutil.copytree(ROOT, copy, ignore=shutil.ignore_patterns('.git', 'benchmarks', '__pycache__', 'cache', 'profile',
+                                                              'chat.db*', 'tracklist.json', 'relay.sock', '*.jsonl'))
+    with open(os.path.join(copy, 'main.py'), 'r+') as source:  # Turn show_render_stats on in the copy
+        code = source.read().replace('\nshow_render_stats = False', '\nshow_render_stats = True', 1)
+        source.seek(0)
+        source.write(code)
+    process, base_url = start_mock_site(args, quiet=True)  # /exit hangs up on its polls
+    try:
+        results = []
+        for run in range(args.runs):
+            try:
+                result = start(copy, base_url, args)
+            except RuntimeError as error:
+                print('FAIL: run %d: %s' % (run + 1, error))
+                sys.exit(1)
+            results.append(result)
+            print('run %d: login screen %.3fs, chat window %.3fs after ENTER, client ready %s' % (
+                run + 1, result['login'], result['chat'],
+                'client ready' in result['steps'] and '%.3fs' % result['steps']['client ready'] or '-'))
+    finally:
+        process.terminate()
+        process.wait()
+
+    print('median: login screen %.3fs, chat window %.3fs after ENTER' % (
+        median([result['login'] for result in results]), median([result['chat'] for result in results])))
+    for title, key in (('steps', 'steps'), ('imports (loaded in the background)', 'imports')):
+        names = results[-1][key]
+        if names:
+            print('%s, median seconds:' % title)
+        for name in names:
+            print('  %-24s %8.3f' % (name, median([result[key].get(name, 0) for result in results])))
+
+    print('import main:                  %.3fs' % time_import(copy, ['main'], args.runs))
+    print('import main + client\'s core:  %.3fs' % time_import(copy, ['main', 'client', 'archive', 'capture'],
+                                                               args.runs))
+    shutil.rmtree(os.path.dirname(copy), ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
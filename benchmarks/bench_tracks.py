@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark for the track search index: build time and lookup time.
+
+Builds tracks.TrackIndex over a tracklist (a recorded ~list.js, or a
+synthetic one of --songs names) and times /play style searches against it:
+whole words, prefixes, several words and typos.
+
+Searches have to stay under --budget milliseconds: the average and the 99th
+percentile of each kind, and the slowest search of each kind too. That one
+is timed again (best of 5) first, since a one-off stall of the machine can
+make any search look slow once.
+
+    python3 benchmarks/bench_tracks.py [recorded ~list.js] [--songs N] [--searches N] [--limit N] [--budget MS]
+
+Exits with status 1 if any of them is over budget.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))  # Import from the repo root
+
+import tracks  # noqa: E402
+from net import SONG_URL  # noqa: E402
+
+
+def synthetic_songs(count):
+    """
+    Makes up 'count' songs named like the real ones ('Artist - Title')
+    """
+    syllables = 'na ga nu ma hi de ki fun ky ra dio sne ak man soul jet set gra ffi ti ro kka ku be at'.split()
+
+    def word():
+        return ''.join(random.choice(syllables) for _ in range(random.randint(1, 4))).capitalize()
+
+    artists = [' '.join(word() for _ in range(random.randint(1, 3))) for _ in range(max(1, count // 20))]
+    names = ['%s - %s' % (random.choice(artists), ' '.join(word() for _ in range(random.randint(1, 5))))
+             for _ in range(count)]
+    return [[name, SONG_URL % name] for name in names]
+
+
+def typo(word):
+    """
+    Swaps two neighbouring letters of a word
+    """
+    if len(word) < 4:
+        return word
+    i = random.randrange(1, len(word) - 2)
+    return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('recording', nargs='?', help='recorded ~list.js to index')
+    parser.add_argument('--songs', type=int, default=50000, help='synthetic songs to index (default 50000)')
+    parser.add_argument('--searches', type=int, default=2000, help='searches of each kind (default 2000)')
+    parser.add_argument('--limit', type=int, default=10, help='songs each search asks for (default 10)')
+    parser.add_argument('--budget', type=float, default=1.0, help='milliseconds a search may take (default 1)')
+    args = parser.parse_args()
+
+    if args.recording:
+        with open(args.recording, 'rb') as recording:
+            songs = tracks.parse_tracklist(recording.read())
+    else:
+        songs = synthetic_songs(args.songs)
+
+    start = time.perf_counter()
+    index = tracks.TrackIndex(songs)
+    print('songs:     %d, index built in %.1f ms' % (len(songs), (time.perf_counter() - start) * 1000))
+
+    names = [tracks.tokenize(name) for name, url in songs]
+    names = [words for words in names if words]
+    kinds = {
+        'word': lambda words: random.choice(words),
+        'prefix': lambda words: random.choice(words)[:3],
+        'two words': lambda words: ' '.join(random.sample(words, min(2, len(words)))),
+        'typo': lambda words: typo(max(words, key=len)),
+        'one letter': lambda words: random.choice(words)[:1],
+    }
+    over = []
+    for kind, make_query in kinds.items():
+        queries = [make_query(random.choice(names)) for _ in range(args.searches)]
+        found = 0
+        times = []
+        for query in queries:
+            start = time.perf_counter()
+            found += bool(index.search(query, args.limit))
+            times.append(time.perf_counter() - start)
+
+        average = sum(times) / len(times)
+        p99 = sorted(times)[int(len(times) * 0.99)]
+        slowest = queries[times.index(max(times))]
+        again = min(time_search(index, slowest, args.limit) for _ in range(5))
+        print('%-10s %7.1f us/search, p99 %7.1f us, slowest %7.1f us (%r, %.1f us again), %5.1f%% found something' %
+              (kind + ':', average * 1e6, p99 * 1e6, max(times) * 1e6, slowest, again * 1e6,
+               found * 100 / len(queries)))
+        for name, seconds in (('average', average), ('p99', p99), ('slowest', again)):
+            if seconds * 1000 >= args.budget:
+                over.append('%s %s %.3f ms' % (kind, name, seconds * 1000))
+
+    if over:
+        print('FAIL: over the %g ms budget: %s' % (args.budget, ', '.join(over)))
+        sys.exit(1)
+
+
+def time_search(index, query, limit):
+    start = time.perf_counter()
+    index.search(query, limit)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark for chat line wrapping: wrap speed, redraw cost and resize reflow.
+
+Fills a scrollback with chat (plain ASCII, and a mix with CJK and emoji),
+then measures:
+
+- wrapping: chat.wrap_text against the old fixed 58 character slices
+- redraws: chat.ChatView.lines() for a big terminal, with the lines cached
+  per (message, width) in a chat.LineCache
+- resizes: the first redraw after the width changes, and how many messages
+  it had to wrap again (only the ones on screen should be)
+
+    python3 benchmarks/bench_wrap.py [--messages N] [--columns N] [--rows N]
+
+Exits with status 1 if a resize rewraps more than a screen of messages.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))  # Import from the repo root
+
+import chat  # noqa: E402
+
+
+def synthetic_texts(count, wide):
+    """
+    Makes up 'count' chat messages
+
+    Args:
+        count (int): Amount of messages to make
+        wide (bool): Mix in CJK, emoji and combining marks
+    """
+    words = 'jet set radio live tokyo-to rudie graffiti soul funk beat gum corn yoyo combo'.split()
+    if wide:
+        words += ['東京', 'ラジオ', '渋谷町', '😀', '🎧🎶', 'café', 'josé', '한국어']
+    return [' '.join(random.choice(words) for _ in range(random.randint(1, 30))) for _ in range(count)]
+
+
+def build_lines(message, width):
+    chunks = chat.wrap_text(message.user + ': ' + message.text, width)
+    chunks.reverse()
+    return chunks
+
+
+def timed(function, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat
+
+
+def run(texts, args):
+    """
+    Runs the measurements over one set of messages; returns whether the resize check passed
+    """
+    width = args.columns - 22  # The chat panel's text area: 58 columns on an 80 column terminal
+    height = args.rows - 11
+
+    start = time.perf_counter()
+    for text in texts:
+        chat.wrap_text('user: ' + text, width)
+    wrap_us = (time.perf_counter() - start) * 1000000 / len(texts)
+
+    start = time.perf_counter()
+    for text in texts:
+        msg = 'user: ' + text
+        [msg[chunk:chunk + 58] for chunk in range(0, len(msg), 58)]
+    slice_us = (time.perf_counter() - start) * 1000000 / len(texts)
+
+    scrollback = chat.Scrollback(len(texts))
+    scrollback.extend(chat.ChatMessage('user%d' % (i % 40), text, 'default', None) for i, text in enumerate(texts))
+
+    cache = chat.LineCache(2000)
+    panel = {'width': width}
+    view = chat.ChatView(scrollback, lambda message: cache.get(message, panel['width'], build_lines), height)
+    view.lines()  # The first frame wraps what's on screen
+    redraw_ms = timed(view.lines, 200) * 1000
+    view.page_up()
+    view.page_up()
+
+    panel['width'] = width // 2  # Terminal gets narrower
+    misses = cache.misses
+    start = time.perf_counter()
+    view.resize(height)
+    view.lines()
+    resize_ms = (time.perf_counter() - start) * 1000
+    rewrapped = cache.misses - misses
+
+    print('  wrap_text:   %.2f us/message (fixed slices: %.2f us)' % (wrap_us, slice_us))
+    print('  redraw:      %.3f ms for %d lines at %d columns (cached)' % (redraw_ms, height, width))
+    print('  resize:      %.3f ms, %d of %d messages wrapped again' % (resize_ms, rewrapped, len(texts)))
+    return rewrapped <= 3 * height  # Scrolled back: the screen, the anchor's message and what __clamp() looks at
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=5000, help='messages in the scrollback (default 5000)')
+    parser.add_argument('--columns', type=int, default=240, help='terminal width (default 240)')
+    parser.add_argument('--rows', type=int, default=70, help='terminal height (default 70)')
+    args = parser.parse_args()
+
+    passed = True
+    for name, wide in (('ascii', False), ('wide', True)):
+        print('%s:' % name)
+        passed = run(synthetic_texts(args.messages, wide), args) and passed
+
+    if not passed:
+        print('FAIL: a resize wrapped more than the messages on screen')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
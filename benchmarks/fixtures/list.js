@@ -0,0 +1,21 @@
+var list = new Array();
+list[0] = "Hideki Naganuma - Funky Radio";
+list[1] = "Hideki Naganuma - Sneakman";
+list[2] = "Hideki Naganuma - Humming The Bassline";
+list[3] = "Hideki Naganuma - Let Mom Sleep";
+list[4] = "Hideki Naganuma - Rock It On";
+list[5] = "Hideki Naganuma - That's Enough";
+list[6] = "Guitar Vader - Magical Girl";
+list[7] = "Guitar Vader - Super Brothers";
+list[8] = "Deavid Soul - Oldies But Happies";
+list[9] = "Deavid Soul - Grace And Glory";
+list[10] = "BS 2000 - Jazz Brew";
+list[11] = "Jurassic 5 - Concrete Schoolyard";
+list[12] = "Feature Cast - Like It Like This Like That";
+list[13] = "Cibo Matto - Birthday Cake";
+list[14] = "Mix Master Mike - Patriotic";
+list[15] = "Rob Zombie - Dragula (Si Non Oscillas, Noli Tintinnare Mix)";
+list[16] = "The Latch Brothers - Ooga Booga";
+list[17] = "Scapegoat Wax - Aisle 10 (Hello Allison)";
+list[18] = "Professional Murder Music - Slow";
+list[19] = "Lovebumps - Bout the City";
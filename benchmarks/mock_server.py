@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+
+"""
+Local stand-in for jetsetradio.live, for benchmarking the client offline.
+
+Serves the endpoints the client uses, seeded from the files in
+benchmarks/fixtures (or another folder of recordings, e.g. saved with curl):
+
+    /audioplayer/audio/~list.js     list.js, plus --songs synthetic names
+    /audioplayer/audio/<name>.mp3   *.mp3 from the fixtures, or silent mp3 frames
+    /chat/messages.xml              a --window message window over messages.xml,
+                                    with --chat-rate new messages per second
+    /chat/save.php                  POSTed messages go into the chat
+    /counter/listeners.xml          listeners.xml, changing every --listener-period seconds
+    /messages/messages.xml          broadcast.xml, changing every --broadcast-period seconds
+
+Everything has an ETag and Last-Modified and answers If-None-Match with a 304,
+like the real site. Point the client at it with JSRL_BASE_URL:
+
+    python3 benchmarks/mock_server.py --port 8080 --chat-rate 2
+    JSRL_BASE_URL=http://127.0.0.1:8080 python3 main.py
+
+The first line printed is the base URL (useful with --port 0).
+"""
+
+import argparse
+import email.utils
+import glob
+import hashlib
+import http.server
+import os
+import random
+import re
+import threading
+import time
+import urllib.parse
+
+FIXTURES = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'fixtures')
+WORDS = 'jet set radio live tokyo-to rudie graffiti soul funk beat gum corn yoyo combo rokkaku tag'.split()
+
+
+def silent_mp3(seconds):
+    """
+    Makes an mp3 of silence without needing an encoder: MPEG-1 layer III frames, 128 kbps,
+    44.1 kHz stereo, whose side info is all zeroes (no audio data, so they decode to silence)
+
+    Args:
+        seconds (float): How long it should play for
+    """
+    frame = b'\xff\xfb\x90\x00' + bytes(144 * 128000 // 44100 - 4)  # 417 bytes, 1152 samples each
+    return frame * int(seconds * 44100 / 1152)
+
+
+class MockSite(object):
+    def __init__(self, fixtures=FIXTURES, songs=0, chat_rate=1.0, window=100, listener_period=10.0,
+                 broadcast_period=60.0, song_seconds=180.0, seed=0):
+        """
+        The site's content, moving along with time the way the real one does
+
+        Args:
+            fixtures (str): Folder with list.js, messages.xml, listeners.xml, broadcast.xml and *.mp3
+            songs (int): Synthetic songs to add to the tracklist
+            chat_rate (float): New chat messages per second
+            window (int): Messages in messages.xml
+            listener_period (float): Seconds between listener count changes
+            broadcast_period (float): Seconds between broadcast message changes
+            song_seconds (float): Length of the silent mp3 served when there are no mp3 fixtures
+            seed (int): Seed for everything random, so runs are comparable
+        """
+        import chat  # The client's own parser reads the fixtures
+
+        self.__random = random.Random(seed)
+        self.__lock = threading.Lock()
+        self.__started = time.monotonic()
+        self.chat_rate = chat_rate
+        self.window = window
+        self.listener_period = listener_period
+        self.broadcast_period = broadcast_period
+        self.requests = {}  # path -> requests served
+
+        def fixture(name, default=b''):
+            path = os.path.join(fixtures, name)
+            if not os.path.exists(path):
+                return default
+            with open(path, 'rb') as source:
+                return source.read()
+
+        self.__song_names = [name.decode('utf-8') for name in re.findall(b'"(.*)";', fixture('list.js'))]
+        self.__song_names += ['%s - %s' % (self.__words(2).title(), self.__words(3).title()) for _ in range(songs)]
+
+        self.__messages = chat.parse_messages(fixture('messages.xml', b'<messages/>'))  # Raw (user, text), oldest first
+        self.__users = sorted({user for user, text in self.__messages}) or ['rudie']
+        self.__generated = 0  # Synthetic messages added so far
+
+        self.__listeners = fixture('listeners.xml', b'<listeners></listeners>')
+        self.__broadcast = fixture('broadcast.xml', b'<messages><avatar></avatar><message></message></messages>')
+
+        self.__mp3s = [fixture(os.path.basename(path)) for path in sorted(glob.glob(os.path.join(fixtures, '*.mp3')))]
+        if not self.__mp3s:
+            self.__mp3s = [silent_mp3(song_seconds)]
+
+        self.__versions = {}  # path -> (content key, body, etag, last modified) of the last answer built
+
+    def __words(self, count):
+        return ' '.join(self.__random.choice(WORDS) for _ in range(count))
+
+    def __elapsed(self):
+        return time.monotonic() - self.__started
+
+    def add_message(self, user, text):
+        with self.__lock:
+            self.__messages.append((user, text))
+            del self.__messages[:-self.window]
+
+    def __chat(self):
+        with self.__lock:
+            due = int(self.__elapsed() * self.chat_rate)
+            while self.__generated < due:  # Catch up on the messages that 'arrived' since the last poll
+                self.__generated += 1
+                self.__messages.append((self.__random.choice(self.__users),
+                                        self.__words(self.__random.randint(1, 25))))
+            del self.__messages[:-self.window]
+            messages = list(self.__messages)
+
+        body = ''.join('<message><username><![CDATA[%s]]></username><text><![CDATA[%s]]></text></message>\n' % message
+                       for message in messages)
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n<messages>\n%s</messages>\n' % body).encode('utf-8')
+
+    def __listener_count(self):
+        base = self.__listeners.count(b'<user>')
+        step = int(self.__elapsed() / self.listener_period) if self.listener_period else 0
+        return max(0, base + (step * 7919) % 11 - 5)  # Wanders around the recorded count
+
+    def __listeners_document(self):
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n<listeners>\n%s</listeners>\n' %
+                ''.join('<user><ip>%d</ip></user>\n' % user for user in range(self.__listener_count()))).encode()
+
+    def __broadcast_document(self):
+        step = int(self.__elapsed() / self.broadcast_period) if self.broadcast_period else 0
+        if not step:
+            return self.__broadcast
+        return self.__broadcast.replace(b'</message>', (' (%d)</message>' % step).encode(), 1)
+
+    def __tracklist(self):
+        return ''.join('list[%d] = "%s";\n' % (number, name) for number, name in enumerate(self.__song_names)).encode()
+
+    def get(self, path):
+        """
+        Returns (body, ETag, Last-Modified, content type) for a path, or None if there's nothing there
+        """
+        if path == '/chat/messages.xml':
+            body, kind = self.__chat(), 'text/xml'
+        elif path == '/counter/listeners.xml':
+            body, kind = self.__listeners_document(), 'text/xml'
+        elif path == '/messages/messages.xml':
+            body, kind = self.__broadcast_document(), 'text/xml'
+        elif path == '/audioplayer/audio/~list.js':
+            body, kind = self.__tracklist(), 'application/javascript'
+        elif path.startswith('/audioplayer/audio/') and path.endswith('.mp3'):
+            name = path[len('/audioplayer/audio/'):-4]
+            if name not in self.__song_names:
+                return None
+            body, kind = self.__mp3s[self.__song_names.index(name) % len(self.__mp3s)], 'audio/mpeg'
+        else:
+            return None
+
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()[:16]
+        with self.__lock:  # Last-Modified only moves when the content does
+            previous = self.__versions.get(path)
+            if previous is None or previous[0] != etag:
+                self.__versions[path] = (etag, email.utils.formatdate(usegmt=True))
+            last_modified = self.__versions[path][1]
+        return body, etag, last_modified, kind
+
+    def count(self, path):
+        with self.__lock:
+            key = '/audioplayer/audio/*.mp3' if path.endswith('.mp3') else path
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, like the real site
+    site = None  # Set by serve()
+
+    def log_message(self, format, *args):  # Quiet; the benchmark prints what matters
+        pass
+
+    def __send(self, status, body=b'', headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_GET(self):
+        path = urllib.parse.urlsplit(self.path).path
+        self.site.count(path)
+        answer = self.site.get(urllib.parse.unquote(path))
+        if answer is None:
+            self.__send(404)
+            return
+
+        body, etag, last_modified, kind = answer
+        headers = [('ETag', etag), ('Last-Modified', last_modified)]
+        if self.headers.get('If-None-Match') == etag:
+            self.__send(304, headers=headers)
+            return
+        self.__send(200, body, headers + [('Content-Type', kind)])
+
+    do_HEAD = do_GET
+
+    def do_POST(self):
+        path = urllib.parse.urlsplit(self.path).path
+        self.site.count(path)
+        length = int(self.headers.get('Content-Length', 0))
+        form = urllib.parse.parse_qs(self.rfile.read(length).decode('utf-8'))
+        if path != '/chat/save.php':
+            self.__send(404)
+            return
+
+        self.site.add_message(form.get('username', [''])[0], form.get('chatmessage', [''])[0])
+        self.__send(200, b'OK')
+
+
+def serve(site, host='127.0.0.1', port=0):
+    """
+    Starts serving 'site' on a thread of its own
+
+    Returns:
+        tuple: (the server, its base URL for JSRL_BASE_URL)
+    """
+    handler = type('SiteHandler', (Handler,), {'site': site})
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name='mock-server').start()
+    return server, 'http://%s:%d' % server.server_address[:2]
+
+
+def main():
+    import sys
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))  # Import from the repo root
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080, help='0 picks a free one (default 8080)')
+    parser.add_argument('--fixtures', default=FIXTURES, help='folder of recorded responses (default: the bundled ones)')
+    parser.add_argument('--songs', type=int, default=0, help='synthetic songs added to the tracklist')
+    parser.add_argument('--chat-rate', type=float, default=1.0, help='new chat messages per second (default 1)')
+    parser.add_argument('--window', type=int, default=100, help='messages in messages.xml (default 100)')
+    parser.add_argument('--listener-period', type=float, default=10.0, help='seconds between listener changes')
+    parser.add_argument('--broadcast-period', type=float, default=60.0, help='seconds between broadcast changes')
+    parser.add_argument('--song-seconds', type=float, default=180.0, help='length of the silent mp3s')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    site = MockSite(args.fixtures, args.songs, args.chat_rate, args.window, args.listener_period,
+                    args.broadcast_period, args.song_seconds, args.seed)
+    server, base_url = serve(site, args.host, args.port)
+    print(base_url, flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
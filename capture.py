@@ -0,0 +1,290 @@
+"""
+Recording and replaying what jetsetradio.live sends the client (--record / --replay).
+
+The polled XML is gone as soon as the next poll replaces it, so a busy night
+when the client fell behind can't be looked at again afterwards. Recording
+keeps every response the pollers and the tracklist got (messages.xml,
+listeners.xml, the broadcast, ~list.js) along with when it arrived, and a
+replay feeds them back to the client in place of the website:
+
+    python3 main.py --record busy-night.jsonl.gz
+    python3 main.py --headless --replay busy-night.jsonl.gz --replay-speed 0
+
+A replay runs at the speed it was recorded (1), N times faster (N) or as
+fast as the client takes it (0): every recorded response is handed over in
+turn and the pollers don't wait between polls, so it's the same work in the
+same order every time, to measure ingestion and rendering with. Once it's
+all been handed over, polls take as long as a quiet endpoint's would again.
+
+The log is a gzip file of JSON lines, a header and then one response per
+line. Only responses with something new in them are kept (no 304s, no bodies
+identical to the last one), and consecutive chat polls are mostly the same
+messages, which gzip squeezes down to little more than the new ones. The
+tracklist's asked for whole even when it's cached, so the log always has it.
+Every line is flushed as it's written, so a log survives the client crashing.
+"""
+
+import asyncio
+import collections
+import gzip
+import json
+import requests
+import threading
+import time
+
+from requests.structures import CaseInsensitiveDict
+
+from metrics import registry as metrics
+from net import BASE_URL
+
+FORMAT = 1  # Bumped whenever the log's layout changes
+KEPT_HEADERS = ('Content-Type', 'ETag', 'Last-Modified')  # Response headers worth keeping
+
+
+def relative(url):
+    """
+    Returns a URL's path on the website, so a log recorded from one base URL replays under another
+    """
+    return url[len(BASE_URL):] if url.startswith(BASE_URL) else url
+
+
+def build_response(url, status=200, headers=None, body=b''):
+    """
+    Makes a requests.Response out of recorded parts, for code that expects one from net.HttpClient
+    """
+    response = requests.Response()
+    response.url = url
+    response.status_code = status
+    response.headers = CaseInsensitiveDict(headers or {})
+    response._content = body
+    return response
+
+
+def scale_intervals(intervals, speed):
+    """
+    Returns a poller's (min, max) seconds between polls for a replay at 'speed' (0 = don't wait at all)
+    """
+    if not speed:
+        return 0, 0
+    return tuple(seconds / speed for seconds in intervals)
+
+
+class Recorder(object):
+    def __init__(self, path):
+        """
+        Writes the responses net.HttpClient gets to a capture log (see the top of this file)
+
+        Args:
+            path (str): The log to write; replaced if it's already there
+        """
+        self.__file = gzip.open(path, 'wt', encoding='utf-8')
+        self.__lock = threading.Lock()  # Songs and chat sends are fetched from other threads than the pollers
+        self.__started = time.monotonic()
+        self.path = path
+        self.records = 0
+        self.__write({'format': FORMAT, 'base_url': BASE_URL, 'recorded': time.time()})
+
+    def __write(self, entry):
+        line = json.dumps(entry) + '\n'  # Undecodable bytes are kept as \udcXX escapes (see record())
+        with self.__lock:
+            if self.__file is None:  # Closed
+                return
+            self.__file.write(line)
+            self.__file.flush()  # Ends a deflate block; everything up to here can be read back even after a crash
+
+    def record(self, kind, url, response):
+        """
+        Adds a response to the log
+
+        Args:
+            kind (str): 'poll' for net.HttpClient.poll(), 'fetch' for other GETs (the tracklist)
+            url (str): The URL requested
+            response (requests.Response): What came back
+        """
+        self.__write({
+            't': round(time.monotonic() - self.__started, 3),
+            'kind': kind,
+            'url': relative(url),
+            'status': response.status_code,
+            'headers': {name: response.headers[name] for name in KEPT_HEADERS if name in response.headers},
+            'body': response.content.decode('utf-8', 'surrogateescape'),
+        })
+        self.records += 1
+
+    def close(self):
+        with self.__lock:
+            if self.__file is not None:
+                self.__file.close()
+                self.__file = None
+
+
+def load(path):
+    """
+    Reads a capture log
+
+    Args:
+        path (str): The log
+
+    Returns:
+        tuple: (the header, the responses oldest first), each a dict; the bodies are bytes
+    """
+    header = None
+    records = []
+    with gzip.open(path, 'rt', encoding='utf-8') as log:
+        try:
+            for line in log:
+                try:
+                    entry = json.loads(line)
+                except ValueError:  # Cut off halfway through the line
+                    break
+                if header is None:
+                    header = entry
+                    continue
+                entry['body'] = entry['body'].encode('utf-8', 'surrogateescape')
+                records.append(entry)
+        except EOFError:  # The recording client never closed it; everything flushed before then is still there
+            pass
+
+    if header is None or header.get('format') != FORMAT:
+        raise ValueError('%s is not a capture log this version can read' % path)
+    return header, records
+
+
+class ReplayHttpClient(object):
+    def __init__(self, path, speed=1.0, on_finished=None, idle_interval=5.0):
+        """
+        Stands in for net.HttpClient, answering from a capture log instead of the website. A poll gets the
+        newest recorded response that's due by the replay's clock, skipping any before it like a poller that
+        fell behind would (with speed 0: simply the next one). Other GETs get the first response recorded for
+        their URL, POSTs (sending chat) an empty 200 without going anywhere, and songs can't be downloaded.
+
+        Args:
+            path (str): The capture log
+            speed (float): How many times faster than it was recorded to replay it; 0 = as fast as it's polled
+            on_finished (function): Called (on the event loop) once every recorded poll response is handed out
+            idle_interval (float): Seconds every poll waits after that, as there'll never be anything new; the
+                pollers' intervals are scaled down for the replay (to 0 with speed 0) and would spin otherwise
+        """
+        self.header, records = load(path)
+        self.__speed = speed
+        self.__idle_interval = idle_interval
+        self.on_finished = on_finished
+        self.__polls = collections.defaultdict(list)  # Path -> recorded poll responses, oldest first
+        self.__fetches = {}  # Path -> first fetch response recorded for it
+        self.__next = collections.Counter()  # Path -> index of the next poll response to hand out
+        self.__started = None  # time.monotonic() of the first poll; the replay's clock starts there
+        self.__finished = None  # time.monotonic() when the last poll response went out
+        self.__stats = collections.defaultdict(lambda: {'requests': 0, 'bytes': 0, 'not_modified': 0,
+                                                        'unchanged': 0, 'skipped': 0})
+        self.__stats_lock = threading.Lock()
+        for record in records:
+            if record['kind'] == 'poll':
+                self.__polls[record['url']].append(record)
+            else:
+                self.__fetches.setdefault(record['url'], record)
+        self.duration = records and records[-1]['t'] or 0  # Seconds the recording covers
+        self.total = sum(len(responses) for responses in self.__polls.values())  # Poll responses in the log
+        self.replayed = 0
+        self.skipped = 0
+
+    @property
+    def stats(self):
+        """
+        Per-URL counters, like net.HttpClient's; 'not_modified' counts polls with nothing new due yet and
+        'skipped' recorded responses a poll came too late for
+        """
+        with self.__stats_lock:
+            return {url: dict(counters) for url, counters in self.__stats.items()}
+
+    @property
+    def finished(self):
+        return self.__finished is not None
+
+    def __count(self, url, body=None, **extra):
+        with self.__stats_lock:
+            counters = self.__stats[url.split('?')[0]]
+            counters['requests'] += 1
+            counters['bytes'] += body and len(body) or 0
+            for name, amount in extra.items():
+                counters[name] += amount
+
+    async def poll(self, url):
+        """
+        Same as net.HttpClient.poll(): returns the next body due for 'url', or None if nothing new is
+        """
+        if self.__finished is not None:  # Nothing left to hand out
+            await asyncio.sleep(self.__idle_interval)
+            self.__count(url, not_modified=1)
+            return None
+
+        await asyncio.sleep(0)  # Still a trip through the event loop, like a real request
+        if self.__started is None:
+            self.__started = time.monotonic()
+
+        path = relative(url)
+        responses = self.__polls.get(path, ())
+        first = last = self.__next[path]  # Hands out responses[first:last], well, the last of them
+        if self.__speed:
+            now = (time.monotonic() - self.__started) * self.__speed
+            while last < len(responses) and responses[last]['t'] <= now:
+                last += 1
+        elif first < len(responses):
+            last = first + 1
+
+        if last == first:
+            self.__count(url, not_modified=1)
+            return None
+
+        self.__next[path] = last
+        body = responses[last - 1]['body']
+        self.replayed += last - first
+        self.skipped += last - first - 1
+        self.__count(url, body, skipped=last - first - 1)
+
+        if self.replayed == self.total:
+            self.__finished = time.monotonic()
+            if self.on_finished is not None:  # Once the poller's done with this last body
+                asyncio.get_running_loop().call_soon(self.on_finished)
+        return body
+
+    def request(self, method, url, **kwargs):
+        """
+        Same as net.HttpClient.request(), from the log
+        """
+        path = relative(url)
+        if method == 'POST':  # Sent nowhere; a replay shouldn't talk to the website
+            self.__count(url)
+            return build_response(url)
+        if path not in self.__fetches:  # Songs, mostly
+            raise requests.ConnectionError('%s is not in the capture log' % path)
+
+        record = self.__fetches[path]
+        self.__count(url, record['body'])
+        return build_response(url, record['status'], record['headers'], record['body'])
+
+    async def fetch(self, method, url, **kwargs):
+        await asyncio.sleep(0)
+        return self.request(method, url, **kwargs)
+
+    def close(self):
+        pass
+
+    def summary(self):
+        """
+        Returns a short text report of the replay: how far it got, how fast, and what the client made of it
+        """
+        started = self.__started or time.monotonic()
+        elapsed = (self.__finished or time.monotonic()) - started
+        lines = ['Replayed %d of %d responses (%d skipped) recorded over %.1fs in %.1fs (%.1fx)' % (
+            self.replayed, self.total, self.skipped, self.duration, elapsed, self.duration / max(elapsed, 0.001))]
+
+        messages = metrics.counter('chat.messages').value
+        parse = metrics.histogram('chat.parse').snapshot()
+        if parse['count']:
+            lines.append('chat: %d messages (%.0f/s), parse p50/p95 %.2f/%.2fms over %d polls' % (
+                messages, messages / max(elapsed, 0.001), parse['p50_ms'], parse['p95_ms'], parse['count']))
+        frames = metrics.histogram('render.frame').snapshot()
+        if frames['count']:
+            lines.append('render: %d frames, p50/p95 %.2f/%.2fms' % (frames['count'], frames['p50_ms'],
+                                                                     frames['p95_ms']))
+        return '\n'.join(lines)
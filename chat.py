@@ -0,0 +1,553 @@
+"""
+Chat ingestion for the jetsetradio.live CLI client.
+
+messages.xml is a sliding window over the most recent chat messages, so
+most of every poll is messages we've already seen. The ingester parses it
+with expat (no tree is built), works out where the previous poll's window
+ends and only hands back the messages after that.
+
+Messages are wrapped to the chat panel by display width (CJK and most emoji
+take two columns, combining marks none), and the wrapped lines are kept per
+(message, width) in a LineCache, so redraws don't wrap anything again and a
+resize only rewraps the messages that end up on screen.
+"""
+
+import collections
+import hashlib
+import re
+import unicodedata
+import xml.parsers.expat
+
+from metrics import registry as metrics
+
+
+class ChatMessage(object):
+    __slots__ = ('user', 'text', 'role', 'fingerprint')
+
+    def __init__(self, user, text, role, fingerprint):
+        """
+        One chat message, already cleaned up for display
+
+        Args:
+            user (str): Username with the HTML tags removed
+            text (str): Message with the HTML tags removed
+            role (str): 'djpk', 'registered' or 'default'; decides the username color
+            fingerprint (bytes): Hash of the raw message, used to recognise it in later polls
+        """
+        self.user = user
+        self.text = text
+        self.role = role
+        self.fingerprint = fingerprint
+
+
+_char_widths = {}  # Character -> columns it takes; there aren't many distinct ones in a chat
+
+
+def char_width(char):
+    """
+    Returns how many terminal columns a character takes: 2 for wide (CJK, most emoji), 0 for combining marks
+    and other zero-width characters, 1 for the rest
+
+    Args:
+        char (str): One character
+    """
+    width = _char_widths.get(char)
+    if width is None:
+        if unicodedata.combining(char) or unicodedata.category(char) in ('Mn', 'Me', 'Cf'):
+            width = 0  # Drawn over (or joined to) the character before it
+        elif unicodedata.east_asian_width(char) in ('W', 'F'):
+            width = 2
+        else:
+            width = 1
+        _char_widths[char] = width
+    return width
+
+
+def display_width(text):
+    """
+    Returns how many terminal columns a string takes
+
+    Args:
+        text (str): The string
+    """
+    if text.isascii():  # The common case; one column per character
+        return len(text)
+    return sum(char_width(char) for char in text)
+
+
+def wrap_text(text, width):
+    """
+    Splits text into lines of at most 'width' columns, top line first. Lines are cut between characters like
+    the site's chat does, never in the middle of a wide character, and zero-width characters stay on the line of
+    the character they belong to.
+
+    Args:
+        text (str): The text to wrap
+        width (int): Columns per line
+    """
+    if text.isascii():  # One column per character, so plain slicing does it
+        return [text[start:start + width] for start in range(0, len(text), width)] or ['']
+
+    lines = []
+    start = used = 0  # Where the current line starts, and the columns it takes so far
+    for i, char in enumerate(text):
+        columns = char_width(char)
+        if used + columns > width and i > start:
+            lines.append(text[start:i])
+            start, used = i, 0
+        used += columns
+    lines.append(text[start:])
+    return lines
+
+
+class LineCache(object):
+    def __init__(self, capacity=2000):
+        """
+        Keeps messages' wrapped lines per (message, width), dropping the least recently used once there are more
+        than 'capacity'. A width change (resizing the terminal) doesn't throw anything away: messages are wrapped
+        again for the new width as they come on screen, and going back to the old width finds the old lines.
+
+        Args:
+            capacity (int): The most (message, width) entries to keep; should be well over a screen of messages
+        """
+        self.__lines = collections.OrderedDict()  # (message, width) -> lines, least recently used first
+        self.__capacity = capacity
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, message, width, wrap):
+        """
+        Returns a message's lines at 'width', wrapping it with wrap(message, width) if they aren't kept yet
+
+        Args:
+            message (ChatMessage): The message; compared by identity, so every message gets its own entry
+            width (int): Columns the lines may take
+            wrap (function): Takes the message and the width, returns its lines
+        """
+        key = (message, width)
+        lines = self.__lines.get(key)
+        if lines is not None:
+            self.hits += 1
+            self.__lines.move_to_end(key)
+            return lines
+
+        self.misses += 1
+        lines = wrap(message, width)
+        self.__lines[key] = lines
+        if len(self.__lines) > self.__capacity:
+            self.__lines.popitem(last=False)
+        return lines
+
+    def __len__(self):
+        return len(self.__lines)
+
+
+class Scrollback(object):
+    def __init__(self, capacity):
+        """
+        Fixed-capacity ring of chat messages: appending is O(1), and once it's full every new message
+        overwrites the oldest, so memory stays flat however long the client runs. Every message gets
+        a sequence number that keeps counting up, so a position in the scrollback stays valid while
+        new messages come in.
+
+        Args:
+            capacity (int): The most messages to keep
+        """
+        self.__slots = [None] * capacity  # Allocated once; message 'seq' lives at slots[seq % capacity]
+        self.__capacity = capacity
+        self.__next_seq = 0  # Sequence number the next message will get
+
+    def append(self, message):
+        self.__slots[self.__next_seq % self.__capacity] = message
+        self.__next_seq += 1
+
+    def extend(self, messages):
+        for message in messages:
+            self.append(message)
+
+    @property
+    def first_seq(self):  # Sequence number of the oldest message still kept
+        return max(0, self.__next_seq - self.__capacity)
+
+    @property
+    def last_seq(self):  # Sequence number of the newest message (-1 if there are none)
+        return self.__next_seq - 1
+
+    def get(self, seq):
+        """
+        Returns message number 'seq', or None if it's been overwritten or doesn't exist yet
+
+        Args:
+            seq (int): The message's sequence number
+        """
+        if self.first_seq <= seq <= self.last_seq:
+            return self.__slots[seq % self.__capacity]
+        return None
+
+    def __len__(self):
+        return self.__next_seq - self.first_seq
+
+    def __iter__(self):  # Oldest first
+        for seq in range(self.first_seq, self.__next_seq):
+            yield self.__slots[seq % self.__capacity]
+
+    def __reversed__(self):  # Newest first
+        for seq in range(self.last_seq, self.first_seq - 1, -1):
+            yield self.__slots[seq % self.__capacity]
+
+
+class ChatView(object):
+    def __init__(self, scrollback, wrap, height=13):
+        """
+        The part of the scrollback shown in the chat panel. Follows the newest messages until it's
+        scrolled up, then stays on the same messages while new ones come in. Scrolling and rendering
+        only ever look at the messages on (or next to) the screen.
+
+        Args:
+            scrollback (Scrollback): The messages to show
+            wrap (function): Takes a message, returns its lines newest first (should cache them, see LineCache)
+            height (int): Lines in the chat panel; change it with resize()
+        """
+        self.__scrollback = scrollback
+        self.__wrap = wrap
+        self.height = height
+        self.anchor = None  # (seq, line) of the bottom line on screen; None = following the newest messages
+
+    @property
+    def following(self):  # True when the newest messages are on screen
+        return self.anchor is None
+
+    def __bottom(self):
+        """
+        Returns the (seq, line) at the bottom of the screen, pulled back into the scrollback if the
+        message it pointed to has been overwritten since
+        """
+        if self.anchor is None:
+            return self.__scrollback.last_seq, 0
+        seq, line = self.anchor
+        if seq < self.__scrollback.first_seq:
+            return self.__scrollback.first_seq, 0
+        return seq, line
+
+    def lines(self):
+        """
+        Returns the lines on screen, bottom line first
+        """
+        if self.anchor is not None and self.anchor[0] < self.__scrollback.first_seq:
+            self.anchor = (self.__scrollback.first_seq, 0)  # Scrolled so far back the messages got overwritten
+            self.__clamp()
+
+        lines = []
+        seq, line = self.__bottom()
+        while len(lines) < self.height:
+            message = self.__scrollback.get(seq)
+            if message is None:  # Ran out of scrollback
+                break
+            lines.extend(self.__wrap(message)[line:line + self.height - len(lines)])
+            seq, line = seq - 1, 0
+        return lines
+
+    def scroll(self, count):
+        """
+        Scrolls 'count' lines towards older messages (negative: towards newer ones)
+
+        Args:
+            count (int): Lines to scroll
+        """
+        scrollback = self.__scrollback
+        if scrollback.last_seq < 0:
+            return
+
+        seq, line = self.__bottom()
+
+        while count > 0:  # Older: walk up through the messages
+            older_lines = len(self.__wrap(scrollback.get(seq))) - 1 - line  # Lines above this one in its message
+            if count <= older_lines:
+                line += count
+                break
+            if seq == scrollback.first_seq:  # Top of the scrollback
+                line += older_lines
+                break
+            count -= older_lines + 1
+            seq, line = seq - 1, 0
+
+        while count < 0:  # Newer: walk down through the messages
+            if line >= -count:
+                line += count
+                break
+            if seq == scrollback.last_seq:  # Back at the newest line
+                line = 0
+                break
+            count += line + 1
+            seq = seq + 1
+            line = len(self.__wrap(scrollback.get(seq))) - 1
+
+        self.anchor = (seq, line)
+        if seq == scrollback.last_seq and line == 0:  # Back at the bottom; follow new messages again
+            self.anchor = None
+        else:
+            self.__clamp()
+
+    def __clamp(self):
+        """
+        Keeps a full screen of lines above the anchor when there are that many, so scrolling up
+        stops at the oldest line instead of scrolling it off the top
+        """
+        scrollback = self.__scrollback
+        seq, line = self.anchor
+        above = len(self.__wrap(scrollback.get(seq))) - line  # Lines from the anchor up, including it
+        while above < self.height and seq > scrollback.first_seq:
+            seq -= 1
+            above += len(self.__wrap(scrollback.get(seq)))
+
+        if above >= self.height:
+            return
+
+        # Less than a screen above the anchor: put the anchor a screen below the oldest line
+        seq, line = scrollback.first_seq, len(self.__wrap(scrollback.get(scrollback.first_seq))) - 1
+        self.anchor = (seq, line)
+        self.scroll(-(self.height - 1))
+
+    def resize(self, height):
+        """
+        Changes how many lines are on screen. Call after the messages' lines change too (the panel got wider or
+        narrower): the message at the bottom stays there, and only the messages on screen get wrapped again.
+
+        Args:
+            height (int): Lines in the chat panel
+        """
+        self.height = height
+        if self.anchor is None:  # Following; lines() starts from the newest message anyway
+            return
+
+        seq, line = self.anchor
+        message = self.__scrollback.get(seq)
+        if message is not None:
+            self.anchor = (seq, min(line, len(self.__wrap(message)) - 1))  # Rewrapped into fewer lines, maybe
+            self.__clamp()
+
+    def page_up(self):
+        self.scroll(self.height)
+
+    def page_down(self):
+        self.scroll(-self.height)
+
+
+def parse_messages(data):
+    """
+    Pulls the (raw username, raw text) pairs out of messages.xml in document order
+
+    Args:
+        data (bytes): The messages.xml document
+    """
+    messages = []
+    fields = {}  # Text collected for the message being parsed
+    current = []  # Name of the field being collected, if any; a list so the handlers can change it
+
+    def start_element(name, attributes):
+        if name == 'message':
+            fields.clear()
+        elif name in ('username', 'text') and not current:
+            current.append(name)
+            fields[name] = []
+
+    def end_element(name):
+        if name == 'message':
+            messages.append((''.join(fields.get('username', ())), ''.join(fields.get('text', ()))))
+        elif current and name == current[0]:
+            current.pop()
+
+    def character_data(text):
+        if current:
+            fields[current[0]].append(text)
+
+    parser = xml.parsers.expat.ParserCreate()
+    parser.buffer_text = True  # Fewer, bigger character_data calls
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.CharacterDataHandler = character_data
+
+    try:
+        parser.Parse(data, True)
+    except xml.parsers.expat.ExpatError:  # Not well-formed XML; the old lenient parser copes with that
+        try:
+            import bs4
+        except ImportError:  # Without it the document's skipped; the next poll's probably fine
+            metrics.counter('chat.parse_failures').add()
+            return []
+
+        metrics.counter('chat.bs4_fallbacks').add()
+        bs = bs4.BeautifulSoup(data, 'html.parser')
+        return [(message.find('username').get_text(), message.find('text').get_text())
+                for message in bs.findAll('message')]
+
+    return messages
+
+
+def parse_broadcast(data):
+    """
+    Pulls the broadcast message and the broadcaster's avatar id out of messages/messages.xml
+
+    Args:
+        data (bytes): The messages.xml document
+
+    Returns:
+        tuple: (avatar id, message); either is '' if missing. None if the document couldn't be parsed
+    """
+    fields = {'avatar': [], 'message': []}
+    current = []  # Name of the field being collected, if any
+
+    def start_element(name, attributes):
+        if name in fields and not current and not fields[name]:  # Only the first of each counts
+            current.append(name)
+
+    def end_element(name):
+        if current and name == current[0]:
+            current.pop()
+
+    def character_data(text):
+        if current:
+            fields[current[0]].append(text)
+
+    parser = xml.parsers.expat.ParserCreate()
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.CharacterDataHandler = character_data
+
+    try:
+        parser.Parse(data, True)
+    except xml.parsers.expat.ExpatError:  # Not well-formed XML; the old lenient parser copes with that
+        try:
+            import bs4
+        except ImportError:  # Without it the document's skipped; the next poll's probably fine
+            metrics.counter('chat.parse_failures').add()
+            return None
+
+        metrics.counter('chat.bs4_fallbacks').add()
+        bs = bs4.BeautifulSoup(data, 'html.parser')
+        avatar, message = bs.find('avatar'), bs.find('message')
+        return avatar and avatar.text or '', message and message.text or ''
+
+    return ''.join(fields['avatar']), ''.join(fields['message'])
+
+
+def overlap(old, new):
+    """
+    Returns how many of the leading fingerprints in 'new' are the last ones in 'old': the longest start of the
+    new window that's also the end of the old one. A message repeated word for word doesn't confuse it since
+    the whole run has to line up, not just one message.
+
+    Args:
+        old (list): Fingerprints seen before, in order
+        new (list): Fingerprints of the new poll, in document order
+    """
+    if not old:
+        return 0
+
+    last = old[-1]
+    for end in range(min(len(new), len(old)), 0, -1):  # Longest possible overlap first
+        if new[end - 1] == last and new[:end] == old[len(old) - end:]:
+            return end
+    return 0
+
+
+class ChatIngester(object):
+    def __init__(self, history_size=500, index_size=1000):
+        """
+        Turns successive polls of messages.xml into a stream of new messages
+
+        Args:
+            history_size (int): How many processed messages to keep, oldest dropped first
+            index_size (int): How many of the latest messages' fingerprints to remember, to tell old messages
+                from new ones when a poll doesn't line up with the previous one
+        """
+        self.history = Scrollback(history_size)  # Processed messages, oldest first
+        self.__window = []  # Fingerprints of the last poll that had messages, in document order
+        self.__recent = collections.deque(maxlen=index_size)  # Fingerprints of the latest messages, oldest first
+        self.__recent_counts = collections.Counter()  # Fingerprint -> times it's in self.__recent
+
+    @staticmethod
+    def fingerprint(user, text):
+        return hashlib.sha1(user.encode('utf-8') + b'\0' + text.encode('utf-8')).digest()
+
+    def __remember(self, fingerprints):
+        """
+        Adds new messages' fingerprints to the index of recent ones, forgetting the oldest past index_size
+        """
+        recent, counts = self.__recent, self.__recent_counts
+        for fingerprint in fingerprints:
+            if len(recent) == recent.maxlen:
+                oldest = recent[0]
+                counts[oldest] -= 1
+                if not counts[oldest]:
+                    del counts[oldest]
+            recent.append(fingerprint)
+            counts[fingerprint] += 1
+
+    def __known(self, fingerprints):
+        """
+        Returns how many of the leading fingerprints are of recent messages. For polls that don't line up with
+        the previous one (it was lost, or the whole window moved on meanwhile): old messages come first in
+        the document, so everything from the first unknown message on is new.
+        """
+        for index, fingerprint in enumerate(fingerprints):
+            if fingerprint not in self.__recent_counts:
+                return index
+        return len(fingerprints)
+
+    def ingest(self, data):
+        """
+        Parses a poll of messages.xml and processes only the messages that weren't in the previous one. A poll
+        with no messages in it (an empty or broken document) is ignored, so the next one is still compared
+        with the last one that had some.
+
+        Args:
+            data (bytes): The messages.xml document
+
+        Returns:
+            list: The new ChatMessages, oldest first (also appended to self.history)
+        """
+        with metrics.timer('chat.parse'):
+            raw_messages = parse_messages(data)
+            fingerprints = [self.fingerprint(user, text) for user, text in raw_messages]
+        if not fingerprints:
+            return []
+
+        seen = overlap(self.__window, fingerprints) or self.__known(fingerprints)  # Everything before this was seen
+
+        new_messages = []
+        for (user, text), fingerprint in zip(raw_messages[seen:], fingerprints[seen:]):
+            role = 'default'  # Decides the color of the user's name
+            if user == 'DJProfessorK':  # The Professor himself
+                role = 'djpk'
+            elif user.find('</font>') != -1:  # Registered users have their name wrapped in a font tag
+                role = 'registered'
+
+            user = re.sub('<[^<]+?>', '', user)  # Remove HTML tags from username and message
+            text = re.sub('<[^<]+?>', '', text)
+
+            new_messages.append(ChatMessage(user, text, role, fingerprint))
+
+        self.__window = fingerprints
+        self.__remember(fingerprints[seen:])
+        self.history.extend(new_messages)
+        metrics.counter('chat.messages').add(len(new_messages))
+        return new_messages
+
+    def add(self, messages, skip_known=False):
+        """
+        Appends messages that were already ingested somewhere else (e.g. by a relay)
+
+        Args:
+            messages (list): ChatMessages, oldest first
+            skip_known (bool): Leave out the leading ones seen recently (a relay's history, sent again after
+                reconnecting to it)
+
+        Returns:
+            list: The messages added
+        """
+        if skip_known:
+            messages = messages[self.__known([message.fingerprint for message in messages]):]
+        self.__remember(message.fingerprint for message in messages if message.fingerprint is not None)
+        self.history.extend(messages)
+        return messages
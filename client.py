@@ -0,0 +1,671 @@
+"""
+Core of the jetsetradio.live CLI client, without the screen.
+
+The chat, listener and broadcast pollers, the tracklist, sending chat and the
+audio player, as components that can be imported and run on their own (to
+profile or benchmark one of them) or together through Client, by main.py's
+curses UI, headless.py or anything else. Nothing here touches curses.
+
+What the pollers learn is published as events, in the relay's format:
+
+    {"type": "chat", "messages": [ChatMessage, ...]}    (new messages only)
+    {"type": "listeners", "count": 12}
+    {"type": "broadcast", "avatar": "djprofessork", "message": "..."}
+    {"type": "tracklist", "songs": [[name, url], ...]}
+    {"type": "outbox", "sent": 3, "failed": 0, "pending": 1}
+    {"type": "song", "name": "..."}                     (started playing)
+    {"type": "relay", "connected": false}               (lost the relay, with --connect; true once it's back)
+"""
+
+import asyncio
+import collections
+import os
+import random
+import relay
+import requests
+import shutil
+import threading
+import time
+import wave
+
+import audio
+from chat import ChatIngester, parse_broadcast
+from metrics import registry as metrics
+from net import BROADCAST_URL, CHAT_URL, LISTENERS_URL, SEND_URL, TIMEOUT, HttpClient, Outbox, PollSchedule
+from state import ClientState
+from tracks import TrackIndex
+
+try:
+    import pyaudio
+except ImportError:  # Only needed to actually play audio; headless clients can do without
+    pyaudio = None
+
+
+class ChatEngine(object):
+    def __init__(self, http, schedule, publish, history_size=5000, archive=None):
+        """
+        Polls the chat, keeping the messages not seen before
+
+        Args:
+            http (net.HttpClient): Client to poll with
+            schedule (net.PollSchedule): How often to poll
+            publish (function): Called with a 'chat' event for every batch of new messages
+            history_size (int): How many messages to keep for scrolling back through
+            archive (archive.ChatArchive): Where every new message is archived; None = nowhere
+        """
+        self.__http = http
+        self.__schedule = schedule
+        self.__publish = publish
+        self.archive = archive
+        self.ingester = ChatIngester(history_size)  # Parses each poll, keeping only messages not seen before
+        self.history = self.ingester.history  # The newest messages; only touched from the event loop
+
+    def add(self, messages, skip_known=False):
+        """
+        Adds new messages from somewhere other than a poll (e.g. the relay)
+
+        Args:
+            messages (list): ChatMessages, oldest first
+            skip_known (bool): Leave out the leading ones seen recently (see chat.ChatIngester.add())
+        """
+        messages = self.ingester.add(messages, skip_known)
+        if not messages:
+            return
+        if self.archive is not None:
+            self.archive.add(messages)  # Queued; written to disk on the archive's own thread
+        self.__publish({'type': 'chat', 'messages': messages})
+
+    async def run(self):
+        while True:
+            try:
+                data = await self.__http.poll(CHAT_URL)
+                new_messages = data is not None and self.ingester.ingest(data)  # Only new messages get processed
+                if new_messages:
+                    if self.archive is not None:
+                        self.archive.add(new_messages)
+                    self.__publish({'type': 'chat', 'messages': new_messages})
+                self.__schedule.record(changed=bool(new_messages))
+            except requests.RequestException:  # Failed or timed out; don't delete messages, try again later
+                self.__schedule.record(error=True)
+
+            await self.__schedule.wait()
+
+
+class ListenerEngine(object):
+    def __init__(self, http, schedule, publish):
+        """
+        Polls the listener count
+
+        Args:
+            http (net.HttpClient): Client to poll with
+            schedule (net.PollSchedule): How often to poll
+            publish (function): Called with a 'listeners' event whenever the count changes
+        """
+        self.__http = http
+        self.__schedule = schedule
+        self.__publish = publish
+        self.count = 0
+
+    async def run(self):
+        while True:
+            try:
+                data = await self.__http.poll(LISTENERS_URL)
+                if data is not None:  # None = same as last time
+                    self.count = data.count(b'<user>')  # The amount of listeners = <user> tags
+                    self.__publish({'type': 'listeners', 'count': self.count})
+                self.__schedule.record(changed=data is not None)
+            except requests.RequestException:  # Failed or timed out; keep the old count
+                self.__schedule.record(error=True)
+
+            await self.__schedule.wait()
+
+
+class BroadcastEngine(object):
+    def __init__(self, http, schedule, publish):
+        """
+        Polls the broadcast message (the 'BCST' bar)
+
+        Args:
+            http (net.HttpClient): Client to poll with
+            schedule (net.PollSchedule): How often to poll
+            publish (function): Called with a 'broadcast' event whenever the message changes
+        """
+        self.__http = http
+        self.__schedule = schedule
+        self.__publish = publish
+        self.avatar = ''
+        self.message = ''
+
+    async def run(self):
+        while True:
+            try:
+                data = await self.__http.poll(BROADCAST_URL)  # None = same message as last time
+                broadcast = data is not None and parse_broadcast(data)
+                if broadcast:  # Unparseable ones are skipped, keeping the old message
+                    self.avatar, self.message = broadcast
+                    self.__publish({'type': 'broadcast', 'avatar': self.avatar, 'message': self.message})
+                self.__schedule.record(changed=data is not None)
+            except requests.RequestException:  # If there is an issue retrieving the message, keep the old one
+                self.__schedule.record(error=True)
+
+            await self.__schedule.wait()
+
+
+class AudioEngine(object):
+    def __init__(self, http, state, songs, stream=True, prefetch_depth=1, prefetch_budget=64 * 1024 * 1024,
+                 buffer_seconds=0.5, cache=None, publish=None, startup_timer=None):
+        """
+        Picks songs, downloads and decodes them and plays them through PyAudio, on the thread that calls run()
+
+        Args:
+            http (net.HttpClient): Client to download songs with
+            state (state.ClientState): Where the song playing, its progress and the volume are kept
+            songs (function): Returns the current tracklist ([[song name, song url], ...])
+            stream (bool): Decode songs through ffmpeg while they download instead of downloading to temp.wav first
+            prefetch_depth (int): How many songs to download & decode ahead of the one playing (needs stream)
+            prefetch_budget (int): Max bytes of decoded audio held in memory for the playing + prefetched songs
+            buffer_seconds (float): Size of the buffer between the decoder and the sound card, in seconds of audio
+            cache (audio.AudioCache): Songs played before; None = no cache
+            publish (function): Called with a 'song' event whenever a song starts
+            startup_timer (startup.StartupTimer): Told when the first audio comes out
+        """
+        self.__http = http
+        self.__state = state
+        self.__songs = songs
+        self.__stream = stream
+        self.__prefetch_depth = prefetch_depth
+        self.__prefetch_budget = prefetch_budget
+        self.__buffer_seconds = buffer_seconds
+        self.__publish = publish or (lambda event: None)
+        self.__startup_timer = startup_timer
+        self.__stopped = False
+        self.__pa = None  # PortAudio, once it's started; every song's stream is opened on it
+        self.__pa_lock = threading.Lock()
+        self.cache = cache
+        self.queue = collections.deque()  # Songs to play before going back to shuffle: Format is [song name, song url]
+        self.__play_now = None  # [song name, song url] to drop everything for; see play_now()
+        self.ring = None  # The ring buffer of the song playing; has the underrun/overrun counters
+
+    def __first_audio(self):
+        if self.__startup_timer is not None:
+            self.__startup_timer.mark('first audio')
+
+    def prepare(self):
+        """
+        Starts PortAudio unless it's running already. It looks through every sound device as it starts, which can
+        take a good part of a second, so the chat window has this done while the user logs in instead of when
+        the first song's ready to play.
+
+        Returns:
+            pyaudio.PyAudio: PortAudio, or None without PyAudio
+        """
+        with self.__pa_lock:  # The loader thread and the audio thread can both get here first
+            if self.__pa is None and pyaudio is not None:
+                self.__pa = pyaudio.PyAudio()
+            return self.__pa
+
+    def download_mp3_to_wav(self, url, cached=None):
+        """
+        This function downloads a file given url 'url' and converts it into a wav
+        for playback using pyAudio
+
+        Args:
+            url (str): The URL to download the file from
+            cached (str): Path of the mp3 in the song cache, if it's there
+        """
+
+        try:  # We want to remove the old temp.wav file (Windows can't remove immediately because it's still in use)
+            os.remove('./temp.wav')
+        except OSError:  # It's still in use??? (This should never happen)
+            pass
+
+        if cached:  # Played before; no need to download it again
+            with open(cached, 'rb') as cached_file:
+                song_download = cached_file.read()
+        else:
+            try:
+                song_download = self.__http.request('GET', url, timeout=TIMEOUT).content  # Fetch the song data
+            except requests.RequestException:  # Return nothing if the song doesn't properly load (or stalls)
+                return
+
+            if self.cache is not None and self.cache.kind == 'mp3':  # Keep the download for next time
+                cache_path = self.cache.reserve(url)
+                with open(cache_path, 'wb') as cache_file:
+                    cache_file.write(song_download)
+                self.cache.commit(url, cache_path)
+
+        temp = open('./temp.mp3', 'wb')  # Create a temporary file to load into ffmpeg
+        temp.write(song_download)  # Write the song data to the temp file
+        temp.close()  # Close the file and save it
+
+        os.system('ffmpeg -loglevel panic -i %s -acodec pcm_u8 -ar 44100 temp.wav' % temp.name)  # Converts mp3 to wav
+        while not os.path.exists('./temp.wav'):  # Wait for the new wav file to exist just in case
+            time.sleep(1)
+        os.remove(temp.name)  # Remove the mp3 temp file
+
+        if self.cache is not None and self.cache.kind == 'pcm':  # Keep the converted wav for next time
+            cache_path = self.cache.reserve(url)
+            shutil.copyfile('./temp.wav', cache_path)
+            self.cache.commit(url, cache_path)
+
+        new_wave = wave.open('./temp.wav')  # Load the wav file
+
+        return new_wave
+
+    def stream_mp3(self, url, cached=None):
+        """
+        This function starts downloading the file at url 'url' and pipes it straight
+        through ffmpeg, so playback can start as soon as the first frames are decoded
+
+        Args:
+            url (str): The URL to stream the file from
+            cached (str): Path of the mp3 in the song cache, if it's there
+        """
+
+        if cached:  # Played before; decode it straight from the disk
+            source = open(cached, 'rb')
+            chunks = iter(lambda: source.read(8192), b'')
+            total_bytes = os.path.getsize(cached)
+        else:
+            try:
+                source = self.__http.request('GET', url, stream=True, timeout=TIMEOUT)  # Only the headers, for now
+            except requests.RequestException:  # Return nothing if the song doesn't properly load (or stalls)
+                return
+
+            chunks = source.iter_content(8192)
+            total_bytes = int(source.headers.get('Content-Length', 0)) or None  # Used to estimate the song's length
+
+            if self.cache is not None and self.cache.kind == 'mp3':  # Save the download for next time as it streams
+                chunks = self.cache.tee(url, chunks)
+
+        try:
+            decoder = audio.StreamingDecoder(chunks, total_bytes, source)
+        except OSError:  # ffmpeg isn't installed / can't be started
+            source.close()
+            return
+
+        if self.cache is not None and self.cache.kind == 'pcm':  # Save the decoded audio for next time as it plays
+            return self.cache.record(url, decoder)
+        return decoder
+
+    def load_song(self, url):
+        """
+        Loads the song at url 'url' into something play_song can read frames from
+
+        Args:
+            url (str): URL to fetch the mp3 from
+        """
+        cached = self.cache is not None and self.cache.lookup(url) or None  # Path to the song if played before
+
+        if cached and self.cache.kind == 'pcm':  # Already decoded, so ffmpeg isn't needed at all
+            return wave.open(cached)
+        elif self.__stream:  # Decode the mp3 from jetsetradio.live as it downloads
+            return self.stream_mp3(url, cached)
+        else:  # Download the mp3 file as a wav from jetsetradio.live
+            return self.download_mp3_to_wav(url, cached)
+
+    def play_song(self, name, url, wav=None):
+        """
+        Plays a song, returning once it's over (or has been skipped)
+
+        Args:
+            name (str): Name to display
+            url (str): URL to fetch the mp3 from
+            wav (object): The song, already loaded by the prefetcher; loaded from 'url' if not given
+        """
+        state = self.__state
+        state.update(current_song='Loading...', playback_progress=0)  # Set the song name to 'Loading...' for now
+
+        if wav is None:
+            wav = self.load_song(url)
+        if not wav:  # If there's no wav returned, don't play it
+            return
+
+        state.update(current_song=name)  # Set the song name to the new song
+        self.__publish({'type': 'song', 'name': name})
+
+        channels = wav.getnchannels()
+        ring = audio.RingBuffer(int(wav.getframerate() * channels * self.__buffer_seconds))  # Raw audio ready to play
+        self.ring = ring
+
+        def song_changed():
+            return state.current_song != name or self.__play_now is not None
+
+        def callback(in_data, frame_count, time_info, status):
+            """
+            Called by PyAudio from its own thread whenever the sound card wants more audio, so skips and
+            volume changes take effect within one buffer
+            """
+            if song_changed():  # If the song changed halfway through, stop the stream
+                return b'', pyaudio.paComplete
+
+            with metrics.timer('audio.callback'):
+                wanted = frame_count * channels * 2  # Each Float32 sample is made from 2 bytes of the wav
+                data = ring.read(wanted)
+                if len(data) < wanted:
+                    if ring.closed:  # Out of data and the decoder is done: the song's over
+                        return audio.convert_samples(data, state.volume), pyaudio.paComplete
+                    data += bytes(wanted - len(data))  # The decoder fell behind; pad with silence instead of stalling
+
+                # Convert the whole buffer to Float32 at the current volume
+                return audio.convert_samples(data, state.volume), pyaudio.paContinue
+
+        pa = self.prepare()  # Main class of pyAudio; contains the open() function we need for an audio stream
+
+        # Opens an audio stream on the default output device.
+        # Explained: We're using 1/2th the framerate because we're going from Int16 to Float32; this change
+        # requires us to get twice the amount of data, hence leaving us with twice the amount of bytes.
+        # We convert from Int16 to Float32 to prevent byte overflow, which results in garbled (and scary) static.
+        audio_stream = pa.open(wav.getframerate() // 2, channels, pyaudio.paFloat32, output=True,
+                               stream_callback=callback, start=False)
+
+        # This thread is the decoder: it keeps the ring topped up while the callback drains it
+        while not song_changed():
+            with metrics.timer('audio.decode'):
+                data = wav.readframes(4096)  # Read data from wav
+            if isinstance(data, str):  # Check typing to prevent errors
+                data = data.encode('utf-8')
+            if not data:  # If we're out of data, exit the loop
+                break
+
+            if audio_stream.is_stopped() and ring.available + len(data) > ring.capacity // 2:  # Primed, start playing
+                audio_stream.start_stream()
+                self.__first_audio()
+            if not ring.write_all(data, song_changed):  # Waits whenever the ring is full
+                break
+
+            # Set percent of song played; whatever's still in the ring hasn't been heard yet
+            state.update(playback_progress=max(0, wav.tell() - ring.available // channels) / wav.getnframes())
+
+        ring.close()
+        if audio_stream.is_stopped() and not song_changed():  # Short song that never filled the buffer
+            audio_stream.start_stream()
+            self.__first_audio()
+
+        while audio_stream.is_active():  # Let the callback play out whatever's left in the ring
+            state.update(playback_progress=max(0, wav.tell() - ring.available // channels) / wav.getnframes())
+            time.sleep(0.1)
+
+        audio_stream.stop_stream()
+        audio_stream.close()
+        wav.close()  # Stops the decoder (and the download) if the song was skipped halfway through
+
+        del audio_stream  # Cleanup unused variables
+        del wav
+
+    def run(self):
+        """
+        Plays queued songs, then random ones, until stop(); blocks, so give it a thread
+        """
+        if pyaudio is None:
+            raise RuntimeError('PyAudio is needed to play audio (pip install pyaudio)')
+
+        def pick_song():
+            while not self.__songs():  # No tracklist yet (first run, or waiting on the relay)
+                time.sleep(0.5)
+            songs = self.__songs()
+            return songs[random.randrange(len(songs))]  # Get a random song from the list
+
+        # The prefetcher loads the next song(s) while the current one plays; temp.wav can't be shared, so only
+        # the streaming path can be prefetched
+        prefetcher = audio.Prefetcher(self.load_song, pick_song, self.__stream and self.__prefetch_depth or 0,
+                                      self.__prefetch_budget)
+        try:
+            while not self.__stopped:
+                if self.__play_now is not None:  # Asked for with /play
+                    name, url = self.__play_now
+                    self.__play_now = None
+                    wav = self.load_song(url)
+                elif self.queue:  # Queued with /queue; the shuffled pick the prefetcher has ready can wait
+                    name, url = self.queue.popleft()
+                    wav = self.load_song(url)
+                else:
+                    name, url, wav = prefetcher.next()  # Format [song name, song url, loaded song]
+                if self.__play_now is not None:  # /play came in while that one was loading; it goes first
+                    if wav:
+                        wav.close()
+                    continue
+                if not wav:  # Couldn't load it; wait a second so a dead connection doesn't spin the CPU
+                    time.sleep(1)
+                    continue
+
+                self.play_song(name, url, wav)  # Play back said song
+        finally:
+            prefetcher.close()
+
+    def skip(self):
+        self.__state.update(current_song='Loading...')  # The playback code stops as soon as the song's changed
+
+    def play_now(self, song):
+        """
+        Stops whatever's playing (or loading) and plays 'song' next, ahead of the queue
+
+        Args:
+            song (list): [song name, song url]
+        """
+        self.__play_now = song  # Checked by run() after every load, and by play_song() while it plays
+        self.skip()
+
+    def stop(self):
+        self.__stopped = True
+        self.__state.update(current_song='None')
+
+
+class Client(object):
+    def __init__(self, state=None, http=None, relay_address=None, chat_history_size=5000, chat_archive=None,
+                 tracklist_cache=None, chat_poll_intervals=(0.5, 5), listener_poll_intervals=(1, 15),
+                 broadcast_poll_intervals=(5, 120), startup_timer=None):
+        """
+        Everything the client keeps up to date, minus the screen and the audio. Nothing runs until
+        start() (or run() on an event loop of your own).
+
+        Args:
+            state (state.ClientState): Updated with the listener count; a new one if not given
+            http (net.HttpClient): Client for every request; a new one if not given
+            relay_address (str): Get everything from the relay here instead of polling jetsetradio.live
+            chat_history_size (int): How many chat messages to keep for scrolling back through
+            chat_archive (archive.ChatArchive): Where every chat message seen is archived; None = nowhere
+            tracklist_cache (tracks.TracklistCache): Where the tracklist's kept between runs; None = no tracklist
+            chat_poll_intervals (tuple): Min/max seconds between chat polls
+            listener_poll_intervals (tuple): Min/max seconds between listener count polls
+            broadcast_poll_intervals (tuple): Min/max seconds between broadcast message polls
+            startup_timer (startup.StartupTimer): Told when the tracklist and the first chat arrive
+        """
+        self.state = state or ClientState()
+        self.http = http or HttpClient()  # One pooled keep-alive session for every request
+        self.startup_timer = startup_timer
+        self.relay_address = relay_address
+        self.relay_client = relay_address and relay.RelayClient() or None  # Set when the relay polls for us
+        self.chat_archive = chat_archive
+        self.tracklist_cache = tracklist_cache
+        self.poll_schedules = {  # How often each endpoint gets polled, adapting to how often it actually changes
+            'chat': PollSchedule(*chat_poll_intervals),
+            'listeners': PollSchedule(*listener_poll_intervals),
+            'broadcast': PollSchedule(*broadcast_poll_intervals),
+        }
+        # Sends chat in the background; through the relay when connected to one
+        self.outbox = Outbox(self.relay_client or self.http, SEND_URL, on_change=lambda: self.publish({
+            'type': 'outbox', 'sent': self.outbox.sent, 'failed': self.outbox.failed,
+            'pending': len(self.outbox.pending)}))
+
+        self.chat = ChatEngine(self.http, self.poll_schedules['chat'], self.publish, chat_history_size, chat_archive)
+        self.listeners = ListenerEngine(self.http, self.poll_schedules['listeners'], self.publish)
+        self.broadcast = BroadcastEngine(self.http, self.poll_schedules['broadcast'], self.publish)
+
+        self.songs = []  # The master list of songs: Format is [song name, song url]
+        self.track_index = TrackIndex(self.songs)  # Searches songs for /play and /queue
+
+        self.loop = None  # The event loop the pollers run on, once started
+        self.__task = None
+        self.__subscribers = []
+
+        if tracklist_cache is not None and relay_address is None:  # The relay sends the tracklist otherwise
+            self.set_songs(tracklist_cache.load())  # Straight from disk; empty on the very first run
+            if self.songs:
+                self.__mark('tracklist (cached)')
+
+    def __mark(self, step):
+        if self.startup_timer is not None:
+            self.startup_timer.mark(step)
+
+    def subscribe(self, callback):
+        """
+        Registers a function to be called with every event (see the top of this file)
+
+        Args:
+            callback (function): Called with the event dict, on the event loop's thread; keep it short
+        """
+        self.__subscribers.append(callback)
+
+    def publish(self, event):
+        if event['type'] == 'chat':
+            self.__mark('first chat')
+        elif event['type'] == 'listeners':
+            self.state.update(listeners=event['count'])
+        for callback in self.__subscribers:
+            callback(event)
+
+    def set_songs(self, songs):
+        """
+        Replaces the master list of songs and rebuilds the search index over it
+
+        Args:
+            songs (list): Songs in the format [song name, song url]
+        """
+        self.track_index = TrackIndex(songs)
+        self.songs = songs
+        if songs:
+            self.publish({'type': 'tracklist', 'songs': songs})
+
+    def send(self, text, username, password=''):
+        """
+        Sends a chat message in the background; safe to call from any thread
+
+        Args:
+            text (str): The message
+            username (str): Who it's from
+            password (str): The password for that name, if it has one
+        """
+        # Shows in outbox.pending until it's gone through (through the relay, with --connect)
+        self.outbox.put({'chatmessage': text, 'username': username, 'password': password})
+
+    async def refresh_tracklist(self):
+        """
+        Asks jetsetradio.live whether the tracklist changed since it was cached (fetches it on the first run),
+        retrying with a growing delay until it gets an answer
+        """
+        delay = 5
+        while True:
+            try:
+                fresh = await self.tracklist_cache.refresh(self.http)
+                if fresh:
+                    self.set_songs(fresh)
+                self.__mark('tracklist (checked)')
+                return
+            except requests.RequestException:  # Songs from the cache (if any) keep playing meanwhile
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 120)
+
+    async def listen_to_relay(self):
+        """
+        Takes chat messages, listeners, broadcasts and the tracklist from the relay instead of polling for them.
+        If the relay goes away (restarted, say), reconnects to it with a growing delay.
+        """
+        reconnected = False
+        while True:
+            async for event in self.relay_client.events():
+                if event['type'] == 'chat':  # After reconnecting, the relay's history starts with old ones
+                    self.chat.add(event['messages'], skip_known=reconnected)
+                    reconnected = False
+                elif event['type'] == 'tracklist':
+                    self.set_songs(event['songs'])
+                    self.__mark('tracklist (relay)')
+                elif event['type'] in ('listeners', 'broadcast'):
+                    self.publish(event)
+
+            self.publish({'type': 'relay', 'connected': False})
+            delay = 1
+            while True:
+                await asyncio.sleep(delay * random.uniform(0.8, 1.2))  # Jittered so clients don't all come back at once
+                try:
+                    await self.relay_client.connect(self.relay_address)
+                    break
+                except OSError:  # Not back yet
+                    delay = min(delay * 2, 30)
+            reconnected = True
+            self.publish({'type': 'relay', 'connected': True})
+
+    async def run(self, *coroutines):
+        """
+        Runs every poller (and 'coroutines' alongside them) until one of them fails or it's cancelled
+        """
+        if self.relay_client is not None:  # The relay does the polling
+            await self.relay_client.connect(self.relay_address)
+            coroutines += (self.listen_to_relay(), self.outbox.run())
+        else:
+            coroutines += (self.broadcast.run(), self.listeners.run(), self.chat.run(), self.outbox.run())
+            if self.tracklist_cache is not None:
+                coroutines += (self.refresh_tracklist(),)
+
+        tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:  # One poller failing (or being cancelled) takes the others down with it
+                task.cancel()
+
+    def start(self, *coroutines, on_error=None):
+        """
+        Runs run() on an event loop of its own, on a new thread
+
+        Args:
+            *coroutines: More coroutines to run on the loop alongside the pollers
+            on_error (function): Called (from within the except block) if the loop dies of an exception
+        """
+        def network_thread():
+            try:
+                self.loop.run_until_complete(self.__task)
+            except asyncio.CancelledError:  # stop()
+                pass
+            except:
+                if on_error is None:
+                    raise
+                on_error()
+
+        self.loop = asyncio.new_event_loop()
+        self.__task = self.loop.create_task(self.run(*coroutines))
+        thread = threading.Thread(target=network_thread, name='network', daemon=True)
+        thread.start()
+        return thread
+
+    def call_soon(self, callback, *args):
+        """
+        Runs callback(*args) on the event loop's thread (where the chat history may be touched)
+        """
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def stop(self):
+        """
+        Stops the pollers started by start()
+        """
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.__task.cancel)
+
+    def close(self):
+        """
+        Writes the chat still waiting to be archived
+        """
+        if self.chat_archive is not None:
+            self.chat_archive.close()
+
+    def register_metrics(self):
+        """
+        Adds the stats kept by the client's parts to the metrics registry
+        """
+        metrics.gauge('http', lambda: self.http.stats)
+        metrics.gauge('polling', lambda: {name: schedule.stats for name, schedule in self.poll_schedules.items()})
+        metrics.gauge('send', lambda: {'sent': self.outbox.sent, 'failed': self.outbox.failed,
+                                       'pending': len(self.outbox.pending)})
+        metrics.gauge('archive', lambda: self.chat_archive and {'written': self.chat_archive.written,
+                                                                'duplicates': self.chat_archive.duplicates})
+        metrics.gauge('relay.latency', lambda: self.relay_client and self.relay_client.latency)
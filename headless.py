@@ -0,0 +1,96 @@
+"""
+Headless mode for the jetsetradio.live CLI client.
+
+Runs the client's core (client.Client) without a screen and writes every
+event to stdout as one JSON object per line, for monitoring, scripting and
+profiling the engines without a terminal:
+
+    python3 main.py --headless [--username NAME] [--audio]
+
+Events are the relay's (see relay.py), chat messages as [user, text, role],
+with "time" added (time.time() when it happened). With --username, every
+line read from stdin is sent as a chat message.
+"""
+
+import asyncio
+import json
+import sys
+import threading
+import time
+
+from metrics import registry as metrics
+
+
+def encode(event):
+    """
+    Turns an event into a JSON line
+
+    Args:
+        event (dict): The event, as published by client.Client
+    """
+    event = dict(event, time=round(time.time(), 3))
+    if event['type'] == 'chat':
+        event['messages'] = [[message.user, message.text, message.role] for message in event['messages']]
+    return json.dumps(event, ensure_ascii=False)
+
+
+def run_headless(client, audio_engine=None, username=None, password='', output=None, input=None, metrics_log=None,
+                 metrics_log_interval=10):
+    """
+    Runs the client until interrupted (or stdin closes, when sending from it)
+
+    Args:
+        client (client.Client): The client to run
+        audio_engine (client.AudioEngine): Plays music too, if given
+        username (str): Send the lines read from 'input' as chat from this name; None = don't read input
+        password (str): The password for that name, if it has one
+        output (file): Where the events go (default: stdout)
+        input (file): Where the chat to send comes from (default: stdin)
+        metrics_log (str): Record metrics and append a snapshot to this file every metrics_log_interval seconds
+        metrics_log_interval (float): Seconds between those snapshots
+    """
+    output = output or sys.stdout
+    input = input or sys.stdin
+    output_lock = threading.Lock()  # 'song' events come from the audio thread, the rest from the network thread
+
+    def emit(event):
+        line = encode(event)
+        with output_lock:
+            output.write(line + '\n')
+            output.flush()
+
+    async def metrics_ticker():
+        while True:
+            await asyncio.sleep(metrics_log_interval)
+            await client.loop.run_in_executor(None, metrics.dump, metrics_log)  # Off the loop; it's disk
+
+    client.subscribe(emit)
+    if metrics_log:
+        metrics.enabled = True
+        client.register_metrics()
+        network = client.start(metrics_ticker())
+    else:
+        network = client.start()
+
+    if audio_engine is not None:
+        threading.Thread(target=audio_engine.run, name='audio', daemon=True).start()
+
+    try:
+        if username is not None:
+            for line in input:  # Blocks until stdin closes
+                if line.strip():
+                    client.send(line.rstrip('\n'), username, password)
+            time.sleep(0.1)
+            deadline = time.monotonic() + 10
+            while any(message.state != 'failed' for message in client.outbox.pending) and \
+                    time.monotonic() < deadline:  # Let the last lines go out
+                time.sleep(0.1)
+        else:
+            network.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if audio_engine is not None:
+            audio_engine.stop()
+        client.stop()
+        client.close()
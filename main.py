@@ -8,42 +8,23 @@ This program is free software. It comes without any warranty, to
      * http://www.wtfpl.net/ for more details.
 """
 
-import bs4
+import argparse
 from _curses import error as curses_error
 import locale
 import os
-import pyaudio
-import random
-import re
-import requests
-import struct
+import startup
 import sys
 import threading
 import time
 import unicurses
-import wave
 
+# Only what the login screen needs is imported up here; the client's core (requests, asyncio, the archive's
+# sqlite3, PyAudio...) is imported by load_client(), in the background while the user logs in
+from chat import ChatMessage, ChatView, LineCache, Scrollback, wrap_text
+from metrics import registry as metrics
+from render import Renderer, RenderScheduler
+from textinput import EditBuffer
 
-os.chdir(os.path.dirname(os.path.realpath(__file__)))  # Changes working directory to the script's parent directory
-
-
-# Screen config
-
-stdscr = unicurses.initscr()  # initiates the unicurses module & returns a writable screen obj
-
-unicurses.noecho()  # disables echoing of user input
-unicurses.cbreak()  # characters are read one-by-one
-unicurses.curs_set(0)  # Hide the cursor from view by the user
-unicurses.start_color()  # enables color in terminal
-
-stdscr.keypad(True)  # returns special keys like PAGE_UP, etc.
-stdscr.nodelay(False)  # enables input blocking to keep CPU down
-
-locale.setlocale(locale.LC_ALL, '')
-encoding = locale.getpreferredencoding()  # get the preferred system encoding for unicode support
-
-if sys.platform == 'win32':  # Windows: set codepage to 65001 for unicode support
-    os.system('chcp 65001')
 
 # Settings
 
@@ -53,21 +34,31 @@ broadcaster_names = {  # Broadcaster names for the 'BCST' bar
     'seaman': 'Seaman'
 }
 
-unicurses.init_pair(1, unicurses.COLOR_BLUE, unicurses.COLOR_BLACK)  # default user color pair
-unicurses.init_pair(2, unicurses.COLOR_CYAN, unicurses.COLOR_BLACK)  # registered user color pair
-unicurses.init_pair(3, unicurses.COLOR_YELLOW, unicurses.COLOR_BLACK)  # DJPK color pair
-
-default_color = unicurses.color_pair(1) | unicurses.A_BOLD  # default user color
-registered_color = unicurses.color_pair(2) | unicurses.A_BOLD  # registered user color
-djpk_color = unicurses.color_pair(3) | unicurses.A_BOLD  # DJPK color
-
-login_text = open('./screens/login.txt', 'r').read()  # login text loaded from file
-chat_text = open('./screens/chat.txt', 'r').read()  # chat text loaded from file
+stream_audio = True  # Decode songs through ffmpeg while they download instead of downloading to temp.wav first
+prefetch_depth = 1  # How many songs to download & decode ahead of the one playing (needs stream_audio; 0 = off)
+prefetch_budget = 64 * 1024 * 1024  # Max bytes of decoded audio held in memory for the playing + prefetched songs
+audio_buffer_seconds = 0.5  # Size of the buffer between the decoder and the sound card, in seconds of audio
+cache_kind = 'mp3'  # Keep played songs on disk as 'mp3' (downloads) or 'pcm' (decoded, skips ffmpeg); None = off
+cache_dir = './cache'  # Folder the song cache lives in
+cache_max_bytes = 512 * 1024 * 1024  # Least recently played songs are deleted once the cache grows past this
+chat_history_size = 5000  # How many chat messages to keep for scrolling back through (PAGE UP/DOWN)
+wrapped_lines_cache_size = 2000  # How many messages' wrapped chat lines to keep (per panel width) for redraws
+tracklist_cache_path = './tracklist.json'  # The tracklist's kept here so startup doesn't wait on the website
+chat_archive_path = './chat.db'  # Every chat message seen is kept here to /search through later; None = off
+chat_poll_intervals = (0.5, 5)  # Min/max seconds between chat polls; stretches towards the max while chat's quiet
+listener_poll_intervals = (1, 15)  # Min/max seconds between listener count polls
+broadcast_poll_intervals = (5, 120)  # Min/max seconds between broadcast message polls
+max_fps = 30  # The most frames drawn per second; the screen's only redrawn when something changed
+show_render_stats = False  # Show the estimated bytes/sec sent to the terminal under the commands list
+metrics_log_interval = 10  # Seconds between the snapshots written by --metrics-log
+relay_address = sys.platform == 'win32' and '127.0.0.1:8765' or 'relay.sock'  # Default for --relay/--connect
+
+stdscr = None  # The whole screen; set up by run_ui(), so importing this file doesn't take over the terminal
 
 
 # Core functions and classes
 
-def write(line, x, y, effect=0):
+def write(line, x, y, effect=0, window=None):
     """
     Function to write text to coordinates (x, y) with optional effect
 
@@ -76,9 +67,13 @@ def write(line, x, y, effect=0):
         x (int): X position to write text to
         y (int): Y position to write text to
         effect (int): Curses effect to apply to the text given (A_BLINK, etc.)
+        window (object): Curses window to write to; defaults to the whole screen
     """
+    if window is None:
+        window = stdscr
+
     try:
-        stdscr.addstr(y, x, line, effect)  # Add the given line to coordinates (x, y) with effect 'effect'
+        window.addstr(y, x, line, effect)  # Add the given line to coordinates (x, y) with effect 'effect'
     except curses_error:
         pass
 
@@ -112,6 +107,30 @@ def get_key():
             return wch
 
 
+def get_keys(block=False):
+    """
+    Function to retrieve every key that's waiting at once (a paste, fast typing), so they can be handled
+    as one batch with one redraw after. Empty if there aren't any.
+
+    Args:
+        block (bool): Wait for the first key if there isn't one yet (for when input blocking is on)
+    """
+    keys = []
+    if block:
+        keys.append(get_key())
+        stdscr.nodelay(True)  # Only take the keys already there after that one
+    try:
+        while True:
+            key = get_key()
+            if not key:
+                break
+            keys.append(key)
+    finally:
+        if block:
+            stdscr.nodelay(False)
+    return keys
+
+
 class TextInput(object):
     def __init__(self, char_limit):
         """
@@ -121,53 +140,40 @@ class TextInput(object):
             char_limit (int): Max amount of characters that can be written by the user
         """
 
-        self.__value = u''  # Text value of this class
-        self.__cursor_pos = 0  # When using write(), it displays the text along with a user cursor.
-        self.__char_limit = char_limit  # Max amount of characters writable
+        self.__buffer = EditBuffer(char_limit)  # The text and the cursor; cheap to type and paste into
 
     def update(self, key):
         """
-        Adds a character/string to this class's value
+        Adds a character to this class's value, or applies an editing key (arrows, HOME, END, DELETE, BACKSPACE)
+
+        Args:
+            key (str): Character/key name to write to this class
+        """
+        self.__buffer.update(key)
+
+    def insert(self, text):
+        """
+        Adds a run of characters at the cursor in one go (as much as fits)
 
         Args:
-            key (str): Character/string to write to this class
+            text (str): Characters to write to this class
         """
-        if (not self.__char_limit or (self.__char_limit > 0 and len(self.__value) < self.__char_limit)) and \
-           len(key) == 1:
-            # If there is not a character limit OR there are less characters than the character limit,
-            #   and there is only one character within the char string, add the character to the input
-            self.__value = self.__value[:self.__cursor_pos] + key + self.__value[self.__cursor_pos:]
-            self.__cursor_pos += 1
-        if key == 'KEY_LEFT':  # If left arrow, move cursor pos left 1
-            self.__cursor_pos = max(0, self.__cursor_pos - 1)
-        elif key == 'KEY_RIGHT':  # If right arrow, move cursor pos right 1
-            self.__cursor_pos = min(len(self.__value), self.__cursor_pos + 1)
-        elif key == 'KEY_HOME':  # If home key, move cursor to the beginning
-            self.__cursor_pos = 0
-        elif key == 'KEY_END':  # If end key, move cursor to the end
-            self.__cursor_pos = len(self.__value)
-        elif key == 'KEY_DC':  # If delete key, delete a character in front of the cursor
-            self.__value = self.__value[:self.__cursor_pos] + self.__value[self.__cursor_pos + 1:]
-            self.__cursor_pos = min(len(self.__value), self.__cursor_pos)
-        elif key == 'KEY_BACKSPACE':  # If the backspace key, remove the character the cursor is on
-            self.__value = self.__value[:max(0, self.__cursor_pos - 1)] + self.__value[self.__cursor_pos:]
-            self.__cursor_pos = max(0, self.__cursor_pos - 1)
-        elif key == 'KEY_ENTER':  # If the key is the enter key, do nothing and return
-            return
-        if self.__char_limit > 0:  # If there is a character limit in place, truncate the current input to stay in it
-            self.__value = self.__value[:self.__char_limit]
+        self.__buffer.insert(text)
 
     @property
     def value(self):  # Value property for external reading
-        return self.__value
+        return self.__buffer.text
 
     @value.setter
     def value(self, new_value):  # Value property setter for external writing
         assert isinstance(new_value, str)
-        self.__value = new_value
-        self.__cursor_pos = len(new_value)
+        self.__buffer.text = new_value
+
+    @property
+    def cursor_pos(self):  # Cursor position property for external reading
+        return self.__buffer.cursor
 
-    def write(self, x=0, y=0, active=False, is_password=False):
+    def write(self, x=0, y=0, active=False, is_password=False, window=None):
         """
         Function to write this class's input to coordinates (x, y)
 
@@ -176,524 +182,893 @@ class TextInput(object):
             y (int): Y position to write text to
             active (bool): Whether or not to render the cursor along with the text
             is_password (bool): Whether or not to render all the text as asterisks
+            window (object): Curses window to write to; defaults to the whole screen
         """
+        if window is None:
+            window = stdscr
 
-        to_write = (is_password and '*' * len(self.__value) or self.__value)  # replace text with *'s if password
+        value = self.__buffer.text
+        to_write = (is_password and '*' * len(value) or value)  # replace text with *'s if password
         if not active:  # me_irl
-            write(to_write, x, y)  # Write using the default function
+            write(to_write, x, y, window=window)  # Write using the default function
         else:  # Text input is active, so cursor needs to be rendered
-            if len(self.__value) == 0:  # If there is no text, just render the cursor
-                write(' ', x, y, unicurses.A_REVERSE)
+            if len(value) == 0:  # If there is no text, just render the cursor
+                write(' ', x, y, unicurses.A_REVERSE, window)
             else:  # If there is text, render the text alongside the cursor
                 # to_write = to_write.encode(encoding)  # Encode to be unicode-safe
 
-                cpos = max(0, self.__cursor_pos - 1)  # Calculate the proper position in the text to render w/ cursor
-
-                stdscr.addnstr(y, x, to_write, cpos + 1)  # Write the text before the cursor
-                stdscr.addnstr(y, x + cpos, to_write[cpos], 1, unicurses.A_REVERSE)  # Write the cursor character
-                stdscr.addstr(y, x + cpos + 1, to_write[cpos + 1:])  # Write all text after the cursor mark
-
-
-# Tracklist fetching code
-
-songs = []  # The master list of songs: Format is [song name, song url]
-
-song_list_data = requests.request('GET', 'http://jetsetradio.live/audioplayer/audio/~list.js').content
-song_name_matches = re.findall(b'"(.*)";', song_list_data)  # Since the list is for a JS exec(), we need to parse it
+                cpos = max(0, self.__buffer.cursor - 1)  # Calculate the proper position in the text to render w/ cursor
 
-for song_name in song_name_matches:  # Loop through all matches within the song list
-    song_url = 'http://jetsetradio.live/audioplayer/audio/%s.mp3' % song_name.decode('utf-8')  # Format names into URLs
-    songs.append([song_name.decode('utf-8'), song_url])  # Add the newly formatted song into the internal song list
+                window.addnstr(y, x, to_write, cpos + 1)  # Write the text before the cursor
+                window.addnstr(y, x + cpos, to_write[cpos], 1, unicurses.A_REVERSE)  # Write the cursor character
+                window.addstr(y, x + cpos + 1, to_write[cpos + 1:])  # Write all text after the cursor mark
 
-del song_list_data  # Delete unused variables
-del song_name_matches
 
-
-# Audio playback code
-
-playback_progress = 0  # 0 -> 1; How much audio has been played (for the status bar)
-current_song = 'Loading...'  # The song currently playing
-volume = 5  # The volume to play music at; goes from 0 to 9
-
-
-def download_mp3_to_wav(url):
+def apply_keys(keys, text_input, handle_key):
     """
-    This function downloads a file given url 'url' and converts it into a wav
-    for playback using pyAudio
+    Applies a batch of keys in the order they were typed. Runs of plain characters (a paste) go into the
+    textbox in one go instead of one at a time.
 
     Args:
-        url (str): The URL to download the file from
+        keys (list): The keys, as returned by get_keys()
+        text_input (TextInput): The textbox plain characters go into
+        handle_key (function): Called with every other key (ENTER, PAGE UP...), in turn
     """
-    
-    try:  # We want to remove the old temp.wav file (Windows can't remove immediately because it's still in use by us)
-        os.remove('./temp.wav')
-    except OSError:  # It's still in use??? (This should never happen)
-        pass
+    typed = []  # Plain characters not put in the textbox yet
+    for char in keys:
+        if len(char) == 1:
+            typed.append(char)
+            continue
 
-    try:
-        song_download = requests.request('GET', url).content  # Fetch the song data from the website
-    except requests.ConnectionError:  # Return nothing and delete the tempfile if the song doesn't properly load
-        os.remove('./temp.mp3')
-        return
-
-    temp = open('./temp.mp3', 'wb')  # Create a temporary file to load into ffmpeg
-    temp.write(song_download)  # Write the song data to the temp file
-    temp.close()  # Close the file and save it
+        if typed:
+            text_input.insert(''.join(typed))
+            typed = []
+        handle_key(char)
 
-    os.system('ffmpeg -loglevel panic -i %s -acodec pcm_u8 -ar 44100 temp.wav' % temp.name)  # Converts mp3 to wav
-    while not os.path.exists('./temp.wav'):  # Wait for the new wav file to exist just in case
-        time.sleep(1)
-    os.remove(temp.name)  # Remove the mp3 temp file
-    
-    new_wave = wave.open('./temp.wav')  # Load the wav file
+    if typed:
+        text_input.insert(''.join(typed))
 
-    return new_wave
 
+# Main code
 
-def play_song(name, url):
+def run_ui(args, loader, startup_timer):
     """
-    Function that plays a song in a new thread
+    Runs the chat window (login screen first) until /exit, CTRL+C or a crash
 
     Args:
-        name (str): Name to display
-        url (str): URL to fetch the mp3 from
+        args (argparse.Namespace): The command line
+        loader (startup.Background): Loading the client to show and the audio engine (see load_client()); they're
+            picked up and started once the user's logged in
+        startup_timer (startup.StartupTimer): Told when the login screen's up and the user's logged in
     """
-    global current_song
-    global playback_progress
-
-    current_song = 'Loading...'  # Set the song name to 'Loading...' to notify the user
-    playback_progress = 0
-
-    wav = download_mp3_to_wav(url)  # Download the mp3 file as a wav from jetsetradio.live
-    if not wav:  # If there's no wav returned, don't play it
-        return
+    global stdscr
 
-    current_song = name  # Set the song name to the new song
+    # Screen config
 
-    pa = pyaudio.PyAudio()  # Main class of pyAudio; contains the open() function we need for an audio stream
+    stdscr = unicurses.initscr()  # initiates the unicurses module & returns a writable screen obj
 
-    # Opens an audio stream on the default output device.
-    # Explained: We're using 1/2th the framerate because we're going from Int16 to Float32; this change
-    # requires us to get twice the amount of data, hence leaving us with twice the amount of bytes.
-    # We convert from Int16 to Float32 to prevent byte overflow, which results in garbled (and scary) static.
-    audio_stream = pa.open(wav.getframerate() // 2, wav.getnchannels(), pyaudio.paFloat32, output=True)
-    audio_stream.start_stream()
+    unicurses.noecho()  # disables echoing of user input
+    unicurses.cbreak()  # characters are read one-by-one
+    unicurses.curs_set(0)  # Hide the cursor from view by the user
+    unicurses.start_color()  # enables color in terminal
 
-    buffer_size = audio_stream._frames_per_buffer  # The amount of int16's to read per frame
+    stdscr.keypad(True)  # returns special keys like PAGE_UP, etc.
+    stdscr.nodelay(False)  # enables input blocking to keep CPU down
 
-    while True:
-        data = wav.readframes(buffer_size * 2)  # Read data from wav
-        if isinstance(data, str):  # Check typing to prevent errors
-            data = data.encode('utf-8')
+    locale.setlocale(locale.LC_ALL, '')
 
-        # Take each byte, divide by 0x7FFF to get a float, and then multiply that by the volume constant
-        data = struct.pack('f' * (len(data) // 2), *list(map(lambda b: b / 65535 * (volume / 9),
-                           struct.unpack('H' * (len(data) // 2), data))))
-        playback_progress = wav.tell() / wav.getnframes()  # Set percent of song played
-        audio_stream.write(data)  # Write raw data to speakers
+    if sys.platform == 'win32':  # Windows: set codepage to 65001 for unicode support
+        os.system('chcp 65001')
 
-        if len(data) // 2 < buffer_size:  # If we're out of data, exit the loop
-            break
-        if current_song != name:  # If the song changed halfway through, stop the stream
-            break
+    login_text = open('./screens/login.txt', 'r').read()  # login text loaded from file
+    scheduler = RenderScheduler(max_fps)  # Tells the input loop when to draw a frame
 
-    audio_stream.stop_stream()
+    client = audio_engine = None  # Picked up from the loader once the user's logged in
+    error_msg = ''  # If it's a thread exception, it'll write it to here
+    has_exception = False  # Set to true if an exception occurs, in which the user will be notified why this crashed
 
-    del audio_stream  # Cleanup unused variables
-    del pa
-    del wav
-
-
-# Main code
-
-error_msg = ''  # If it's a thread exception, it'll write it to here
-has_exception = False  # Will be set to true if an exception occurs, in which the user will be notified why this crashed
-
-
-def register_exception():
-    """
-    Sets has_exception to True and the error_msg to the traceback
-    """
-    import traceback
-
-    global error_msg
-    global has_exception
-
-    error_msg = traceback.format_exc()
-    has_exception = True
-
-
-try:  # Hold all code within a try-catch statement so that errors can be logged upon any crashes
-    # Login loop
-
-    stdscr.clear()  # Clears the screen
-
-    username, password = '', ''  # Username and password to be sent with every chat request
-    current_field = True  # Username = True, Password = False
-    user_field = TextInput(18)  # Username field, 18 is the site limit
-    pass_field = TextInput(40)  # Password field (never used by anyone but DJPK?)
-    enter_username_warning = False  # If a blank username is given, it'll display a warning after toggling this variable
-
-    write(login_text, 0, 0)  # Because blocking is enabled when first run, we need to draw the login screen pre-loop
-
-    while True:  # main login loop
-        char = get_key()  # Get key to input into either the username or password field
-
-        if char == 'KEY_UP' or char == 'KEY_DOWN' or char == 'KEY_TAB':  # Switch between username and password fields?
-            current_field = not current_field
-        elif char == 'KEY_ENTER':  # Are we entering credentials?
-            if user_field.value.replace(' ', '') == '':  # Make sure that we aren't entering a blank username
-                enter_username_warning = True
-            else:  # If the username isn't blank, break the loop and go to the chat loop
-                username = user_field.value
-                pass_field = pass_field.value
-                break
-        else:  # Write character to input if not a special character
-            if current_field:  # Current field true = write to password field, false = write to username field
-                user_field.update(char)
-            else:
-                pass_field.update(char)
-
-        write(login_text, 0, 0)  # Write the base of the login window
-        user_field.write(11, 15, current_field)  # Write the username input to it's respective location
-        pass_field.write(11, 16, not current_field)  # Write the password input to it's respective location as well
-
-        if enter_username_warning:
-            write('    You must enter a username!    ', 23, 12)
-
-        stdscr.refresh()
-
-    del current_field  # Cleanup unused variables
-    del user_field
-    del pass_field
-    del enter_username_warning
-
-    stdscr.clear()  # Clear screen for the chat window
-
-    # Chat loop
-
-    chat_input = TextInput(76)  # The input box where the user types and sends messages from
-    chat_messages = []  # The messages to be written with every update. Format = {'user': [username, color], 'msg':msg}
-    listeners = 0  # The amount of listeners currently listening to the podcast
-    marquee_text = u''  # The marquee to be displayed at the bottom of the screen
-    song_marquee_text = u''  # The marquee to be displayed at the top of the screen
-
-    def draw():
+    def register_exception():
         """
-        Function that draws everything to the screen in one fell swoop.
-
-        Notes:
-            This used to be built in to the write thread, but since the write
-            thread has been throttled to keep CPU and I/O low, we need to have
-            this at the top so we can call it from both the text input loop as
-            well as the write thread.
+        Sets has_exception to True and the error_msg to the traceback
         """
+        import traceback
 
-        stdscr.clear()  # Clear the window
+        nonlocal error_msg
+        nonlocal has_exception
 
-        write(chat_text, 0, 0)  # Write the base of the chat window
-        write(marquee_text, 6, 21)  # Write the marquee text to the window
-        write(song_marquee_text, 21, 2)  # Write the song marquee text to the window
-        write(str(volume), 51, 2)  # Write the current volume to the window
-        write(str(listeners).zfill(4), 61, 1)  # Write the amount of listeners to the window
-        write('#' * int(20 * playback_progress), 56, 2)  # Write the percentage of the song completed
-        chat_input.write(2, 19, True)  # Write the chatbox to the window
+        error_msg = traceback.format_exc()
+        has_exception = True
+        scheduler.request()  # Wake the input loop up so it can show the error
 
-        current_message = 0  # Keep count of what message we're on
-        for message in chat_messages:  # Format = {'user': (None | [username, color]), 'msg': msg}
-            write(message['msg'], 1, 17 - current_message)  # Write the message to the screen
+    try:  # Hold all code within a try-catch statement so that errors can be logged upon any crashes
+        # Login loop
 
-            if message['user'] is not None:  # If the username is in the message, write it with it's color
-                write(message['user'][0], 1, 17 - current_message, message['user'][1])
+        stdscr.clear()  # Clears the screen
 
-            current_message += 1
-            if current_message == 13:
-                break
+        username, password = '', ''  # Username and password to be sent with every chat request
+        current_field = True  # Username = True, Password = False
+        user_field = TextInput(18)  # Username field, 18 is the site limit
+        pass_field = TextInput(40)  # Password field (never used by anyone but DJPK?)
+        enter_username_warning = False  # If a blank username is given, it'll display a warning after toggling this
 
-        stdscr.refresh()  # Refresh the window, writing contents to screen
-
-    def marquee_thread():
-        """
-        Constantly fetches and updates the marquee at the bottom of the window
-        """
-        global has_exception
-        global marquee_text
-        global song_marquee_text
-
-        def fetch_broadcast_message():
-                """
-                Fetches the broadcast messsage to be marquee'd at the bottom of the screen
-                """
-                try:
-                    data = requests.request('GET', 'http://jetsetradio.live/messages/messages.xml').content  # Get data
-                    bs = bs4.BeautifulSoup(data, 'html.parser')  # Parse XML data retrieved from the URL
-
-                    msg = bs.find('message').text  # Parse the broadcast message out of the XML data
-                    broadcaster_name = bs.find('avatar').text  # Get the broadcaster's name
-
-                    if broadcaster_name in broadcaster_names:  # Check that there's name for the broadcaster avatar id
-                        msg = broadcaster_names[broadcaster_name] + ': ' + msg  # Replace the id with a name
+        write(login_text, 0, 0)  # Because blocking is enabled when first run, we need to draw the login screen first
+        stdscr.refresh()
+        startup_timer.mark('login screen')
+
+        logged_in = False
+        while not logged_in:  # main login loop
+            for char in get_keys(block=True):  # Keys to input into either field; a paste is drawn once, at the end
+                if char == 'KEY_UP' or char == 'KEY_DOWN' or char == 'KEY_TAB':  # Switch between the two fields?
+                    current_field = not current_field
+                elif char == 'KEY_ENTER':  # Are we entering credentials?
+                    if user_field.value.replace(' ', '') == '':  # Make sure that we aren't entering a blank username
+                        enter_username_warning = True
+                    else:  # If the username isn't blank, break the loop and go to the chat loop
+                        username = user_field.value
+                        pass_field = pass_field.value
+                        startup_timer.mark('logged in')
+                        logged_in = True
+                        break
+                else:  # Write character to input if not a special character
+                    if current_field:  # Current field true = write to password field, false = write to username field
+                        user_field.update(char)
+                    else:
+                        pass_field.update(char)
 
-                    return ' ' * 72 + msg  # Append 72 blank spaces to make it truly act like a marquee
-                except requests.ConnectionError:  # If there is an issue retrieving the message, use a blank string
-                    return ' ' * 72
+            if logged_in:
+                break
 
-        broadcast_message = fetch_broadcast_message()  # The message to be marquee'd at the bottom of the screen
-        marquee_offset = 0  # The offset of which the marquee text is currently at
+            write(login_text, 0, 0)  # Write the base of the login window
+            user_field.write(11, 15, current_field)  # Write the username input to it's respective location
+            pass_field.write(11, 16, not current_field)  # Write the password input to it's respective location too
+
+            if enter_username_warning:
+                write('    You must enter a username!    ', 23, 12)
+
+            stdscr.refresh()
+
+        del current_field  # Cleanup unused variables
+        del user_field
+        del pass_field
+        del enter_username_warning
+
+        client, audio_engine = loader.result()  # Loaded while the user was typing; waits for the rest if it isn't
+        state = client.state  # Everything shown in the chat window; the renderer is notified whenever it changes
+
+        import asyncio
+        from net import BROADCAST_URL, CHAT_URL, LISTENERS_URL
+
+        # The chat window's colors; the login screen has none
+        unicurses.init_pair(1, unicurses.COLOR_BLUE, unicurses.COLOR_BLACK)  # default user color pair
+        unicurses.init_pair(2, unicurses.COLOR_CYAN, unicurses.COLOR_BLACK)  # registered user color pair
+        unicurses.init_pair(3, unicurses.COLOR_YELLOW, unicurses.COLOR_BLACK)  # DJPK color pair
+        unicurses.init_pair(4, unicurses.COLOR_WHITE, unicurses.COLOR_BLACK)  # message being sent color pair
+        unicurses.init_pair(5, unicurses.COLOR_RED, unicurses.COLOR_BLACK)  # message that couldn't be sent color pair
+
+        default_color = unicurses.color_pair(1) | unicurses.A_BOLD  # default user color
+        registered_color = unicurses.color_pair(2) | unicurses.A_BOLD  # registered user color
+        djpk_color = unicurses.color_pair(3) | unicurses.A_BOLD  # DJPK color
+        sending_color = unicurses.color_pair(4)  # color of your messages until they're sent
+        failed_color = unicurses.color_pair(5) | unicurses.A_BOLD  # color of your messages that couldn't be sent
+        role_colors = {'default': default_color, 'registered': registered_color, 'djpk': djpk_color,  # Username colors
+                       'sending': sending_color, 'failed': failed_color}
+
+        chat_text = open('./screens/chat.txt', 'r').read()  # chat text loaded from file
+
+        stdscr.clear()  # Clear screen for the chat window
+        stdscr.refresh()  # From here on the panels draw over it; stdscr itself isn't touched again
+
+        # Chat loop
+
+        chat_input = TextInput(76)  # The input box where the user types and sends messages from
+
+        base_frame = chat_text.split('\n')  # The chat window's frame for an 80x24 terminal, row by row
+        chat_frame = base_frame  # The frame stretched to the terminal's size, to cut the panels' backgrounds from
+        extra_width = extra_height = 0  # How much bigger than 80x24 the terminal is; set by lay_out()
+        chat_width, chat_height = 58, 13  # Columns and lines of the chat panel's text area
+
+        def stretch_frame(width, height):
+            """
+            Stretches the chat window's frame by repeating a column and a row that look the same all the way
+            along: the chat panel gets all of the extra width (the command list keeps its size) and height.
+
+            Args:
+                width (int): Extra columns
+                height (int): Extra rows
+            """
+            rows = []
+            for top, row in enumerate(base_frame):
+                column = 4 <= top <= 18 and 57 or 77  # Inside the chat panel's right border, or near the end
+                rows.append(row[:column] + row[column:column + 1] * width + row[column:])
+            return rows[:15] + rows[14:15] * height + rows[15:]  # Row 14 is an empty line of chat
+
+        def frame(window, top, left, width):
+            """
+            Writes the part of the chat window's frame that a panel covers onto the panel's window
+
+            Args:
+                window (object): The panel's curses window
+                top (int): Screen row of the panel's top
+                left (int): Screen column of the panel's left side
+                width (int): Width of the panel
+            """
+            height, _ = window.getmaxyx()
+            for row in range(height):
+                write(chat_frame[top + row][left:left + width], 0, row, window=window)
+
+        stats_overlay = False  # Whether /stats is showing in place of the chat
+
+        def stats_lines():
+            """
+            Builds the /stats overlay: one line per part of the client, at most 12
+            """
+            def timing(name):
+                histogram = metrics.histogram(name).snapshot()
+                if not histogram['count']:
+                    return '-'
+                return '%.1f/%.1fms' % (histogram['p50_ms'], histogram['p95_ms'])
+
+            lines = ['STATS (p50/p95; /stats to close)   uptime %ds' % (time.time() - metrics.started)]
+
+            urls = {'chat': CHAT_URL, 'listeners': LISTENERS_URL, 'broadcast': BROADCAST_URL}
+            outbox = client.outbox
+            for name, schedule in client.relay_client is None and client.poll_schedules.items() or ():  # Or the relay
+                counters = client.http.stats.get(urls[name], {})
+                lines.append('%-9s %5.1fs %3d%% new  %s  req %d 304s %d' % (
+                    name, schedule.interval, schedule.hit_rate * 100, timing('http.' + urls[name]),
+                    counters.get('requests', 0), counters.get('not_modified', 0)))
+            lines.append('parse     %s  messages %d  bs4 fallbacks %d' % (
+                timing('chat.parse'), metrics.counter('chat.messages').value,
+                metrics.counter('chat.bs4_fallbacks').value))
+            lines.append('send      sent %d  failed %d  pending %d' % (outbox.sent, outbox.failed, len(outbox.pending)))
+            lines.append('render    %s  %d B/s to the terminal' % (timing('render.frame'), renderer.bytes_per_second))
+            ring = audio_engine.ring
+            lines.append('audio     callback %s  decode %s' % (timing('audio.callback'), timing('audio.decode')))
+            if ring is not None:
+                lines.append('buffer    %3d%% full  underruns %d  overruns %d' % (
+                    ring.available * 100 // max(1, ring.capacity), ring.underruns, ring.overruns))
+            if audio_engine.cache is not None:
+                cache = audio_engine.cache.stats
+                lines.append('cache     hits %d  misses %d  evictions %d  %d MB' % (
+                    cache['hits'], cache['misses'], cache['evictions'], cache['bytes'] // (1024 * 1024)))
+            if client.chat_archive is not None:
+                lines.append('archive   written %d  duplicates %d' % (client.chat_archive.written,
+                                                                      client.chat_archive.duplicates))
+            if client.relay_client is not None:
+                lines.append('relay     latency %.1fms' % (client.relay_client.latency * 1000))
+            return lines[:chat_height]
+
+        def draw_header(window):
+            frame(window, 0, 0, 79 + extra_width)
+            write(state.song_marquee_text, 21, 2, window=window)  # Write the song marquee text to the window
+            write(str(state.volume), 51, 2, window=window)  # Write the current volume to the window
+            write(str(state.listeners).zfill(4), 61, 1, window=window)  # Write the amount of listeners to the window
+            write('#' * int(20 * state.playback_progress), 56, 2, window=window)  # Write the percentage played
+
+        def draw_chat(window):
+            frame(window, 4, 0, 60 + extra_width)
+
+            if stats_overlay:  # /stats takes the chat's place until it's closed
+                for row, line in enumerate(stats_lines()):
+                    write(line[:chat_width], 1, 1 + row, window=window)
+                return
+
+            current_message = 0  # Keep count of what message we're on
+            for message in state.chat_messages:  # Format = {'user': (None | [username, color]), 'msg': msg}
+                write(message['msg'], 1, chat_height - current_message, window=window)  # Write the message
+
+                if message['user'] is not None:  # If the username is in the message, write it with it's color
+                    write(message['user'][0], 1, chat_height - current_message, message['user'][1], window)
+
+                current_message += 1
+                if current_message == chat_height:
+                    break
 
-        last_song_name = ''  # The last song name played
-        song_marquee = ' ' * 24 + 'Loading...'  # The song name to be marquee'd at the top of the screen
-        song_marquee_offset = 0  # The offset of which the SONG marquee text is currently at
+        def draw_commands(window):
+            frame(window, 4, 60 + extra_width, 19)
+            if show_render_stats:  # Estimated terminal output, in the blank space under the commands
+                write(' tx %6d B/s' % renderer.bytes_per_second, 0, 8, window=window)
+
+        def draw_input(window):
+            frame(window, 18 + extra_height, 0, 79 + extra_width)
+            chat_input.write(2, 1, True, window=window)  # Write the chatbox to the window
+
+        def draw_broadcast(window):
+            frame(window, 21 + extra_height, 0, 79 + extra_width)
+            write(state.marquee_text, 6, 0, window=window)  # Write the marquee text to the window
+
+        renderer = Renderer()  # Only redraws the panels whose contents changed
+
+        def lay_out():
+            """
+            Sizes the chat window to the terminal and (re)creates its panels; the chat panel takes up whatever's
+            left over from 80x24. Smaller terminals get the 80x24 layout, cut off.
+            """
+            nonlocal chat_frame, extra_width, extra_height, chat_width, chat_height
+
+            rows, columns = stdscr.getmaxyx()
+            extra_width, extra_height = max(0, columns - 80), max(0, rows - 24)
+            chat_frame = stretch_frame(extra_width, extra_height)
+            chat_width, chat_height = 58 + extra_width, 13 + extra_height
+            width = 79 + extra_width
+
+            renderer.reset()
+            renderer.add_panel(4, width, 0, 0, draw_header,
+                               lambda: (state.song_marquee_text, state.volume, state.listeners,
+                                        int(20 * state.playback_progress)))
+            renderer.add_panel(chat_height + 1, chat_width + 2, 4, 0, draw_chat,  # Stats refresh every second
+                               lambda: (state.chat_messages, stats_overlay and int(time.monotonic())))
+            renderer.add_panel(chat_height + 1, 19, 4, chat_width + 2, draw_commands,
+                               lambda: show_render_stats and renderer.bytes_per_second)
+            renderer.add_panel(3, width, chat_height + 5, 0, draw_input,
+                               lambda: (chat_input.value, chat_input.cursor_pos))
+            renderer.add_panel(2, width, chat_height + 8, 0, draw_broadcast, lambda: state.marquee_text)
+
+        lay_out()
+
+        def draw():
+            """
+            Function that draws everything that changed to the screen in one fell swoop.
+
+            Notes:
+                Only ever called from the input loop, which owns the screen; other
+                threads ask for a frame through the scheduler instead, so curses is
+                never used from two threads at once.
+            """
+            renderer.render()
+
+        last_broadcast_message = ' ' * 72  # The latest broadcast message, kept up to date by the broadcast events
+
+        def format_broadcast_message(broadcaster_name, msg):
+            """
+            Turns the broadcaster's avatar id and message into the text marquee'd at the bottom of the screen
+
+            Args:
+                broadcaster_name (str): The broadcaster's avatar id
+                msg (str): The broadcast message
+            """
+            if broadcaster_name in broadcaster_names:  # Check that there's name for the broadcaster avatar id
+                msg = broadcaster_names[broadcaster_name] + ': ' + msg  # Replace the id with a name
+
+            return ' ' * 72 + msg  # Append 72 blank spaces to make it truly act like a marquee
+
+        async def marquee_poller():
+            """
+            Constantly fetches and updates the marquee at the bottom of the window
+            """
+            broadcast_message = last_broadcast_message  # The message to be marquee'd at the bottom of the screen
+            marquee_offset = 0  # The offset of which the marquee text is currently at
+
+            last_song_name = ''  # The last song name played
+            song_marquee = ' ' * 24 + 'Loading...'  # The song name to be marquee'd at the top of the screen
+            song_marquee_offset = 0  # The offset of which the SONG marquee text is currently at
 
-        try:
             while True:
                 marquee_offset = (marquee_offset + 1) % len(broadcast_message)  # Set the marquee over by 1
-                marquee_text = broadcast_message[marquee_offset:marquee_offset + 72]  # Offset marquee text
-
                 song_marquee_offset = (song_marquee_offset + 1) % len(song_marquee)  # Set the song marquee over by 1
-                song_marquee_text = song_marquee[song_marquee_offset:song_marquee_offset + 24]  # Offset marquee text
-
-                if marquee_offset == 0:  # If the marquee is fully read, check if the server has a new one readied
-                    broadcast_message = fetch_broadcast_message()
-
-                if last_song_name != current_song:  # Check to make sure the song name marquee is still valid
-                    song_marquee_offset = 0  # Set the offset to 0
-                    song_marquee = ' ' * 24 + current_song  # Set the current marquee to be the new song
-                    last_song_name = current_song  # ...and set the last song as the new one
-
-                time.sleep(0.1)
-                if has_exception:
-                    break
-        except:
-            register_exception()
-
-    def listener_thread():
-        """
-        Updates the listener count at the top right of the window
-        """
-        global listeners
-
-        try:
-            while True:
-                try:
-                    # Retrieve the listener XML page
-                    data = requests.request('GET', 'http://jetsetradio.live/counter/listeners.xml').content
-                    listeners = data.count(b'<user>')  # The amount of listeners = <user> tags, so we can use count()
-                except requests.ConnectionError:  # Don't do anything when errors occur so as not to reset the counter
-                    pass
 
-                time.sleep(1)
-                if has_exception:
-                    break
-        except:
-            register_exception()
+                state.update(marquee_text=broadcast_message[marquee_offset:marquee_offset + 72 + extra_width],
+                             song_marquee_text=song_marquee[song_marquee_offset:song_marquee_offset + 24])
 
-    def chat_thread():
-        """
-        Constantly retrieves chat messages from jetsetradio.live and places them into chat_messages
-        """
-        global chat_messages
+                # If the marquee is fully read (or still blank from startup), switch to the newest message
+                if marquee_offset == 0 or (not broadcast_message.strip() and last_broadcast_message.strip()):
+                    broadcast_message = last_broadcast_message
+                    marquee_offset = 0
 
-        try:
+                if last_song_name != state.current_song:  # Check to make sure the song name marquee is still valid
+                    song_marquee_offset = 0  # Set the offset to 0
+                    song_marquee = ' ' * 24 + state.current_song  # Set the current marquee to be the new song
+                    last_song_name = state.current_song  # ...and set the last song as the new one
+
+                await asyncio.sleep(0.1)
+
+        def build_lines(message, width):
+            """
+            Splits a chat message into the lines shown in the chat panel, newest line first
+
+            Args:
+                message (chat.ChatMessage): The message to wrap
+                width (int): Columns in the chat panel
+            """
+            chunks = wrap_text(message.user + ': ' + message.text, width)  # Username + the colon, then the message
+            chunks.reverse()  # Reverse it so we go from the back to the front
+
+            lines = [{'user': None, 'msg': chunk} for chunk in chunks]
+            lines[-1]['user'] = [message.user, role_colors[message.role]]  # The first line has the name
+            return lines
+
+        wrapped_lines = LineCache(wrapped_lines_cache_size)
+
+        def wrap_message(message):
+            """
+            Returns a chat message's lines at the chat panel's current width, newest line first. Each message is
+            only wrapped once per width; redraws reuse the lines.
+
+            Args:
+                message (chat.ChatMessage): The message to wrap
+            """
+            return wrapped_lines.get(message, chat_width, build_lines)
+
+        live_chat_view = ChatView(client.chat.history, wrap_message, chat_height)  # The scrollback on screen
+        chat_view = live_chat_view  # What the chat panel shows; /search swaps in the results for a while
+
+        def chat_lines():
+            """
+            Builds the lines of the chat panel, newest line first. Shows the newest messages unless the
+            chat's been scrolled back with PAGE UP, with your messages that are still being sent (or that
+            couldn't be) under them.
+            """
+            lines = []
+            if chat_view is live_chat_view:
+                for message in reversed(list(client.outbox.pending)):  # Copied; the network thread changes it
+                    if message.state == 'failed':
+                        text = '(not sent: %s) %s' % (message.error, message.data['chatmessage'])
+                    else:
+                        text = '(sending) %s' % message.data['chatmessage']
+                    lines.extend(build_lines(ChatMessage(message.data['username'], text,  # Not cached; they change
+                                                         message.state == 'failed' and 'failed' or 'sending', None),
+                                             chat_width))
+            return (lines + chat_view.lines())[:chat_height]
+
+        def on_event(event):
+            """
+            Shows what the client's pollers (or the relay) found; called on the network thread
+            """
+            nonlocal last_broadcast_message
+
+            if event['type'] in ('chat', 'outbox'):  # New messages, or yours went out (or couldn't)
+                state.update(chat_messages=chat_lines())
+            elif event['type'] == 'broadcast':
+                last_broadcast_message = format_broadcast_message(event['avatar'], event['message'])
+            elif event['type'] == 'relay':  # Lost (or got back) the relay, with --connect
+                show_notice(event['connected'] and 'Reconnected to the relay' or 'Lost the relay; reconnecting...')
+
+        async def metrics_ticker():
+            """
+            Redraws the /stats overlay every second while it's open, and writes the --metrics-log snapshots
+            """
+            last_dump = time.monotonic()
             while True:
-                try:
-                    new_messages = []  # The new messages to replace the old ones with
-
-                    data = requests.request('GET', 'http://jetsetradio.live/chat/messages.xml').content  # Retrieve data
-                    bs = bs4.BeautifulSoup(data, 'html.parser')  # and parse it using BeautifulSoup
+                await asyncio.sleep(1)
+                if stats_overlay:
+                    scheduler.request()
+                if args.metrics_log and time.monotonic() - last_dump >= metrics_log_interval:
+                    last_dump = time.monotonic()
+                    await client.loop.run_in_executor(None, metrics.dump, args.metrics_log)  # Off the loop; it's disk
+
+        def song_thread():
+            """
+            Constantly updates the current song / plays it back
+            """
+            try:
+                audio_engine.run()
+            except:
+                register_exception()
 
-                    messages = bs.findAll('message')  # Get all XML tags named 'message'
-                    messages.reverse()  # We reverse it so that we start from the last message and go forward
+        # Stats kept elsewhere, read whenever metrics are shown or logged
+        metrics.enabled = bool(args.metrics_log)  # Otherwise off until /stats
+        client.register_metrics()
+        metrics.gauge('render.bytes_per_second', lambda: renderer.bytes_per_second)
+        metrics.gauge('audio.ring', lambda: audio_engine.ring and {'buffered': audio_engine.ring.available,
+                                                                   'capacity': audio_engine.ring.capacity,
+                                                                   'underruns': audio_engine.ring.underruns,
+                                                                   'overruns': audio_engine.ring.overruns})
+        metrics.gauge('audio.cache', lambda: audio_engine.cache and audio_engine.cache.stats)
 
-                    lines_parsed = 0  # Keep track of how many lines we parse so we can stop at 13
-                    for message in messages:
-                        user = message.find('username').get_text()  # Retrieve username from message
-                        msg = message.find('text').get_text()  # Retrieve actual message from message
+        # The pollers all share one event loop on one thread; audio keeps a thread of its own since decoding blocks
+        client.subscribe(on_event)
+        client.start(marquee_poller(), metrics_ticker(), on_error=register_exception)
+        threading.Thread(target=song_thread, name='audio', daemon=True).start()
 
-                        user_color = default_color  # The color of the user's name
-                        if user == 'DJProfessorK':  # If the user is the Professor himself, change color to yellow
-                            user_color = djpk_color
-                        elif user.find('</font>') != -1:  # If the user is registered, change color to cyan
-                            user_color = registered_color
+        # Input loop; not a thread so that the program will run properly
 
-                        user = re.sub('<[^<]+?>', '', user)  # Remove HTML tags from username and message
-                        msg = re.sub('<[^<]+?>', '', msg)
+        def parse_commands(msg):
+            """
+            Parses commands sent by the user
 
-                        msg = user + ': ' + msg  # Add username + the colon to the message
-                        # Create message chunks of size 58
-                        chunks = [msg[chunk:chunk + 58] for chunk in range(0, len(msg), 58)]
-                        chunks.reverse()  # As from before, reverse it so we go from the back to the front
+            Args:
+                msg (str): The command string to execute
+            """
+            nonlocal stats_overlay
 
-                        current_line = 0  # Keep track so we can add the username if it's the correct line
-                        for chunk in chunks:
-                            message_data = {'user': None, 'msg': chunk}  # Create dict to insert into chat_messages
+            command = msg.split(' ')[0].lower()  # Get the command
+            command_args = msg.split(' ')[1:]  # Get all the args along with the command name
 
-                            current_line += 1
-                            if current_line == len(chunks):  # If the line contains the username, add it to the msg data
-                                message_data['user'] = [user, user_color]
+            if command == 'exit':  # Quit the app
+                audio_engine.stop()  # Stop song
+                client.stop()  # Stop the pollers
+                stdscr.clear()  # Clear screen before exit
+                stdscr.refresh()  # Refresh to load cleared screen
 
-                            new_messages.append(message_data)
+                time.sleep(0.2)  # Give time for song to stop
 
-                            lines_parsed += 1
-                            if lines_parsed == 13:  # Stop parsing messages at line 13
-                                break
+                client.close()  # Write the chat still waiting to be archived
 
-                        chat_messages = new_messages  # replace the old messages with the new ones
-                except requests.ConnectionError:  # Don't delete messages if messages can't be retrieved
+                try:
+                    os.remove('./temp.wav')  # Try to delete tempfile
+                except OSError:
                     pass
 
-                time.sleep(0.5)
-
-                if has_exception:
-                    break
-        except:
-            register_exception()
-
-    def song_thread():
-        """
-        Constantly updates the current song / plays it back
-        """
-        global current_song
-        global has_exception
-        global playback_progress
-
-        try:
-            while True:
-                time.sleep(1)
-                next_song = songs[random.randrange(len(songs))]  # Get a random song from the list
-                play_song(*next_song)  # Play back said song (format [song name, song url])
-
-                if has_exception:
-                    break
-        except:
-            register_exception()
-
-    def write_thread():
-        """
-        Writes the contents of the chat window to the terminal constantly
-        """
-        global has_exception
-
-        try:
-            while True:
-                draw()
-
-                time.sleep(0.1)
-                if has_exception:
-                    break
-        except:
-            register_exception()
-
-    # Create threads
-    thread_1 = threading.Thread(target=marquee_thread, daemon=True)
-    thread_2 = threading.Thread(target=listener_thread, daemon=True)
-    thread_3 = threading.Thread(target=chat_thread, daemon=True)
-    thread_4 = threading.Thread(target=song_thread, daemon=True)
-    thread_5 = threading.Thread(target=write_thread, daemon=True)
-
-    # Run threads
-    thread_1.start()
-    thread_2.start()
-    thread_3.start()
-    thread_4.start()
-    thread_5.start()
-
-    # Input loop; not a thread so that the program will run properly
-
-    def parse_commands(msg):
-        """
-        Parses commands sent by the user
-
-        Args:
-            msg (str): The command string to execute
-        """
-
-        command = msg.split(' ')[0].lower()  # Get the command
-        command_args = msg.split(' ')[1:]  # Get all the args along with the command name
-
-        if command == 'exit':  # Quit the app
-            current_song = 'None'  # Stop song
-            stdscr.clear()  # Clear screen before exit
-            stdscr.refresh()  # Refresh to load cleared screen
-            
-            time.sleep(0.2)  # Give time for song to stop
+                unicurses.endwin()  # Reset terminal back to original state
+                sys.exit()  # Exit the application
+            elif command == 'setvolume':  # Volume change command
+                try:  # Try and parse the argument as a volume and then set said volume
+                    state.update(volume=max(0, min(9, int(command_args[0]))))  # Clamp between 0 and 9
+                except (TypeError, IndexError):
+                    pass
+            elif command == 'skipsong':  # Skip the current song
+                audio_engine.skip()
+            elif command == 'stats':  # Show (or hide) what the client's been up to in place of the chat
+                metrics.enabled = True  # Timings are only recorded from the first /stats on
+                stats_overlay = not stats_overlay
+                scheduler.request()
+            elif command == 'search':  # Search the chat archive; no terms goes back to the live chat
+                search_chat(' '.join(command_args))
+            elif command == 'play':  # Play the best match for a search right now
+                song = find_song(' '.join(command_args))
+                if song is not None:
+                    audio_engine.play_now(song)
+                    show_notice('Playing %s' % song[0])
+            elif command == 'queue':  # Play the best match for a search after the songs already queued
+                if not command_args:  # Just show the queue
+                    show_results([ChatMessage('queue', '%d. %s' % (position + 1, name), 'default', None)
+                                  for position, (name, url) in enumerate(audio_engine.queue)],
+                                 '%d songs queued; /search to go back' % len(audio_engine.queue))
+                    return
+
+                song = find_song(' '.join(command_args))
+                if song is not None:
+                    audio_engine.queue.append(song)
+                    show_notice('Queued %s (%d in the queue)' % (song[0], len(audio_engine.queue)))
+
+        def find_song(query):
+            """
+            Returns the song best matching a search, telling the user if there's none
+
+            Args:
+                query (str): What to search for, as typed after the command
+            """
+            found = client.track_index.search(query, 1)
+            if not found:
+                show_notice('No songs match "%s"' % query)
+                return None
+            return found[0]
+
+        def show_notice(text):
+            """
+            Adds a line from the client itself to the live chat (it's never sent or archived)
+
+            Args:
+                text (str): What to tell the user
+            """
+            def add():
+                client.chat.ingester.add([ChatMessage('*', text, 'registered', None)])
+                state.update(chat_messages=chat_lines())
+
+            client.call_soon(add)  # The chat history's only touched from the network thread
+
+        def show_replay_summary():
+            """
+            Says how the replay went, a notice per line of the summary
+            """
+            for line in client.http.summary().split('\n'):
+                show_notice(line)
+
+        if args.replay:  # Once it's over; the chat window stays up
+            client.http.on_finished = show_replay_summary
+
+        def show_results(messages, summary):
+            """
+            Shows a list of messages in the chat panel in place of the live chat, until /search with no terms
+
+            Args:
+                messages (list): ChatMessages, oldest (top) first
+                summary (str): Shown under them, explaining what they are
+            """
+            nonlocal chat_view
+
+            results = Scrollback(len(messages) + 1)
+            results.extend(messages)
+            results.append(ChatMessage('*', summary, 'registered', None))
+
+            chat_view = ChatView(results, wrap_message, chat_height)
+            state.update(chat_messages=chat_lines())
+
+        def search_chat(terms):
+            """
+            Shows the archived messages matching the search terms in the chat panel, newest at the bottom
+            like the live chat, until /search is used again without any terms
+
+            Args:
+                terms (str): The search terms, as typed after /search
+            """
+            nonlocal chat_view
+
+            if not terms.strip():  # Back to the live chat
+                chat_view = live_chat_view
+                state.update(chat_messages=chat_lines())
+                return
+
+            if client.chat_archive is None:
+                found = []
+                summary = 'the chat archive is turned off (chat_archive_path)'
+            else:
+                found = client.chat_archive.search(terms)
+                summary = '%d messages found for "%s"; PAGE UP for more, /search to go back' % (len(found), terms)
+
+            show_results([ChatMessage(message.user,
+                                      time.strftime('[%m-%d %H:%M] ', time.localtime(seen)) + message.text,
+                                      message.role, message.fingerprint)
+                          for message, seen in reversed(found)],  # Oldest first, so the newest end up at the bottom
+                         summary)
+
+        def resize():
+            """
+            Lays the chat window out again for the terminal's new size. Wrapped lines are kept per width, so
+            only the messages that end up on screen get wrapped for the new one.
+            """
+            if watching_resizes:  # curses didn't get the SIGWINCH, so it doesn't know the new size yet
+                try:
+                    columns, rows = os.get_terminal_size()
+                    unicurses.resize_term(rows, columns)
+                except OSError:
+                    pass
 
-            try:
-                os.remove('./temp.wav')  # Try to delete tempfile
-            except OSError:
-                pass
-                
-            unicurses.endwin()  # Reset terminal back to original state
-            sys.exit()  # Exit the application
-        elif command == 'setvolume':  # Volume change command
-            try:  # Try and parse the argument as a volume and then set said volume
-                global volume
-
-                volume = max(0, min(9, int(command_args[0])))  # Clamp between 0 and 9
-            except (TypeError, IndexError):
-                pass
-        elif command == 'skipsong':  # Skip the current song
-            global current_song
+            lay_out()
+            live_chat_view.resize(chat_height)
+            if chat_view is not live_chat_view:
+                chat_view.resize(chat_height)
 
-            current_song = 'Loading...'  # Since the playback code stops if the current_song's changed, this works
+            stdscr.clear()  # The old layout may be left where the new panels don't reach
+            stdscr.noutrefresh()
+            state.update(chat_messages=chat_lines())
 
-    while True:
-        try:
-            char = get_key()  # Fetch the key to input into the chat textbox
+        def handle_key(char):
+            """
+            Applies a key typed into the chat textbox
 
+            Args:
+                char (str): The key, as returned by get_key()
+            """
             if char == 'KEY_ENTER':  # Send button; once pressed send the input to the server
                 if chat_input.value.replace(' ', '') != '':  # Prevent sending blank messages
                     if chat_input.value[0] == '/':  # Command prefix is '/'
                         parse_commands(chat_input.value[1:])  # Parse the commands without the command prefix
-                    else:
-                        try:
-                            requests.request('POST', 'http://jetsetradio.live/chat/save.php',  # Send message to chat
-                                             data={
-                                                 'chatmessage': chat_input.value, 'username': username,
-                                                 'password': password
-                                             })
-                        except requests.ConnectionError:  # If there's an issue with sending the message, don't retry
-                            pass
+                    else:  # Sent in the background; it shows as '(sending)' in the chat until it's gone through
+                        client.send(chat_input.value, username, password)
 
                     chat_input.value = ''  # Delete the previous message after sending
+            elif char == 'KEY_PPAGE':  # Page up; scroll the chat back
+                chat_view.page_up()
+                state.update(chat_messages=chat_lines())
+            elif char == 'KEY_NPAGE':  # Page down; scroll the chat forward, following new messages again at the bottom
+                chat_view.page_down()
+                state.update(chat_messages=chat_lines())
+            elif char == 'KEY_RESIZE':  # Windows reports resizes as a key; elsewhere the input loop watches SIGWINCH
+                resize()
             elif char == 'KEY_TAB':  # Replace tabs with 4 spaces to prevent input glitches
-                for i in range(4):
-                    chat_input.update(' ')
+                chat_input.insert(' ' * 4)
             else:  # Standard character; add to the current input
                 chat_input.update(char)
 
-            draw()  # Draw the text input instantly
-        except curses_error:  # Prevent crashes simply because of input glitches
-            pass
+        # Input & render loop; the only place the screen is touched from now on. It sleeps until there's a key
+        # to read or a frame to draw, so an idle client doesn't use any CPU.
+        stdscr.nodelay(True)  # The scheduler does the waiting now; get_key() only takes keys that are already there
+        state.subscribe(scheduler.request)  # Every state change asks for a frame; bursts get merged into one
+        watching_resizes = scheduler.watch_resizes()  # Lay the window out again when the terminal's resized
+        scheduler.request()
 
-        if has_exception:
-            break
+        while True:
+            try:
+                if scheduler.wait(sys.stdin.fileno()):
+                    keys = get_keys()  # Every key waiting (curses may have read some ahead of what select() sees)
+                    if keys:
+                        apply_keys(keys, chat_input, handle_key)
+                        scheduler.request(immediate=True)  # Draw the text input instantly, once for the whole batch
+
+                if scheduler.resized():
+                    resize()
+
+                if scheduler.frame_due():
+                    draw()
+                    scheduler.frame_drawn()
+            except curses_error:  # Prevent crashes simply because of input glitches
+                pass
 
-except KeyboardInterrupt:  # CTRL+C
-    pass
-except SystemExit:  # /exit
-    pass
-except:  # unexpected shutdown
-    register_exception()
+            if has_exception:
+                break
+
+    except KeyboardInterrupt:  # CTRL+C
+        pass
+    except SystemExit:  # /exit
+        pass
+    except:  # unexpected shutdown
+        register_exception()
 
-if has_exception:  # If an exception occurs, print how to get help debugging the client
+    if has_exception:  # If an exception occurs, print how to get help debugging the client
 
-    current_song = 'None'  # Stop the current song
+        if audio_engine is not None:  # Not if it failed to load
+            audio_engine.stop()  # Stop the current song
 
-    logfile = open('./errorlog.txt', 'w')  # Create errorlog.txt in the working directory to write the exception to
-    logfile.write(error_msg)  # Writes the exception traceback to the file...
-    logfile.close()  # ...and then closes it, saving it
+        logfile = open('./errorlog.txt', 'w')  # Create errorlog.txt in the working directory to write the exception to
+        logfile.write(error_msg)  # Writes the exception traceback to the file...
+        logfile.close()  # ...and then closes it, saving it
 
-    stdscr.clear()  # Clear the screen to print the error message
+        stdscr.clear()  # Clear the screen to print the error message
 
-    unicurses.beep()  # Attempt to make a beep; may not be possible on Linux without the pcspkr driver loaded
+        unicurses.beep()  # Attempt to make a beep; may not be possible on Linux without the pcspkr driver loaded
 
-    # Write a message stating how to get help with debugging for those who aren't programmers
-    write('Fatal error occured: please send errorlog.txt to bb via pqlime@gmail.com', 0, 0)
-    write('Press any key to exit.', 0, 1)
-    stdscr.refresh()
+        # Write a message stating how to get help with debugging for those who aren't programmers
+        write('Fatal error occured: please send errorlog.txt to bb via pqlime@gmail.com', 0, 0)
+        write('Press any key to exit.', 0, 1)
+        stdscr.refresh()
 
-    get_key()  # Wait for key
-    os.remove('./temp.wav')  # Remove the temporary song file
+        stdscr.nodelay(False)  # The input loop may have left input non-blocking
+        get_key()  # Wait for key
+        try:
+            os.remove('./temp.wav')  # Remove the temporary song file (only exists when stream_audio is off)
+        except OSError:
+            pass
 
-unicurses.endwin()  # Returns the terminal to it's original state
+    unicurses.endwin()  # Returns the terminal to it's original state
+
+
+def main():
+    launch_dir = os.getcwd()  # Where paths given on the command line are relative to
+    os.chdir(os.path.dirname(os.path.realpath(__file__)))  # Changes working directory to the script's parent directory
+
+    startup_timer = startup.StartupTimer()  # When each step of startup happened, for --startup-report
+    startup_timer.mark('main.py imported')  # The interpreter's started and what the login screen needs is loaded
+
+    # Command line
+
+    arguments = argparse.ArgumentParser(description='Jet Set Radio Live (jetsetradio.live) CLI chat application')
+    arguments.add_argument('--relay', nargs='?', const=relay_address, metavar='ADDRESS',
+                           help='poll jetsetradio.live once for any number of local clients, listening on a Unix '
+                                'socket path or host:port (default: %s); runs without the chat window'
+                                % relay_address)
+    arguments.add_argument('--connect', nargs='?', const=relay_address, metavar='ADDRESS',
+                           help='get chat, listeners, broadcasts and the tracklist from a relay instead of polling '
+                                'jetsetradio.live (default: %s)' % relay_address)
+    arguments.add_argument('--headless', action='store_true',
+                           help='run without the chat window, writing chat, listener counts and broadcasts to '
+                                'stdout as JSON lines')
+    arguments.add_argument('--username', metavar='NAME',
+                           help='with --headless: send every line read from stdin as chat from NAME')
+    arguments.add_argument('--audio', action='store_true', help='with --headless: play music too')
+    arguments.add_argument('--startup-report', action='store_true',
+                           help='print how long startup took (to the login screen, to the first audio, ...) and '
+                                'what the imports cost to stderr on exit')
+    arguments.add_argument('--metrics-log', metavar='FILE',
+                           help='record timings and counters (see /stats) and append them to FILE as JSON lines')
+    arguments.add_argument('--profile', nargs='?', const='profile', metavar='DIR',
+                           help='sample every thread\'s stack while running and write flame graph input (collapsed '
+                                'stacks, one file per thread) to DIR on exit (default: ./profile)')
+    arguments.add_argument('--record', metavar='FILE',
+                           help='record everything jetsetradio.live sends (chat, listeners, broadcasts, the '
+                                'tracklist) to FILE, to play back later with --replay')
+    arguments.add_argument('--replay', metavar='FILE',
+                           help='take chat, listeners, broadcasts and the tracklist from a file made with --record '
+                                'instead of jetsetradio.live, and print how it went on exit')
+    arguments.add_argument('--replay-speed', type=float, default=1, metavar='N',
+                           help='with --replay: play it back N times faster than it was recorded; 0 = as fast as '
+                                'the client can take it (default: 1)')
+    args = arguments.parse_args()
+    if args.replay and (args.record or args.connect):
+        arguments.error('--replay can\'t be used with --record or --connect')
+    args.record = args.record and os.path.join(launch_dir, args.record)  # Relative to where the client was started
+    args.replay = args.replay and os.path.join(launch_dir, args.replay)
+
+    sampler = None
+    if args.profile:
+        import profiler
+
+        threading.current_thread().name = args.relay and 'relay' or args.headless and 'headless' or 'input'
+        sampler = profiler.SamplingProfiler()
+        sampler.start()
+    try:
+        run(args, startup_timer)
+    finally:
+        if args.startup_report:
+            print(startup_timer.report(), file=sys.stderr)  # Not stdout, where --headless writes its events
+        if sampler is not None:
+            sampler.stop()
+            paths = sampler.write(os.path.join(launch_dir, args.profile))
+            print(sampler.summary(), file=sys.stderr)  # Not stdout, where --headless writes its events
+            print('Collapsed stacks written to %s' % ', '.join(paths), file=sys.stderr)
+
+
+def load_client(args, http, poll_intervals, startup_timer):
+    """
+    Imports the client's core and makes the client, and the audio engine unless it's a headless client without
+    music. The chat window has this done in the background while the login screen's up; see run().
+
+    Args:
+        args (argparse.Namespace): The command line
+        http (net.HttpClient): What the client polls through; None = a new net.HttpClient
+        poll_intervals (dict): 'chat', 'listeners' and 'broadcast' -> the poller's (min, max) seconds between polls
+        startup_timer (startup.StartupTimer): Told what the imports cost and when the client's ready
+
+    Returns:
+        tuple: (client.Client, client.AudioEngine or None)
+    """
+    # The biggest first, so each one's cost in --startup-report is its own: requests and asyncio are most of it
+    startup_timer.load('requests', 'asyncio', 'sqlite3', 'net', 'tracks', 'audio', 'archive', 'client')
+    import archive
+    import audio
+    from client import AudioEngine, Client
+    from tracks import TracklistCache
+
+    # Headless clients skip the archive (many of them can share a folder) and the tracklist unless they play
+    # music; replays skip the archive too, it's chat that's been seen before
+    client = Client(http=http, relay_address=args.connect, chat_history_size=chat_history_size,
+                    chat_archive=not args.headless and not args.replay and chat_archive_path
+                    and archive.ChatArchive(chat_archive_path) or None,
+                    tracklist_cache=(not args.headless or args.audio) and TracklistCache(tracklist_cache_path)
+                    or None,
+                    chat_poll_intervals=poll_intervals['chat'], listener_poll_intervals=poll_intervals['listeners'],
+                    broadcast_poll_intervals=poll_intervals['broadcast'], startup_timer=startup_timer)
+    audio_engine = None  # Plays music on a thread of its own
+    if not args.headless or args.audio:
+        audio_engine = AudioEngine(client.http, client.state, lambda: client.songs, stream_audio, prefetch_depth,
+                                   prefetch_budget, audio_buffer_seconds,
+                                   cache_kind and audio.AudioCache(cache_dir, cache_max_bytes, cache_kind) or None,
+                                   client.publish, startup_timer)
+
+        def prepare_audio():
+            if audio_engine.prepare() is not None:
+                startup_timer.mark('audio ready')
+
+        startup.Background(prepare_audio, 'portaudio')  # Up before the first song is; nothing else waits on it
+    startup_timer.mark('client ready')
+    return client, audio_engine
+
+
+def run(args, startup_timer):
+    """
+    Runs the client in the mode the command line asks for (relay, headless or the chat window)
+    """
+    http = None  # Made by the Client (or the relay) unless recording or replaying
+    poll_intervals = {'chat': chat_poll_intervals, 'listeners': listener_poll_intervals,
+                      'broadcast': broadcast_poll_intervals}
+    if args.replay:
+        import capture
+
+        metrics.enabled = True  # Parse and frame timings for the summary at the end
+        http = capture.ReplayHttpClient(args.replay, args.replay_speed)
+        poll_intervals = {name: capture.scale_intervals(intervals, args.replay_speed)
+                          for name, intervals in poll_intervals.items()}
+    elif args.record:
+        import capture
+        from net import HttpClient
+
+        http = HttpClient(recorder=capture.Recorder(args.record))
+
+    try:
+        if args.relay:  # Relay mode has no chat window, so it's over before the screen gets set up
+            import relay
+
+            if args.replay:  # The relay keeps serving its clients after that
+                http.on_finished = lambda: print(http.summary(), file=sys.stderr)
+            relay.run_relay(args.relay, http=http, poll_intervals=poll_intervals)
+        elif args.headless:
+            import headless
+
+            client, audio_engine = load_client(args, http, poll_intervals, startup_timer)
+            if args.replay:  # Done once everything's been replayed
+                http.on_finished = client.stop
+            headless.run_headless(client, audio_engine, args.username, metrics_log=args.metrics_log,
+                                  metrics_log_interval=metrics_log_interval)
+        else:  # Nothing but the login screen's needed until the user's logged in, so the rest loads meanwhile
+            run_ui(args, startup.Background(lambda: load_client(args, http, poll_intervals, startup_timer)),
+                   startup_timer)
+    finally:
+        if args.replay:
+            print(http.summary(), file=sys.stderr)  # Not stdout, where --headless writes its events
+        elif args.record:
+            http.recorder.close()
+            print('Recorded %d responses to %s' % (http.recorder.records, args.record), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+"""
+Metrics for the jetsetradio.live CLI client.
+
+Counters and latency histograms for the pollers, the chat parser, the
+renderer and the audio path, all kept in one registry so they can be shown
+by /stats or dumped to a JSON-lines file. Until the registry is enabled,
+recording something costs a single attribute check.
+"""
+
+import json
+import threading
+import time
+
+
+class Counter(object):
+    def __init__(self, registry):
+        self.__registry = registry
+        self.__lock = threading.Lock()
+        self.value = 0
+
+    def add(self, amount=1):
+        if self.__registry.enabled:
+            with self.__lock:
+                self.value += amount
+
+
+class Histogram(object):
+    BUCKETS = 26  # Bucket n holds durations under 2**n microseconds; the last one has everything longer (> 33 s)
+
+    def __init__(self, registry):
+        """
+        Latency histogram with power-of-two buckets: recording is a bit_length() and an increment,
+        and percentiles come out accurate to within a factor of two, which is plenty to see where
+        time goes
+        """
+        self.__registry = registry
+        self.__lock = threading.Lock()
+        self.__buckets = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0  # Seconds
+        self.max = 0.0
+
+    def observe(self, seconds):
+        if not self.__registry.enabled:
+            return
+        bucket = min(self.BUCKETS - 1, int(seconds * 1000000).bit_length())
+        with self.__lock:
+            self.__buckets[bucket] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def percentile(self, fraction):
+        """
+        Returns (an upper bound of) the duration 'fraction' of the recorded ones were under, in seconds
+
+        Args:
+            fraction (float): 0.5 for the median, 0.95 for the 95th percentile, ...
+        """
+        with self.__lock:
+            wanted = fraction * self.count
+            seen = 0
+            for bucket, count in enumerate(self.__buckets):
+                seen += count
+                if count and seen >= wanted:
+                    return min(self.max, 2 ** bucket / 1000000)
+        return 0.0
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean_ms': self.count and round(self.total / self.count * 1000, 3) or 0,
+            'p50_ms': round(self.percentile(0.5) * 1000, 3),
+            'p95_ms': round(self.percentile(0.95) * 1000, 3),
+            'max_ms': round(self.max * 1000, 3),
+        }
+
+
+class _Timer(object):
+    __slots__ = ('histogram', 'started')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_TIMER = _NullTimer()  # Handed out while the registry's disabled, so timing costs nothing
+
+
+class Registry(object):
+    def __init__(self, enabled=False):
+        """
+        Every counter and histogram, by name. Names are dotted: 'area.what', e.g. 'render.frame'.
+
+        Args:
+            enabled (bool): Whether to record anything yet
+        """
+        self.enabled = enabled
+        self.__lock = threading.Lock()
+        self.__counters = {}
+        self.__histograms = {}
+        self.__gauges = {}  # name -> function returning the value when a snapshot is taken
+        self.started = time.time()
+
+    def counter(self, name):
+        with self.__lock:
+            if name not in self.__counters:
+                self.__counters[name] = Counter(self)
+            return self.__counters[name]
+
+    def histogram(self, name):
+        with self.__lock:
+            if name not in self.__histograms:
+                self.__histograms[name] = Histogram(self)
+            return self.__histograms[name]
+
+    def timer(self, name):
+        """
+        Context manager recording how long its block takes into histogram 'name'
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self.histogram(name))
+
+    def gauge(self, name, read):
+        """
+        Registers a value that's read whenever a snapshot is taken (e.g. stats something else keeps)
+
+        Args:
+            name (str): The gauge's name
+            read (function): Returns the value; anything json can dump
+        """
+        with self.__lock:
+            self.__gauges[name] = read
+
+    def snapshot(self):
+        """
+        Returns every metric as a dict that json can dump
+        """
+        with self.__lock:
+            counters = dict(self.__counters)
+            histograms = dict(self.__histograms)
+            gauges = dict(self.__gauges)
+
+        snapshot = {'time': time.time(), 'uptime': round(time.time() - self.started, 1)}
+        snapshot.update((name, counter.value) for name, counter in sorted(counters.items()))
+        snapshot.update((name, histogram.snapshot()) for name, histogram in sorted(histograms.items()))
+        for name, read in sorted(gauges.items()):
+            try:
+                snapshot[name] = read()
+            except Exception as error:  # A gauge breaking mustn't take the snapshot (or the client) down with it
+                snapshot[name] = repr(error)
+        return snapshot
+
+    def dump(self, path):
+        """
+        Appends a snapshot to a JSON-lines file
+
+        Args:
+            path (str): The file to append to
+        """
+        line = json.dumps(self.snapshot(), default=str)
+        with open(path, 'a') as dump:
+            dump.write(line + '\n')
+
+
+registry = Registry()  # The client's metrics; enabled by /stats or --metrics-log
@@ -0,0 +1,357 @@
+"""
+Networking for the jetsetradio.live CLI client.
+
+One requests.Session with keep-alive is shared by the whole client. requests
+has no asyncio API, so the pollers await its blocking calls on a small
+executor instead of each holding a thread of their own. Every request made
+for them times out (TIMEOUT), so a stalled connection can only hold up one
+of the executor's threads for so long.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import hashlib
+import os
+import random
+import requests
+import threading
+
+from metrics import registry as metrics
+
+
+# jetsetradio.live endpoints; JSRL_BASE_URL points them somewhere else (e.g. benchmarks/mock_server.py)
+
+BASE_URL = os.environ.get('JSRL_BASE_URL', 'http://jetsetradio.live').rstrip('/')
+CHAT_URL = BASE_URL + '/chat/messages.xml'  # The latest chat messages
+SEND_URL = BASE_URL + '/chat/save.php'  # Where chat messages are POSTed
+LISTENERS_URL = BASE_URL + '/counter/listeners.xml'  # One <user> per listener
+BROADCAST_URL = BASE_URL + '/messages/messages.xml'  # The broadcast message for the 'BCST' bar
+TRACKLIST_URL = BASE_URL + '/audioplayer/audio/~list.js'  # Every song the radio plays
+SONG_URL = BASE_URL + '/audioplayer/audio/%s.mp3'  # A song's mp3, by name
+
+CONDITIONAL_HEADERS = ('If-None-Match', 'If-Modified-Since')  # Headers asking "has this changed?"
+TIMEOUT = 10  # Seconds requests wait for the server (to connect, and between bytes) before giving up
+
+
+class HttpClient(object):
+    def __init__(self, workers=4, recorder=None):
+        """
+        Shared HTTP client for the pollers (async) and everything else (sync)
+
+        Args:
+            workers (int): How many requests the pollers can have in flight at once; one each for the three
+                pollers and the outbox by default, so one endpoint stalling doesn't queue up the others
+            recorder (capture.Recorder): Gets every new poll response and every fetched GET; None = not recorded
+        """
+
+        self.session = requests.Session()  # Pooled keep-alive connections to jetsetradio.live (gzip by default)
+        self.__executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix='http')
+        self.__validators = {}  # url -> headers to send next time to ask "has this changed?"
+        self.__hashes = {}  # url -> hash of the last body poll() returned
+        self.__stats = collections.defaultdict(lambda: {'requests': 0, 'bytes': 0, 'not_modified': 0, 'unchanged': 0,
+                                                        'errors': 0})
+        self.__stats_lock = threading.Lock()
+        self.recorder = recorder
+
+    @property
+    def stats(self):
+        """
+        Per-URL counters: requests sent, body bytes received (compressed size when gzipped),
+        304 Not Modified answers, 200 answers identical to the previous one and error answers (4xx/5xx)
+        """
+        with self.__stats_lock:
+            return {url: dict(counters) for url, counters in self.__stats.items()}
+
+    def __count(self, url, response, **extra):
+        """
+        Adds a response to the stats of 'url'
+
+        Args:
+            url (str): URL the request was for (without the query string, so the stats stay grouped)
+            response (requests.Response): The response received
+            **extra: Other counters to bump by 1
+        """
+        received = response.headers.get('Content-Length')  # Size on the wire; the body we get is decompressed
+        with self.__stats_lock:
+            counters = self.__stats[url.split('?')[0]]
+            counters['requests'] += 1
+            counters['bytes'] += int(received) if received else len(response.content or b'')
+            for name in extra:
+                counters[name] += 1
+
+    def request(self, method, url, **kwargs):
+        """
+        Blocking request over the shared session, same arguments as requests.request()
+        """
+        response = self.session.request(method, url, **kwargs)
+        if not kwargs.get('stream'):  # Streamed bodies (songs) aren't downloaded yet, so there's nothing to count
+            self.__count(url, response)
+        return response
+
+    async def fetch(self, method, url, **kwargs):
+        """
+        Request over the shared session without blocking the event loop, same arguments as requests.request();
+        times out after TIMEOUT seconds unless given a timeout. While recording, GETs aren't conditional, and
+        only successful ones are recorded.
+        """
+        kwargs.setdefault('timeout', TIMEOUT)
+        recording = self.recorder is not None and method == 'GET'
+        if recording:  # Ask for the whole body (the cached tracklist's validators would get a bodiless 304)
+            kwargs['headers'] = {name: value for name, value in (kwargs.get('headers') or {}).items()
+                                 if name not in CONDITIONAL_HEADERS}
+        loop = asyncio.get_running_loop()
+        with metrics.timer('http.' + url.split('?')[0]):
+            response = await loop.run_in_executor(self.__executor, functools.partial(self.session.request, method,
+                                                                                     url, **kwargs))
+        self.__count(url, response)
+        if recording and 200 <= response.status_code < 300:  # A replay serves the first one; it has to be content
+            self.recorder.record('fetch', url, response)
+        return response
+
+    async def poll(self, url):
+        """
+        GETs a URL that's fetched over and over, asking the server to skip the body if nothing changed
+        since last time (If-None-Match / If-Modified-Since)
+
+        Args:
+            url (str): URL to poll
+
+        Returns:
+            bytes: The new body, or None if it's the same as the one returned last time
+
+        Raises:
+            requests.RequestException: The request failed, timed out (after TIMEOUT seconds) or got an error
+                status back (requests.HTTPError); nothing about the response is remembered then
+        """
+        loop = asyncio.get_running_loop()
+        with metrics.timer('http.' + url):
+            response = await loop.run_in_executor(self.__executor, functools.partial(
+                self.session.request, 'GET', url, headers=self.__validators.get(url, {}), timeout=TIMEOUT))
+
+        if response.status_code == 304:  # The server says it hasn't changed
+            self.__count(url, response, not_modified=True)
+            return None
+        if not 200 <= response.status_code < 300:  # An error page isn't the content; keep the validators and hash
+            self.__count(url, response, errors=True)
+            raise requests.HTTPError('HTTP %d from %s' % (response.status_code, url), response=response)
+
+        validators = {}  # Remember whatever the server gave us to validate against next time
+        if 'ETag' in response.headers:
+            validators['If-None-Match'] = response.headers['ETag']
+        if 'Last-Modified' in response.headers:
+            validators['If-Modified-Since'] = response.headers['Last-Modified']
+        self.__validators[url] = validators
+
+        body_hash = hashlib.sha1(response.content).digest()  # Servers without validators still send the same body
+        if self.__hashes.get(url) == body_hash:
+            self.__count(url, response, unchanged=True)
+            return None
+
+        self.__hashes[url] = body_hash
+        self.__count(url, response)
+        if self.recorder is not None:
+            self.recorder.record('poll', url, response)
+        return response.content
+
+    def close(self):
+        self.__executor.shutdown(wait=False)
+        self.session.close()
+
+
+class PollSchedule(object):
+    def __init__(self, min_interval, max_interval, target=0.5, smoothing=0.3, backoff=2, jitter=0.2):
+        """
+        Decides how long a poller waits between polls of one endpoint, from how often it's been changing
+        lately: the interval's set so about 'target' of the polls find something new, so busy endpoints get
+        polled fast and quiet ones less and less. Failing endpoints are backed off from.
+
+        Args:
+            min_interval (float): Seconds between polls while the endpoint is busy
+            max_interval (float): The longest it'll wait between polls
+            target (float): Fraction of polls that should find something new
+            smoothing (float): How much each poll counts towards the recent averages (0-1; higher reacts faster)
+            backoff (float): What the interval is multiplied by after every failed poll
+            jitter (float): +/- fraction of randomness added to each wait so pollers don't line up
+        """
+        self.__min_interval = min_interval
+        self.__max_interval = max_interval
+        self.__target = target
+        self.__smoothing = smoothing
+        self.__backoff = backoff
+        self.__jitter = jitter
+        self.__seconds = min_interval  # Recent average seconds between polls
+        self.hit_rate = target  # Recent average of the polls that found something new (1) or not (0)
+        self.interval = min_interval  # Current seconds between polls, before jitter
+        self.polls = 0
+        self.changes = 0
+        self.errors = 0
+
+    def record(self, changed=False, error=False):
+        """
+        Updates the interval after a poll
+
+        Args:
+            changed (bool): The poll found something new
+            error (bool): The poll failed
+        """
+        self.polls += 1
+        if error:  # Says nothing about how often it changes; just ease off
+            self.errors += 1
+            self.interval = min(self.__max_interval, self.interval * self.__backoff)
+            return
+
+        self.changes += changed
+        self.__seconds += self.__smoothing * (self.interval - self.__seconds)
+        self.hit_rate += self.__smoothing * (changed - self.hit_rate)
+        # Changes per second = hit_rate / seconds; a quiet spell counts as one poll's worth of a change
+        self.interval = self.__target * self.__seconds / max(self.hit_rate, self.__smoothing)
+        self.interval = max(self.__min_interval, min(self.__max_interval, self.interval))
+
+    def delay(self):
+        """
+        Seconds to wait before the next poll, with jitter (never outside min_interval to max_interval)
+        """
+        delay = self.interval * random.uniform(1 - self.__jitter, 1 + self.__jitter)
+        return max(self.__min_interval, min(self.__max_interval, delay))
+
+    async def wait(self):
+        await asyncio.sleep(self.delay())
+
+    @property
+    def stats(self):
+        return {'interval': round(self.interval, 2), 'hit_rate': round(self.hit_rate, 3), 'polls': self.polls,
+                'changes': self.changes, 'errors': self.errors}
+
+
+class OutgoingMessage(object):
+    __slots__ = ('data', 'state', 'attempts', 'error')
+
+    def __init__(self, data):
+        """
+        A POST waiting in an Outbox
+
+        Args:
+            data (dict): The form fields to send
+        """
+        self.data = data
+        self.state = 'queued'  # 'queued', 'sending' (tried at least once) or 'failed' (gave up)
+        self.attempts = 0
+        self.error = None  # Why the last attempt failed
+
+
+class Outbox(object):
+    def __init__(self, http, url, attempts=4, backoff=1.0, max_backoff=8.0, keep_failed=30.0, on_change=None):
+        """
+        Sends POSTs (chat messages) one at a time, in the order they were put in, from the event loop,
+        so whoever puts them in never waits on the network. Failed sends are retried with a growing
+        delay; a message that still can't be sent is marked failed and the next one goes out.
+
+        Args:
+            http (HttpClient): The client to send with (or anything with its fetch(), like relay.RelayClient)
+            url (str): Where to POST to
+            attempts (int): Tries per message before giving up on it
+            backoff (float): Seconds to wait before the first retry; doubled every retry after
+            max_backoff (float): The longest wait between retries
+            keep_failed (float): Seconds failed messages stay in 'pending' (so they can be shown) before being dropped
+            on_change (function): Called from the event loop whenever 'pending' changes
+        """
+        self.__http = http
+        self.__url = url
+        self.__attempts = attempts
+        self.__backoff = backoff
+        self.__max_backoff = max_backoff
+        self.__keep_failed = keep_failed
+        self.__on_change = on_change or (lambda: None)
+        self.__queue = collections.deque()  # Messages not sent yet; appended from any thread, popped by run()
+        self.__loop = None
+        self.__wakeup = None
+        self.pending = []  # Queued, sending and recently failed messages, oldest first; only changed on the loop
+        self.sent = 0
+        self.failed = 0
+
+    def put(self, data):
+        """
+        Queues a POST; safe to call from any thread and never blocks
+
+        Args:
+            data (dict): The form fields to send
+
+        Returns:
+            OutgoingMessage: The queued message
+        """
+        message = OutgoingMessage(data)
+        self.__queue.append(message)
+        if self.__loop is not None:
+            self.__loop.call_soon_threadsafe(self.__queued, message)
+        return message
+
+    def __queued(self, message):
+        if message in self.__queue:  # Not already picked up by run()
+            self.pending.append(message)
+            self.__on_change()
+        self.__wakeup.set()
+
+    def __remove(self, message):
+        if message in self.pending:
+            self.pending.remove(message)
+            self.__on_change()
+
+    async def __send(self, message):
+        """
+        Tries to send a message until it goes through or runs out of attempts
+
+        Returns:
+            bool: Whether it was sent
+        """
+        delay = self.__backoff
+        while True:
+            message.attempts += 1
+            try:
+                response = await self.__http.fetch('POST', self.__url, data=message.data)
+                if response.status_code < 500:  # Sent; a 4xx won't go any better by retrying either
+                    if response.status_code < 400:
+                        return True
+                    message.error = 'HTTP %d' % response.status_code
+                    return False
+                message.error = 'HTTP %d' % response.status_code
+            except requests.RequestException as error:
+                message.error = type(error).__name__
+
+            if message.attempts >= self.__attempts:
+                return False
+            await asyncio.sleep(delay * random.uniform(0.8, 1.2))  # Jittered so clients don't all retry together
+            delay = min(delay * 2, self.__max_backoff)
+
+    async def run(self):
+        """
+        Sends everything put in the outbox, forever
+        """
+        self.__loop = asyncio.get_running_loop()
+        self.__wakeup = asyncio.Event()
+        self.pending.extend(message for message in self.__queue if message not in self.pending)  # Put before run()
+        if self.pending:
+            self.__on_change()
+
+        while True:
+            while not self.__queue:
+                self.__wakeup.clear()
+                await self.__wakeup.wait()
+
+            message = self.__queue[0]
+            if message not in self.pending:
+                self.pending.append(message)
+            message.state = 'sending'
+            self.__on_change()
+
+            sent = await self.__send(message)
+            self.__queue.popleft()  # Only now, so nothing queued after it can go out before it
+            if sent:
+                self.sent += 1
+                self.__remove(message)
+            else:
+                self.failed += 1
+                message.state = 'failed'
+                self.__on_change()
+                self.__loop.call_later(self.__keep_failed, self.__remove, message)
@@ -0,0 +1,174 @@
+"""
+Sampling profiler for the jetsetradio.live CLI client (--profile).
+
+cProfile only sees the thread it's started on, and most of the client's work
+happens on the others (network, audio, http, archive...). This samples every
+thread's Python stack a few hundred times a second from a thread of its own
+and, on exit, writes one file of collapsed stacks per thread role:
+
+    <dir>/network.folded
+    <dir>/audio.folded
+    <dir>/input.folded
+    ...
+
+One line per distinct stack, 'outermost;...;innermost weight', which
+flamegraph.pl, speedscope and most other flame graph tools read as is.
+Threads with the same role (http_0 and http_1, one ffmpeg feeder per song)
+are added together.
+
+Where threads' CPU clocks can be read (Linux), a stack's weight is the CPU
+time in microseconds its thread used since the previous sample, so threads
+waiting on the network or the sound card don't show up at all. Elsewhere
+every sample counts as 1 (wall clock).
+"""
+
+import collections
+import os
+import re
+import sys
+import threading
+import time
+
+
+def thread_role(name):
+    """
+    Turns a thread's name into the name of its role: 'http_1' -> 'http', 'Thread-3 (load)' -> 'load'
+    """
+    match = re.match(r'Thread-\d+ \((.*)\)$', name)  # Unnamed threads are named after their target
+    if match:
+        name = match.group(1)
+    return re.sub(r'[_-]\d+$', '', name).strip('_') or 'thread'
+
+
+def frame_label(code):
+    return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class SamplingProfiler(object):
+    def __init__(self, interval=0.005, cpu_time=True):
+        """
+        Samples every thread's stack every 'interval' seconds, once started
+
+        Args:
+            interval (float): Seconds between samples
+            cpu_time (bool): Weigh samples by the CPU time each thread used (where that can be read)
+        """
+        self.__interval = interval
+        self.__cpu_time = cpu_time and hasattr(time, 'pthread_getcpuclockid')
+        self.__stacks = collections.defaultdict(collections.Counter)  # role -> (code objects, outermost 1st) -> weight
+        self.__cpu_clocks = {}  # thread ident -> (clock id, CPU seconds at the last sample)
+        self.__stopped = threading.Event()
+        self.__thread = None
+        self.samples = 0
+        self.started = None
+        self.stopped = None
+
+    @property
+    def cpu_time(self):  # Whether the weights are CPU microseconds (True) or samples (False)
+        return self.__cpu_time
+
+    def start(self):
+        self.started = time.monotonic()
+        self.__thread = threading.Thread(target=self.__run, name='profiler', daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.stopped = time.monotonic()
+        self.__stopped.set()
+        if self.__thread is not None:
+            self.__thread.join()
+
+    def __weight(self, ident):
+        """
+        Returns how much a sample of thread 'ident' counts for: the CPU microseconds it's used since the last
+        sample, or 1 without CPU clocks
+        """
+        if not self.__cpu_time:
+            return 1
+
+        clock, last = self.__cpu_clocks.get(ident, (None, None))
+        try:
+            if clock is None:
+                clock = time.pthread_getcpuclockid(ident)
+            used = time.clock_gettime(clock)
+        except (OSError, OverflowError):  # The thread's gone (or isn't a pthread)
+            self.__cpu_clocks.pop(ident, None)
+            return 0
+        self.__cpu_clocks[ident] = (clock, used)
+        if last is None:  # First time this thread's seen; what it used before can't be pinned on this stack
+            return 0
+        return int((used - last) * 1000000)
+
+    def __run(self):
+        own = threading.get_ident()
+        while not self.__stopped.wait(self.__interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                weight = self.__weight(ident)
+                if not weight:  # Idle since the last sample
+                    continue
+
+                stack = []
+                while frame is not None:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                stack.reverse()
+
+                name = names.get(ident) or 'native (%s)' % stack[0].co_name  # E.g. PyAudio's callback thread
+                self.__stacks[thread_role(name)][tuple(stack)] += weight
+            self.samples += 1
+
+    def collapsed(self):
+        """
+        Returns {role: collapsed stack lines} for everything sampled so far
+        """
+        labels = {}  # code object -> label; there aren't many distinct ones
+        result = {}
+        for role, stacks in list(self.__stacks.items()):
+            lines = []
+            for stack, weight in stacks.most_common():
+                names = []
+                for code in stack:
+                    if code not in labels:
+                        labels[code] = frame_label(code).replace(';', ':')
+                    names.append(labels[code])
+                lines.append('%s %d' % (';'.join(names), weight))
+            result[role] = lines
+        return result
+
+    def write(self, directory):
+        """
+        Writes one <role>.folded file per thread role into 'directory' (made if needed)
+
+        Returns:
+            list: The paths written
+        """
+        os.makedirs(directory, exist_ok=True)
+        paths = []
+        for role, lines in sorted(self.collapsed().items()):
+            path = os.path.join(directory, re.sub(r'[^\w.-]+', '_', role) + '.folded')
+            with open(path, 'w') as folded:
+                folded.write('\n'.join(lines) + '\n')
+            paths.append(path)
+        return paths
+
+    def summary(self, top=5):
+        """
+        Returns a short text report: each role's share of the samples and its hottest functions (by self time)
+        """
+        totals = {role: sum(stacks.values()) for role, stacks in self.__stacks.items()}
+        grand_total = sum(totals.values()) or 1
+        unit = self.__cpu_time and 'CPU ms' or 'samples'
+        lines = ['Profile: %d samples over %.1fs, weights in %s' % (
+            self.samples, (self.stopped or time.monotonic()) - (self.started or time.monotonic()), unit)]
+        for role, total in sorted(totals.items(), key=lambda item: -item[1]):
+            lines.append('  %-20s %10.1f %s (%4.1f%%)' % (role, self.__cpu_time and total / 1000 or total, unit,
+                                                        total * 100 / grand_total))
+            own = collections.Counter()
+            for stack, weight in self.__stacks[role].items():
+                own[stack[-1]] += weight
+            for code, weight in own.most_common(top):
+                lines.append('      %5.1f%%  %s' % (weight * 100 / (total or 1), frame_label(code)))
+        return '\n'.join(lines)
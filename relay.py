@@ -0,0 +1,387 @@
+"""
+Local fan-out relay for the jetsetradio.live CLI client.
+
+One relay process polls jetsetradio.live and pushes what changed to every
+client connected to it, over a Unix socket or a localhost TCP port, so many
+clients on one machine cost the website as much as one. Clients send their
+chat messages through the relay as well.
+
+The protocol is one JSON object per line, both ways. Relay -> client:
+
+    {"type": "tracklist", "songs": [[name, url], ...]}
+    {"type": "chat", "messages": [[user, text, role, fingerprint], ...]}    (new messages only)
+    {"type": "listeners", "count": 12}
+    {"type": "broadcast", "avatar": "djprofessork", "message": "..."}
+    {"type": "stats", "subscribers": 3, "fanout_ms": 0.4, ...}  (reply to a stats request)
+    {"type": "sent", "id": 7, "status": 200}                    (reply to a send request: the website's answer,
+    {"type": "sent", "id": 7, "error": "ConnectionError"}        or why there wasn't one)
+
+Every event also has "sent", the relay's time.time() when it went out.
+Client -> relay:
+
+    {"type": "send", "id": 7, "chatmessage": "...", "username": "...", "password": "..."}
+    {"type": "stats"}
+
+The relay tries each send once; the client's net.Outbox retries it.
+"""
+
+import asyncio
+import collections
+import itertools
+import json
+import os
+import requests
+import time
+
+from chat import ChatIngester, ChatMessage, parse_broadcast
+from net import BROADCAST_URL, CHAT_URL, LISTENERS_URL, SEND_URL, TIMEOUT, TRACKLIST_URL, HttpClient, PollSchedule
+from tracks import TracklistCache, parse_tracklist
+
+
+def parse_address(address):
+    """
+    Splits a relay address into ('tcp', host, port) for 'host:port' or ('unix', path, None) for anything else
+
+    Args:
+        address (str): The relay address
+    """
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit():
+        return 'tcp', host, int(port)
+    return 'unix', address, None
+
+
+def encode(event):
+    """
+    Stamps an event with the time it's sent and turns it into a protocol line
+
+    Args:
+        event (dict): The event to send
+    """
+    event['sent'] = time.time()
+    return json.dumps(event).encode('utf-8') + b'\n'
+
+
+def chat_event(messages):
+    """
+    Builds a 'chat' event out of ChatMessages; each goes as [user, text, role, fingerprint (hex)], the
+    fingerprint so clients can archive them
+
+    Args:
+        messages (list): The messages, oldest first
+    """
+    return {'type': 'chat', 'messages': [[message.user, message.text, message.role, message.fingerprint.hex()]
+                                         for message in messages]}
+
+
+class RelayServer(object):
+    def __init__(self, http, history_size=50, max_backlog=1024 * 1024, tracklist_cache=None, poll_intervals=None):
+        """
+        Polls jetsetradio.live once and fans the changes out to every subscriber
+
+        Args:
+            http (net.HttpClient): Client to poll upstream with
+            history_size (int): How many chat messages a new subscriber gets to start with
+            max_backlog (int): Bytes a subscriber may fall behind by before it gets disconnected
+            tracklist_cache (tracks.TracklistCache): Tracklist to start with while the website's asked for changes
+            poll_intervals (dict): 'chat', 'listeners' and/or 'broadcast' -> (min, max) seconds between polls
+        """
+        intervals = dict({'chat': (0.5, 5), 'listeners': (1, 15), 'broadcast': (5, 120)},  # The client's defaults
+                         **poll_intervals or {})
+        self.__http = http
+        self.__tracklist_cache = tracklist_cache
+        self.__max_backlog = max_backlog
+        self.__subscribers = set()  # StreamWriters of the connected clients
+        self.__ingester = ChatIngester(history_size)
+        self.__snapshot = {}  # type -> latest tracklist/listeners/broadcast event, replayed to new subscribers
+        self.__fanout_times = collections.deque(maxlen=100)  # Seconds each of the last fan-outs took
+        self.events_sent = 0  # Events sent, counting every subscriber separately
+        self.poll_schedules = {name: PollSchedule(*intervals[name]) for name in intervals}  # How often they're polled
+
+    @property
+    def stats(self):
+        """
+        Subscriber count and how long it takes to push an event to all of them
+        """
+        fanout_times = list(self.__fanout_times)
+        return {
+            'subscribers': len(self.__subscribers),
+            'events_sent': self.events_sent,
+            'fanout_ms': fanout_times and round(sum(fanout_times) / len(fanout_times) * 1000, 3) or 0,
+            'fanout_max_ms': fanout_times and round(max(fanout_times) * 1000, 3) or 0,
+            'upstream': self.__http.stats,
+            'polling': {name: schedule.stats for name, schedule in self.poll_schedules.items()},
+        }
+
+    def publish(self, event, keep=True):
+        """
+        Sends an event to every subscriber
+
+        Args:
+            event (dict): The event to send
+            keep (bool): Remember it as the latest of its type for subscribers that connect later
+        """
+        if keep:
+            self.__snapshot[event['type']] = event
+
+        start = time.perf_counter()
+        line = encode(event)
+        for writer in list(self.__subscribers):
+            transport = writer.transport
+            if transport.get_write_buffer_size() > self.__max_backlog:  # Not reading; don't buffer forever
+                self.__drop(writer)
+                continue
+            writer.write(line)
+            self.events_sent += 1
+
+        self.__fanout_times.append(time.perf_counter() - start)
+
+    def __drop(self, writer):
+        self.__subscribers.discard(writer)
+        writer.close()
+
+    async def handle_client(self, reader, writer):
+        """
+        Serves one subscriber: replays the current state, then handles its requests until it disconnects
+        """
+        for event in self.__snapshot.values():
+            writer.write(encode(event))
+        if self.__ingester.history:
+            writer.write(encode(chat_event(self.__ingester.history)))
+        self.__subscribers.add(writer)
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    continue
+
+                if request.get('type') == 'send':  # Chat message to pass on to the website
+                    reply = {'type': 'sent', 'id': request.get('id')}
+                    try:
+                        response = await self.__http.fetch('POST', SEND_URL, data={
+                            'chatmessage': request.get('chatmessage', ''), 'username': request.get('username', ''),
+                            'password': request.get('password', '')
+                        })
+                        reply['status'] = response.status_code
+                    except requests.RequestException as error:  # The client decides whether to try again
+                        reply['error'] = type(error).__name__
+                    writer.write(encode(reply))
+                elif request.get('type') == 'stats':
+                    stats = self.stats
+                    stats['type'] = 'stats'
+                    writer.write(encode(stats))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.__drop(writer)
+
+    async def poll_tracklist(self):
+        if self.__tracklist_cache is None:
+            while True:
+                try:
+                    response = await self.__http.fetch('GET', TRACKLIST_URL)
+                    response.raise_for_status()  # An error page would parse as no songs at all
+                    self.publish({'type': 'tracklist', 'songs': parse_tracklist(response.content)})
+                    return
+                except requests.RequestException:  # Keep trying; clients can't pick songs without it
+                    await asyncio.sleep(5)
+
+        songs = self.__tracklist_cache.load()
+        if songs:  # Clients can start playing before the website's even been asked
+            self.publish({'type': 'tracklist', 'songs': songs})
+        while True:
+            try:
+                songs = await self.__tracklist_cache.refresh(self.__http)
+                if songs:
+                    self.publish({'type': 'tracklist', 'songs': songs})
+                return
+            except requests.RequestException:  # Keep trying; clients can't pick songs without it
+                await asyncio.sleep(5)
+
+    async def poll_chat(self):
+        schedule = self.poll_schedules['chat']
+        while True:
+            try:
+                data = await self.__http.poll(CHAT_URL)
+                new_messages = data is not None and self.__ingester.ingest(data)
+                if new_messages:
+                    self.publish(chat_event(new_messages), keep=False)
+                schedule.record(changed=bool(new_messages))
+            except requests.RequestException:
+                schedule.record(error=True)
+            await schedule.wait()
+
+    async def poll_listeners(self):
+        schedule = self.poll_schedules['listeners']
+        while True:
+            try:
+                data = await self.__http.poll(LISTENERS_URL)
+                if data is not None:
+                    self.publish({'type': 'listeners', 'count': data.count(b'<user>')})
+                schedule.record(changed=data is not None)
+            except requests.RequestException:
+                schedule.record(error=True)
+            await schedule.wait()
+
+    async def poll_broadcast(self):
+        schedule = self.poll_schedules['broadcast']
+        while True:
+            try:
+                data = await self.__http.poll(BROADCAST_URL)
+                broadcast = data is not None and parse_broadcast(data)
+                if broadcast:  # Unparseable ones are skipped
+                    avatar, message = broadcast
+                    self.publish({'type': 'broadcast', 'avatar': avatar, 'message': message})
+                schedule.record(changed=data is not None)
+            except requests.RequestException:
+                schedule.record(error=True)
+            await schedule.wait()
+
+    async def serve(self, address, report_interval=10):
+        """
+        Listens on 'address' and polls upstream until cancelled, printing stats every report_interval seconds
+
+        Args:
+            address (str): 'host:port' or a Unix socket path
+            report_interval (float): Seconds between stats lines on stdout (0 = never)
+        """
+        kind, host, port = parse_address(address)
+        if kind == 'tcp':
+            server = await asyncio.start_server(self.handle_client, host, port)
+        else:
+            if os.path.exists(host):  # Left behind by a relay that didn't shut down cleanly
+                os.remove(host)
+            server = await asyncio.start_unix_server(self.handle_client, host)
+
+        print('relay listening on %s' % address, flush=True)
+        tasks = [asyncio.ensure_future(coroutine) for coroutine in
+                 (self.poll_tracklist(), self.poll_chat(), self.poll_listeners(), self.poll_broadcast())]
+        try:
+            while True:
+                await asyncio.sleep(report_interval or 3600)
+                if report_interval:
+                    stats = self.stats
+                    print('subscribers=%d fanout_ms=%.3f fanout_max_ms=%.3f events_sent=%d' % (
+                        stats['subscribers'], stats['fanout_ms'], stats['fanout_max_ms'], stats['events_sent']),
+                        ' '.join('%s_interval=%.2f %s_hit_rate=%.3f' % (name, poll['interval'], name, poll['hit_rate'])
+                                 for name, poll in stats['polling'].items()),
+                        flush=True)
+        finally:
+            for task in tasks:
+                task.cancel()
+            server.close()
+            if kind == 'unix' and os.path.exists(host):
+                os.remove(host)
+
+
+class RelayClient(object):
+    def __init__(self):
+        """
+        Connection to a relay, used by the client instead of polling jetsetradio.live itself
+        """
+        self.__reader = None
+        self.__writer = None
+        self.__loop = None
+        self.__ids = itertools.count(1)  # For matching the relay's 'sent' replies to the sends
+        self.__replies = {}  # id -> future of the 'sent' reply
+        self.latency = 0  # Seconds between the relay sending the last event and us reading it
+
+    async def connect(self, address):
+        """
+        Connects to the relay at 'address' ('host:port' or a Unix socket path)
+        """
+        kind, host, port = parse_address(address)
+        if kind == 'tcp':
+            self.__reader, self.__writer = await asyncio.open_connection(host, port)
+        else:
+            self.__reader, self.__writer = await asyncio.open_unix_connection(host)
+        self.__loop = asyncio.get_running_loop()
+
+    async def events(self):
+        """
+        Yields the relay's events as they arrive, until the relay goes away
+        """
+        while True:
+            try:
+                line = await self.__reader.readline()
+            except ConnectionError:  # Same as it hanging up
+                line = b''
+            if not line:
+                self.__writer.close()  # So fetch() knows, until connect() again
+                for reply in self.__replies.values():  # No answer's coming for those
+                    if not reply.done():
+                        reply.set_exception(requests.ConnectionError('the relay closed the connection'))
+                return
+
+            try:
+                event = json.loads(line)
+            except ValueError:  # Cut off halfway; the next readline() says it hung up
+                continue
+            self.latency = time.time() - event.get('sent', time.time())
+            if event.get('type') == 'sent':  # For fetch()
+                reply = self.__replies.get(event.get('id'))
+                if reply is not None and not reply.done():
+                    reply.set_result(event)
+                continue
+            if event.get('type') == 'chat':  # Hand chat messages over the way the ingester makes them
+                event['messages'] = [ChatMessage(user, text, role, bytes.fromhex(fingerprint))
+                                     for user, text, role, fingerprint in event['messages']]
+            yield event
+
+    async def fetch(self, method, url, data=None, **kwargs):
+        """
+        Stands in for net.HttpClient.fetch() for the client's net.Outbox: has the relay POST a chat message
+        (to its own SEND_URL, whatever 'url' is) and waits for the website's answer. Only called on the loop.
+
+        Returns:
+            requests.Response: Just the status code
+
+        Raises:
+            requests.RequestException: The relay couldn't send it, didn't answer in time or went away
+        """
+        if self.__writer is None or self.__writer.is_closing():
+            raise requests.ConnectionError('not connected to the relay')
+
+        request_id = next(self.__ids)
+        reply = self.__loop.create_future()
+        self.__replies[request_id] = reply
+        self.__writer.write(encode(dict(data or {}, type='send', id=request_id)))
+        try:
+            event = await asyncio.wait_for(reply, TIMEOUT * 2)  # The relay's own request times out after TIMEOUT
+        except asyncio.TimeoutError:
+            raise requests.Timeout('the relay didn\'t answer')
+        finally:
+            del self.__replies[request_id]
+
+        if 'error' in event:
+            raise requests.ConnectionError('the relay couldn\'t send it (%s)' % event['error'])
+        response = requests.Response()
+        response.url = url
+        response.status_code = event['status']
+        return response
+
+
+def run_relay(address, tracklist_cache_path='tracklist.json', http=None, poll_intervals=None):
+    """
+    Runs a relay on 'address' until interrupted (python3 main.py --relay [ADDRESS])
+
+    Args:
+        address (str): Unix socket path or host:port to listen on
+        tracklist_cache_path (str): Where the tracklist's cached; None to always fetch it
+        http (net.HttpClient): Client to poll upstream with (e.g. a capture.ReplayHttpClient); a new one if not given
+        poll_intervals (dict): See RelayServer
+    """
+    http = http or HttpClient()
+    tracklist_cache = tracklist_cache_path and TracklistCache(tracklist_cache_path) or None
+    try:
+        asyncio.run(RelayServer(http, tracklist_cache=tracklist_cache, poll_intervals=poll_intervals).serve(address))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        http.close()
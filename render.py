@@ -0,0 +1,272 @@
+"""
+Chat window renderer for the jetsetradio.live CLI client.
+
+The window is split into panels (header, chat, command list, input and the
+broadcast bar), each its own curses window. A panel is only redrawn when
+the values it shows have changed, and all redrawn panels go out to the
+terminal together with one doupdate(), so curses only sends the cells that
+actually changed instead of repainting the whole screen every frame.
+
+Frames are only drawn when something asks for one (RenderScheduler), and
+only ever by the thread that owns the screen.
+"""
+
+import collections
+import os
+import select
+import signal
+import sys
+import threading
+import time
+import unicurses
+
+from _curses import error as curses_error
+from metrics import registry as metrics
+
+
+def estimate_output(old_rows, new_rows):
+    """
+    Estimates how many bytes curses has to send to turn old_rows into new_rows: the changed
+    characters plus a cursor movement (~8 bytes) for every run of them
+
+    Args:
+        old_rows (list): Rows (bytes) the panel showed before, or None if it was never drawn
+        new_rows (list): Rows (bytes) the panel shows now
+    """
+    if old_rows is None:
+        old_rows = [b''] * len(new_rows)
+
+    total = 0
+    for old, new in zip(old_rows, new_rows):
+        if old == new:
+            continue
+
+        in_run = False
+        for i in range(max(len(old), len(new))):
+            if old[i:i + 1] != new[i:i + 1]:
+                total += in_run and 1 or 9  # First changed character of a run also pays for the cursor move
+                in_run = True
+            else:
+                in_run = False
+    return total
+
+
+class Panel(object):
+    def __init__(self, height, width, y, x, draw, key):
+        """
+        One rectangle of the chat window with its own curses window
+
+        Args:
+            height (int): Rows the panel covers
+            width (int): Columns the panel covers
+            y (int): Screen row of the panel's top left corner
+            x (int): Screen column of the panel's top left corner
+            draw (function): Called with the panel's window to draw the panel's contents onto it
+            key (function): Returns the values the panel shows; the panel's only redrawn when they change
+        """
+        self.window = unicurses.newwin(height, width, y, x)
+        self.height = height
+        self.__draw = draw
+        self.__key = key
+        self.__last_key = None
+        self.__rows = None  # What the panel showed after its last redraw, to estimate output with
+        self.dirty = True  # Forces a redraw on the next update (first frame, resizes)
+
+    def update(self):
+        """
+        Redraws the panel if what it shows has changed, staging it for the next doupdate()
+
+        Returns:
+            int: Estimated bytes the redraw will send to the terminal (0 if nothing changed)
+        """
+        key = self.__key()
+        if key == self.__last_key and not self.dirty:
+            return 0
+
+        self.__last_key = key
+        self.dirty = False
+
+        self.window.erase()  # Unlike clear(), erase() doesn't make curses resend the whole panel
+        self.__draw(self.window)
+        self.window.noutrefresh()
+
+        rows = []
+        for y in range(self.height):
+            try:
+                rows.append(self.window.instr(y, 0))
+            except curses_error:
+                rows.append(b'')
+        output = estimate_output(self.__rows, rows)
+        self.__rows = rows
+        return output
+
+
+class Renderer(object):
+    def __init__(self):
+        """
+        Draws the chat window panel by panel; see the module docstring
+        """
+        self.panels = []
+        self.__lock = threading.Lock()  # Frames can be asked for from more than one thread
+        self.__output = collections.deque()  # (time, estimated bytes) of the frames in the last second
+
+    def add_panel(self, height, width, y, x, draw, key=lambda: None):
+        """
+        Adds a panel; see Panel for the arguments. Panels are drawn in the order they're added.
+        """
+        panel = Panel(height, width, y, x, draw, key)
+        self.panels.append(panel)
+        return panel
+
+    def reset(self):
+        """
+        Drops every panel, to lay the window out again (e.g. after the terminal's been resized)
+        """
+        with self.__lock:
+            self.panels = []
+
+    def invalidate(self):
+        """
+        Makes every panel redraw on the next frame
+        """
+        for panel in self.panels:
+            panel.dirty = True
+
+    def render(self):
+        """
+        Redraws the panels that changed and sends them to the terminal in one go
+        """
+        with self.__lock, metrics.timer('render.frame'):
+            output = sum(panel.update() for panel in self.panels)
+            if output:
+                unicurses.doupdate()
+            metrics.counter('render.bytes').add(output)
+
+            now = time.monotonic()
+            self.__output.append((now, output))
+            while self.__output[0][0] < now - 1:
+                self.__output.popleft()
+
+    @property
+    def bytes_per_second(self):
+        """
+        Estimated bytes sent to the terminal over the last second. Panels show this while render() is drawing
+        them, with the lock held, so it doesn't take the lock: it reads a copy of the frames instead.
+        """
+        now = time.monotonic()
+        frames = tuple(self.__output)  # Copied in one go (under the GIL), so render() can't change it midway
+        return sum(output for frame_time, output in frames if frame_time >= now - 1)
+
+
+class RenderScheduler(object):
+    def __init__(self, max_fps=30):
+        """
+        Decides when the thread that owns the screen should draw a frame. Any thread can ask for a
+        frame with request(); requests that come in faster than max_fps are merged into one frame,
+        and when nothing asks, wait() sleeps until there's input or a request.
+
+        Args:
+            max_fps (int): The most frames to draw per second for state changes (input is drawn right away)
+        """
+        self.__interval = 1 / max_fps
+        self.__pending = False  # A frame has been requested but not drawn yet
+        self.__last_frame = 0  # time.monotonic() of the last frame
+        self.__lock = threading.Lock()
+        self.__resized = False  # Set by the SIGWINCH handler; see watch_resizes()
+
+        if sys.platform == 'win32':  # select() only works on sockets there, so wait() polls instead
+            self.__wake_read = self.__wake_write = None
+        else:  # A pipe that request() writes to, so select() wakes up alongside the keyboard
+            self.__wake_read, self.__wake_write = os.pipe()
+            os.set_blocking(self.__wake_read, False)
+            os.set_blocking(self.__wake_write, False)
+
+    def request(self, immediate=False):
+        """
+        Asks for a frame; safe to call from any thread
+
+        Args:
+            immediate (bool): Draw it now instead of waiting for the frame rate limit (e.g. for typing)
+        """
+        with self.__lock:
+            if immediate:
+                self.__last_frame = 0
+            if self.__pending and not immediate:  # Already on its way; this change will be in that frame
+                return
+            self.__pending = True
+
+        if self.__wake_write is not None:
+            try:
+                os.write(self.__wake_write, b'\0')
+            except BlockingIOError:  # Pipe's full of wake ups already
+                pass
+
+    def watch_resizes(self):
+        """
+        Makes wait() wake up when the terminal's resized, so the window can be laid out again right away (see
+        resized()). Takes over SIGWINCH from curses, so whoever calls this has to resize curses' screen
+        themselves. Only works on the main thread, and not on Windows, where curses reports KEY_RESIZE instead.
+
+        Returns:
+            bool: True if resizes are being watched
+        """
+        if self.__wake_write is None or not hasattr(signal, 'SIGWINCH'):
+            return False
+
+        def on_resize(signum, frame):  # Runs on the main thread between two bytecodes, so no locks in here
+            self.__resized = True
+
+        signal.signal(signal.SIGWINCH, on_resize)
+        signal.set_wakeup_fd(self.__wake_write, warn_on_full_buffer=False)  # Wakes select() in wait()
+        return True
+
+    def resized(self):
+        """
+        True if the terminal's been resized since the last call
+        """
+        if not self.__resized:
+            return False
+        self.__resized = False
+        return True
+
+    def wait(self, input_fd):
+        """
+        Sleeps until there's input on input_fd or a requested frame is due
+
+        Args:
+            input_fd (int): File descriptor of the terminal's input
+
+        Returns:
+            bool: True if there may be input to read
+        """
+        with self.__lock:
+            timeout = None  # Nothing to draw, so sleep until something happens
+            if self.__pending:
+                timeout = max(0, self.__last_frame + self.__interval - time.monotonic())
+
+        if self.__wake_read is None:
+            time.sleep(min(self.__interval if timeout is None else timeout, 0.02))
+            return True
+
+        readable, _, _ = select.select([input_fd, self.__wake_read], [], [], timeout)
+        if self.__wake_read in readable:
+            try:
+                os.read(self.__wake_read, 4096)  # Empty the pipe; the pending flag is what counts
+            except BlockingIOError:
+                pass
+        return input_fd in readable
+
+    def frame_due(self):
+        """
+        True if a frame was requested and the frame rate limit allows drawing it now
+        """
+        with self.__lock:
+            return self.__pending and time.monotonic() >= self.__last_frame + self.__interval
+
+    def frame_drawn(self):
+        """
+        Call after drawing a frame
+        """
+        with self.__lock:
+            self.__pending = False
+            self.__last_frame = time.monotonic()
@@ -0,0 +1,116 @@
+"""
+Startup timing for the jetsetradio.live CLI client.
+
+Records how long after the process started each step of startup happened
+(login screen up, first audio out, ...) and how long the heavy imports took,
+so slow starts can be pinned on something. The login screen only needs
+curses: the rest of the client (requests, asyncio, sqlite3, PyAudio...) is
+imported and set up in the Background while the user types their login.
+For every single import, there's python3 -X importtime main.py.
+"""
+
+import importlib
+import os
+import sys
+import threading
+import time
+
+
+def process_age():
+    """
+    Returns how many seconds ago this process started (so the interpreter starting up and imports
+    are counted too), or None where that can't be found out
+    """
+    try:
+        with open('/proc/self/stat', 'r') as stat:
+            fields = stat.read().rsplit(')', 1)[1].split()  # The process name can have spaces; skip past it
+        with open('/proc/uptime', 'r') as uptime:
+            now = float(uptime.read().split()[0])
+        return max(0.0, now - int(fields[19]) / os.sysconf('SC_CLK_TCK'))  # Field 22: start time, in ticks since boot
+    except (OSError, ValueError, IndexError, AttributeError):  # No /proc (Windows, macOS)
+        return None
+
+
+class StartupTimer(object):
+    def __init__(self):
+        """
+        Timeline of startup, starting when the process did (or when this was made, where that can't be told)
+        """
+        age = process_age()
+        self.__start = time.perf_counter() - (age or 0)
+        self.__from_process_start = age is not None
+        self.marks = {}  # Step -> seconds since start, in the order they happened
+        self.imports = {}  # Module -> seconds its import took, in the order they were imported
+
+    def mark(self, step):
+        """
+        Records when a step happened; only the first time counts
+
+        Args:
+            step (str): Name of the step
+        """
+        if step not in self.marks:
+            self.marks[step] = time.perf_counter() - self.__start
+
+    def load(self, *names):
+        """
+        Imports modules, noting how long each one took like python -X importtime does; that includes whatever it
+        imported that wasn't loaded yet, so the order matters. Modules already imported are skipped.
+
+        Args:
+            names (str): The modules, in the order to import them
+        """
+        for name in names:
+            if name in sys.modules:
+                continue
+            start = time.perf_counter()
+            importlib.import_module(name)
+            self.imports[name] = time.perf_counter() - start
+
+    def report(self):
+        """
+        Returns the timeline as text, one step per line, then the imports
+        """
+        lines = ['Startup timing (seconds since %s):' % ('the process started' if self.__from_process_start
+                                                        else 'main.py was loaded')]
+        for step, seconds in sorted(self.marks.items(), key=lambda mark: mark[1]):
+            lines.append('  %-24s %8.3f' % (step, seconds))
+        if self.imports:
+            lines.append('Imports (seconds, with what they imported that wasn\'t loaded yet):')
+            for name, seconds in self.imports.items():
+                lines.append('  %-24s %8.3f' % (name, seconds))
+        return '\n'.join(lines)
+
+
+class Background(object):
+    def __init__(self, function, name='loader'):
+        """
+        Runs function() on a thread of its own straight away, for what it returns to be picked up later
+
+        Args:
+            function (function): What to run; takes no arguments
+            name (str): Name of the thread
+        """
+        self.__result = None
+        self.__error = None
+        self.__thread = threading.Thread(target=self.__run, args=(function,), name=name, daemon=True)
+        self.__thread.start()
+
+    def __run(self, function):
+        try:
+            self.__result = function()
+        except BaseException as error:  # Raised again by result(), on the thread that wants it
+            self.__error = error
+
+    @property
+    def done(self):
+        return not self.__thread.is_alive()
+
+    def result(self):
+        """
+        Waits for function() to finish, then returns what it returned or raises what it raised
+        """
+        self.__thread.join()
+        if self.__error is not None:
+            raise self.__error
+        return self.__result
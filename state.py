@@ -0,0 +1,64 @@
+"""
+Shared state of the jetsetradio.live CLI client.
+
+Everything the pollers, the audio thread and the input loop used to share
+through module globals lives on one ClientState, which lets whoever draws
+the screen know when something changed.
+"""
+
+import threading
+
+
+class ClientState(object):
+    def __init__(self):
+        """
+        Holds everything displayed in the chat window. Read the attributes directly;
+        write them through update() so subscribers get notified.
+        """
+
+        self.chat_messages = []  # The messages to be written. Format = {'user': [username, color], 'msg': msg}
+        self.listeners = 0  # The amount of listeners currently listening to the podcast
+        self.marquee_text = u''  # The marquee to be displayed at the bottom of the screen
+        self.song_marquee_text = u''  # The marquee to be displayed at the top of the screen
+        self.current_song = 'Loading...'  # The song currently playing
+        self.playback_progress = 0  # 0 -> 1; How much audio has been played (for the status bar)
+        self.volume = 5  # The volume to play music at; goes from 0 to 9
+
+        self.__subscribers = []  # Functions called (from whichever thread made the change) after every change
+        self.__lock = threading.Lock()
+
+    def subscribe(self, callback):
+        """
+        Registers a function to be called with no arguments whenever the state changes
+
+        Args:
+            callback (function): Called from the thread that made the change, so keep it short
+        """
+        with self.__lock:
+            self.__subscribers.append(callback)
+
+    def update(self, **changes):
+        """
+        Sets the given attributes and notifies subscribers if any of them actually changed
+
+        Args:
+            **changes: Attribute names and their new values
+        """
+        changed = False
+        for name, value in changes.items():
+            assert hasattr(self, name), 'unknown state attribute %r' % name
+            if getattr(self, name) != value:
+                setattr(self, name, value)
+                changed = True
+
+        if changed:
+            self.notify()
+
+    def notify(self):
+        """
+        Tells subscribers something changed (e.g. the text input, which isn't part of the state)
+        """
+        with self.__lock:
+            subscribers = list(self.__subscribers)
+        for callback in subscribers:
+            callback()
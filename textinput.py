@@ -0,0 +1,103 @@
+"""
+Text editing for the jetsetradio.live CLI client's input boxes.
+
+EditBuffer is a gap buffer: the text before the cursor is a list in order
+and the text after it a list in reverse, so typing, deleting and moving the
+cursor only touch the ends of the lists instead of copying the whole string
+for every key, and a paste goes in with a single extend(). The string is
+only put together when it's read, once per change.
+"""
+
+
+class EditBuffer(object):
+    def __init__(self, limit=0):
+        """
+        The text of an input box and the cursor in it
+
+        Args:
+            limit (int): The most characters it can hold; 0 = no limit
+        """
+        self.__before = []  # Characters before the cursor
+        self.__after = []  # Characters after the cursor, the last one first
+        self.__limit = limit
+        self.__text = ''  # The whole text, put together when read; None = changed since
+
+    def __len__(self):
+        return len(self.__before) + len(self.__after)
+
+    @property
+    def text(self):
+        if self.__text is None:
+            self.__text = ''.join(self.__before) + ''.join(reversed(self.__after))
+        return self.__text
+
+    @text.setter
+    def text(self, text):  # Replaces the text, with the cursor at the end
+        self.__before = list(text)
+        self.__after = []
+        self.__text = text
+
+    @property
+    def cursor(self):  # Characters before the cursor
+        return len(self.__before)
+
+    def insert(self, text):
+        """
+        Types text in at the cursor, as much of it as fits under the limit
+
+        Args:
+            text (str): The text, e.g. a run of pasted characters
+
+        Returns:
+            int: How many characters went in
+        """
+        if self.__limit:
+            text = text[:max(0, self.__limit - len(self))]
+        if text:
+            self.__before.extend(text)
+            self.__text = None
+        return len(text)
+
+    def update(self, key):
+        """
+        Applies a key: a character is typed in, arrows/HOME/END move the cursor and DELETE/BACKSPACE delete
+
+        Args:
+            key (str): The key, as returned by get_key(); anything else is ignored
+
+        Returns:
+            bool: Whether the key did something
+        """
+        before, after = self.__before, self.__after
+        if len(key) == 1:
+            return bool(self.insert(key))
+        elif key == 'KEY_LEFT':
+            if not before:
+                return False
+            after.append(before.pop())
+            return True
+        elif key == 'KEY_RIGHT':
+            if not after:
+                return False
+            before.append(after.pop())
+            return True
+        elif key == 'KEY_HOME':
+            after.extend(reversed(before))
+            before.clear()
+            return True
+        elif key == 'KEY_END':
+            before.extend(reversed(after))
+            after.clear()
+            return True
+        elif key == 'KEY_DC':  # The character after the cursor
+            if not after:
+                return False
+            after.pop()
+        elif key == 'KEY_BACKSPACE':  # The character before the cursor
+            if not before:
+                return False
+            before.pop()
+        else:
+            return False
+        self.__text = None
+        return True
@@ -0,0 +1,321 @@
+"""
+Tracklist handling for the jetsetradio.live CLI client.
+
+The tracklist is kept on disk with the validators it was served with, so
+the client has songs to pick from the moment it starts and only asks the
+website whether the list changed (a 304 most of the time) in the background.
+"""
+
+import bisect
+import collections
+import difflib
+import json
+import os
+import re
+
+from net import SONG_URL, TRACKLIST_URL
+
+
+def parse_tracklist(data):
+    """
+    Parses the tracklist the website's audio player loads (~list.js) into the master list of songs
+
+    Args:
+        data (bytes): The contents of ~list.js
+
+    Returns:
+        list: Songs in the format [song name, song url]
+    """
+    songs = []
+    for song_name in re.findall(b'"(.*)";', data):  # Since the list is for a JS exec(), we need to parse it
+        song_name = song_name.decode('utf-8')
+        songs.append([song_name, SONG_URL % song_name])  # Format names into URLs
+    return songs
+
+
+class TracklistCache(object):
+    def __init__(self, path):
+        """
+        The tracklist as last fetched, with its ETag / Last-Modified
+
+        Args:
+            path (str): JSON file the tracklist is kept in
+        """
+        self.__path = path
+        self.__validators = {}  # Headers to send to ask "has the tracklist changed?"
+
+    def load(self):
+        """
+        Reads the cached tracklist; never touches the network
+
+        Returns:
+            list: Songs in the format [song name, song url], empty if there's no (usable) cache yet
+        """
+        try:
+            with open(self.__path, 'r') as cache:
+                cached = json.load(cache)
+            songs = cached['songs']
+        except (OSError, ValueError, KeyError, TypeError):  # Missing or broken; the refresh will replace it
+            return []
+
+        self.__validators = cached.get('validators', {})
+        return songs
+
+    async def refresh(self, http, url=TRACKLIST_URL):
+        """
+        Asks the website for the tracklist if it changed since it was cached, and caches it if it did
+
+        Args:
+            http (net.HttpClient): The client to fetch it with
+            url (str): Where the tracklist is
+
+        Returns:
+            list: The new songs, or None if the cached ones are still current
+        """
+        response = await http.fetch('GET', url, headers=self.__validators)
+        if response.status_code != 200:  # 304 Not Modified (or the site's having trouble): keep what we have
+            return None
+
+        validators = {}
+        if 'ETag' in response.headers:
+            validators['If-None-Match'] = response.headers['ETag']
+        if 'Last-Modified' in response.headers:
+            validators['If-Modified-Since'] = response.headers['Last-Modified']
+
+        songs = parse_tracklist(response.content)
+        self.__validators = validators
+        self.__save({'validators': validators, 'songs': songs})
+        return songs
+
+    def __save(self, cached):
+        """
+        Writes the cache next to the old one and swaps it in, so a crash halfway leaves the old one intact
+        """
+        temp_path = '%s.part' % self.__path
+        try:
+            with open(temp_path, 'w') as cache:
+                json.dump(cached, cache)
+            os.replace(temp_path, self.__path)
+        except OSError:  # Can't write it (read-only folder?); it'll just be fetched again next time
+            pass
+
+
+def tokenize(text):
+    """
+    Splits a song name (or a search) into lowercase words
+
+    Args:
+        text (str): The text to split
+    """
+    return re.findall(r'\w+', text.casefold())
+
+
+class TrackIndex(object):
+    def __init__(self, songs):
+        """
+        Search index over the song names, built once per tracklist. Every word of a search has to
+        be the start of a word in the name; words that aren't found anywhere are swapped for the
+        closest words in the tracklist (typos), found by spelling out their typos or through their trigrams.
+
+        The songs matching a search word are kept as a bitmask (an int, bit n for song n), so a search
+        of several words ANDs them together in C and picks the lowest bits, however many songs match.
+        Words and prefixes matching a lot of songs have theirs made up front; the rest are quick to make.
+
+        Args:
+            songs (list): Songs in the format [song name, song url]
+        """
+        self.songs = songs
+        # Songs are numbered shortest name first, so the lowest bits of a bitmask are the best matches
+        self.__ranked = sorted(songs, key=lambda song: len(song[0]))
+        self.__postings = collections.defaultdict(list)  # word -> numbers of the songs with it, in order
+        for song, (name, url) in enumerate(self.__ranked):
+            for token in set(tokenize(name)):
+                self.__postings[token].append(song)
+        self.__tokens = sorted(self.__postings)  # Every word, sorted so all the words with a prefix sit together
+        self.__letters = sorted(set(''.join(self.__tokens)))  # Every letter in the words, to spell typos with
+        self.__trigrams = collections.defaultdict(list)  # (trigram, word length) -> words, to find typos with
+        for token in self.__tokens:
+            for trigram in self.__trigrams_of(token):
+                self.__trigrams[trigram, len(token)].append(token)
+
+        # Past this many songs a bitmask takes less memory than a list of them, and longer to make on the spot
+        self.__heavy = max(64, len(self.__ranked) // 64)
+        self.__word_masks = {token: self.__mask(songs) for token, songs in self.__postings.items()
+                             if len(songs) > self.__heavy}  # Word -> bitmask of the songs with it
+        self.__prefix_masks = self.__build_prefix_masks()  # Prefix -> bitmask of the songs with a word starting so
+
+    @staticmethod
+    def __trigrams_of(word):
+        padded = ' %s ' % word  # Padding lets short words and word starts/ends count
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    def __mask(self, *song_lists):
+        """
+        Returns the bitmask of the songs in any of the lists
+        """
+        bits = bytearray((len(self.__ranked) >> 3) + 1)
+        for songs in song_lists:
+            for song in songs:
+                bits[song >> 3] |= 1 << (song & 7)
+        return int.from_bytes(bits, 'little')
+
+    def __build_prefix_masks(self):
+        """
+        Makes the bitmasks of the prefixes whose words are in more than self.__heavy songs (counted with
+        repeats, which is quick to count from the sorted words). Every prefix of such a prefix is one too, so
+        each word's songs are only added to its longest one, which is then ORed into the shorter ones.
+        """
+        counts = [0]  # Songs per word, added up in the order of self.__tokens
+        for token in self.__tokens:
+            counts.append(counts[-1] + len(self.__postings[token]))
+
+        heavy = {}  # Prefix -> its songs' lists (only the words it's the longest heavy prefix of)
+        light = set()  # Prefixes already counted and found not to be
+        for token in self.__tokens:
+            longest = None
+            for length in range(1, len(token) + 1):
+                prefix = token[:length]
+                if prefix in light:
+                    break
+                if prefix not in heavy:
+                    start = bisect.bisect_left(self.__tokens, prefix)
+                    end = bisect.bisect_left(self.__tokens, prefix + '\U0010ffff', start)
+                    if counts[end] - counts[start] <= self.__heavy:
+                        light.add(prefix)
+                        break
+                    heavy[prefix] = []
+                longest = prefix
+            if longest is not None:
+                heavy[longest].append(self.__postings[token])
+
+        masks = {prefix: self.__mask(*song_lists) for prefix, song_lists in heavy.items()}
+        for prefix in sorted(masks, key=len, reverse=True):  # Longest first, so they're complete when ORed in
+            if len(prefix) > 1:
+                masks[prefix[:-1]] |= masks[prefix]
+        return masks
+
+    def __prefixed(self, prefix):
+        """
+        Returns the words starting with 'prefix'
+        """
+        start = bisect.bisect_left(self.__tokens, prefix)
+        end = bisect.bisect_left(self.__tokens, prefix + '\U0010ffff', start)  # Past the last word with the prefix
+        return self.__tokens[start:end]
+
+    def __word_mask(self, word):
+        """
+        Returns the bitmask of the songs with the word 'word'
+        """
+        mask = self.__word_masks.get(word)
+        if mask is None:
+            mask = self.__mask(self.__postings.get(word, ()))
+        return mask
+
+    def __prefix_mask(self, prefix):
+        """
+        Returns the bitmask of the songs with a word starting with 'prefix' (0 if there aren't any)
+        """
+        mask = self.__prefix_masks.get(prefix)
+        if mask is None:
+            mask = self.__mask(*(self.__postings[word] for word in self.__prefixed(prefix)))
+        return mask
+
+    def __near(self, term):
+        """
+        Returns the words one typo away from 'term': a letter missing, one too many, one wrong or two swapped.
+        Trying every such spelling (with the letters the tracklist has) is a few hundred lookups, far quicker
+        than comparing trigrams, and that's most typos.
+        """
+        splits = [(term[:i], term[i:]) for i in range(len(term) + 1)]
+        spellings = {start + end[1:] for start, end in splits if end}
+        spellings.update(start + end[1] + end[0] + end[2:] for start, end in splits if len(end) > 1)
+        spellings.update(start + letter + end[1:] for start, end in splits if end for letter in self.__letters)
+        spellings.update(start + letter + end for start, end in splits for letter in self.__letters)
+        return [spelling for spelling in spellings if spelling in self.__postings]
+
+    def __fuzzy(self, term, candidates=10, cutoff=0.7, spread=2):
+        """
+        Returns the words closest to 'term', for when nothing starts with it: the ones a typo away if there
+        are any, otherwise the closest by trigrams. Only words at most 'spread' letters longer or shorter are
+        looked at for those; a typo rarely changes the length by more.
+        """
+        near = self.__near(term)
+        if near:
+            if len(near) > candidates:
+                near.sort(key=lambda word: difflib.SequenceMatcher(None, term, word).ratio(), reverse=True)
+            return near[:candidates]
+
+        # Trigrams half the words have say nothing about which word was meant; leave them out unless they're all
+        # there is
+        lengths = range(max(1, len(term) - spread), len(term) + spread + 1)
+        lists = sorted((self.__trigrams.get((trigram, length), ()) for trigram in self.__trigrams_of(term)
+                        for length in lengths), key=len)
+        common = max(64, len(self.__tokens) // 100)
+        shared = collections.Counter()
+        for tokens in lists:
+            if len(tokens) > common and shared:
+                break
+            shared.update(tokens)
+
+        # Only the words sharing the most trigrams get the (slower) proper comparison
+        close = []
+        for token, count in shared.most_common(candidates):
+            if difflib.SequenceMatcher(None, term, token).ratio() >= cutoff:
+                close.append(token)
+        return close
+
+    @staticmethod
+    def __lowest(mask, count):
+        """
+        Returns the numbers of the lowest 'count' songs in a bitmask, lowest first
+        """
+        songs = []
+        while mask and len(songs) < count:
+            lowest = mask & -mask
+            songs.append(lowest.bit_length() - 1)
+            mask ^= lowest
+        return songs
+
+    def search(self, query, limit=10):
+        """
+        Finds the songs matching a search, best match first: songs where every search word is a
+        whole word of the name come first, then ones where some only match the start of a word;
+        shorter names first within each
+
+        Args:
+            query (str): What to search for
+            limit (int): Most songs to return
+
+        Returns:
+            list: Songs in the format [song name, song url]
+        """
+        terms = tokenize(query)
+        if not terms:
+            return []
+
+        # Whole words first: every term has to be a word of the name
+        exact = 0
+        if all(term in self.__postings for term in terms):
+            exact = -1  # Every song, until ANDed with the terms
+            for term in sorted(terms, key=lambda term: len(self.__postings[term])):  # Rarest first; 0 ends it early
+                exact &= self.__word_mask(term)
+                if not exact:
+                    break
+        found = self.__lowest(exact, limit)
+
+        # Then word starts, and the closest words for terms that don't start any word
+        if len(found) < limit:
+            matches = ~exact  # Every song not found already
+            for term in terms:
+                mask = self.__prefix_mask(term)
+                if not mask:  # Nothing starts with it: a typo?
+                    words = self.__fuzzy(term)
+                    mask = 0
+                    for word in words:
+                        mask |= self.__word_mask(word)
+                matches &= mask
+                if not matches:
+                    break
+            found.extend(self.__lowest(matches, limit - len(found)))
+
+        return [self.__ranked[song] for song in found]